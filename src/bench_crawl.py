@@ -0,0 +1,82 @@
+"""
+Crawl throughput benchmark: runs a full RedditLookup.search_reddit against the offline SyntheticRedditSession stand-in
+and reports requests/sec (overall and per endpoint), rows/sec per table and the peak RSS of the process.
+The crawl writes to the database of the given db config, so point it to a scratch database.
+
+Usage: python bench_crawl.py --db-config config/bench_db_config.yml --subreddits 4 --keywords 6 --latency 0.05
+"""
+import argparse
+import os
+import resource
+import time
+
+from reddit_lookup import RedditLookup
+from reddit_standin import SyntheticRedditSession, standin_reddit_kwargs
+
+TABLES = ['redditors', 'submissions', 'comments', 'submission_keywords']
+
+
+def count_rows(rl: RedditLookup) -> dict:
+    return {t: rl.generic_db.execute_query(f'SELECT count(*) FROM {t};', fetch_one=True)[0][0] for t in TABLES}
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument('--db-config', default=None, help='Path of the db config (defaults to config/db_config.yml)')
+    arg_parser.add_argument('--subreddits', type=int, default=None, help='Number of registered subreddits to crawl')
+    arg_parser.add_argument('--keywords', type=int, default=None, help='Number of keywords to search')
+    arg_parser.add_argument('--submissions-per-search', type=int, default=25)
+    arg_parser.add_argument('--comments-per-submission', type=int, default=50)
+    arg_parser.add_argument('--inline-comments', type=int, default=20)
+    arg_parser.add_argument('--search-cap', type=int, default=250, help='Maximum number of results of a search listing')
+    arg_parser.add_argument('--latency', type=float, default=0.0, help='Synthetic latency of every request (seconds)')
+    arg_parser.add_argument('--rate-limit-budget', type=int, default=600, help='Requests allowed per 10 minute window')
+    arg_parser.add_argument('--workers', type=int, default=None, help='Overrides max_workers of config/crawler.yml')
+    arg_parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic corpus')
+    args = arg_parser.parse_args()
+
+    # The stand-in accepts any credentials
+    for key in ['client_id', 'client_secret', 'username', 'password', 'user_agent']:
+        os.environ.setdefault(key, 'standin')
+
+    session = SyntheticRedditSession(submissions_per_search=args.submissions_per_search,
+                                     comments_per_submission=args.comments_per_submission,
+                                     inline_comments=args.inline_comments,
+                                     seed=args.seed,
+                                     search_cap=args.search_cap,
+                                     latency=args.latency,
+                                     rate_limit_budget=args.rate_limit_budget)
+    rl = RedditLookup(reddit_kwargs=standin_reddit_kwargs(session), db_config_path=args.db_config)
+    rl.crawler_config['resume'] = False
+    rl.crawler_config['search_result_cap'] = args.search_cap
+    if args.workers is not None:
+        rl.crawler_config['max_workers'] = args.workers
+    if args.keywords is not None:
+        rl.search_keywords = rl.search_keywords[:args.keywords]
+    if args.subreddits is not None:
+        rl.all_subs = rl.all_subs.iloc[:args.subreddits]
+
+    rows_before = count_rows(rl)
+    requests_before = session.requests_by_endpoint.copy()
+    start = time.perf_counter()
+    rl.search_reddit()
+    elapsed = time.perf_counter() - start
+    rows_after = count_rows(rl)
+    requests = session.requests_by_endpoint - requests_before
+
+    print()
+    print(f'Crawled {len(rl.all_subs)} subreddits x {len(rl.search_keywords)} keywords in {elapsed:.2f}s '
+          f'(max_workers={rl.crawler_config.get("max_workers", 1)}, latency={args.latency}s)')
+    print(f'Requests: {sum(requests.values())} ({sum(requests.values()) / elapsed:.1f}/s)')
+    for endpoint, count in sorted(requests.items()):
+        print(f'  {endpoint:<28}{count:>8}{count / elapsed:>10.1f}/s')
+    print('Rows:')
+    for t in TABLES:
+        inserted = rows_after[t] - rows_before[t]
+        print(f'  {t:<28}{inserted:>8}{inserted / elapsed:>10.1f}/s')
+    # ru_maxrss is in kilobytes on Linux
+    print(f'Peak RSS: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MB')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+"""
+Command line entry point of the crawler and of the tables built on the crawled data. Every command imports the modules it
+needs when it runs, so a command which does not crawl never loads praw, and plan does not even load pandas or psycopg2.
+The config files are read from --config-dir (the config directory next to this file by default), whatever the working
+directory is.
+
+Usage:
+    python cli.py register                      Registers the subreddits of subreddits.yml missing from the database
+    python cli.py crawl [--workers 8]           Searches the keywords in the registered subreddits
+    python cli.py export --root-dir snapshots   Exports the crawled tables into Parquet snapshots
+    python cli.py stats [--stats-dir stats]     Prints (or writes) the keyword and subreddit statistics
+    python cli.py backfill rollups|hits|text    Rebuilds a derived table from the stored rows
+    python cli.py plan                          Prints the searches a crawl runs per subreddit
+    python cli.py duplicates submissions        Prints the near-duplicate rate of the submissions (or comments)
+"""
+import argparse
+import os
+
+DEFAULT_CONFIG_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config')
+
+
+def _db_config_path(args) -> str:
+    return args.db_config or os.path.join(args.config_dir, 'db_config.yml')
+
+
+def _generic_db(args):
+    from generic_db import GenericDBOperations
+    return GenericDBOperations(path=_db_config_path(args))
+
+
+def _reddit_lookup(args):
+    from reddit_lookup import RedditLookup
+    return RedditLookup(db_config_path=_db_config_path(args), config_dir=args.config_dir)
+
+
+def register(args):
+    # Only the subreddits table and, if any subreddit is missing, a praw instance are needed
+    from reddit_lookup import create_reddit, load_env, register_subreddits
+    load_env(args.config_dir)
+    register_subreddits(_generic_db(args), args.config_dir, get_reddit=create_reddit)
+
+
+def crawl(args):
+    rl = _reddit_lookup(args)
+    if args.workers is not None:
+        rl.crawler_config['max_workers'] = args.workers
+    if args.new_run:
+        rl.crawler_config['resume'] = False
+    rl.search_reddit()
+
+
+def export(args):
+    from snapshot_export import SnapshotStore
+    SnapshotStore(args.root_dir, _generic_db(args)).export_all(chunk_size=args.chunk_size)
+
+
+def stats(args):
+    from corpus_stats import CorpusStats, write_stats
+    corpus_stats = CorpusStats(_generic_db(args)).compute()
+    if args.stats_dir:
+        write_stats(corpus_stats, args.stats_dir)
+        print('Stats written to', args.stats_dir)
+        return
+    for name, df in corpus_stats.items():
+        print(name)
+        print(df.to_string())
+        print()
+
+
+def backfill(args):
+    generic_db = _generic_db(args)
+    if args.table == 'rollups':
+        from keyword_rollups import KeywordRollups
+        KeywordRollups(generic_db).backfill()
+    elif args.table == 'hits':
+        from keyword_matcher import KeywordHits, KeywordMatcher
+        matcher = KeywordMatcher.from_config(os.path.join(args.config_dir, 'keywords.yml'))
+        KeywordHits(generic_db, matcher).backfill(chunk_size=args.chunk_size)
+    else:
+        from text_normalizer import TextNormalizer
+        TextNormalizer(generic_db).backfill(chunk_size=args.chunk_size)
+
+
+def plan(args):
+    import yaml
+    from query_planner import SearchPlanner
+
+    with open(os.path.join(args.config_dir, 'keywords.yml')) as config_stream:
+        keywords = yaml.full_load(config_stream)['keywords']
+    crawler_config = {}
+    if os.path.isfile(os.path.join(args.config_dir, 'crawler.yml')):
+        with open(os.path.join(args.config_dir, 'crawler.yml')) as config_stream:
+            crawler_config = yaml.full_load(config_stream)['crawler']
+    searches = SearchPlanner.from_config(keywords, crawler_config).plan()
+    print(f'{len(keywords)} keywords -> {len(searches)} searches per subreddit')
+    for search in searches:
+        print(search.query)
+        print('  covers:', ', '.join(search.keywords))
+
+
+def duplicates(args):
+    from near_duplicates import print_duplicates
+    print_duplicates(_generic_db(args), args.table, threshold=args.threshold, top=args.top)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument('--config-dir', default=DEFAULT_CONFIG_DIR, help='Directory of the config files')
+    arg_parser.add_argument('--db-config', default=None, help='Path of the db config (defaults to db_config.yml of '
+                                                              'the config directory)')
+    commands = arg_parser.add_subparsers(dest='command', required=True)
+
+    commands.add_parser('register', help='Register the subreddits of subreddits.yml').set_defaults(handler=register)
+
+    crawl_parser = commands.add_parser('crawl', help='Search the keywords in the registered subreddits')
+    crawl_parser.add_argument('--workers', type=int, default=None, help='Overrides max_workers of crawler.yml')
+    crawl_parser.add_argument('--new-run', action='store_true', help='Start a new run instead of resuming the last one')
+    crawl_parser.set_defaults(handler=crawl)
+
+    export_parser = commands.add_parser('export', help='Export the crawled tables into Parquet snapshots')
+    export_parser.add_argument('--root-dir', default='snapshots', help='Directory of the snapshots')
+    export_parser.add_argument('--chunk-size', type=int, default=100000, help='Rows read from the database at a time')
+    export_parser.set_defaults(handler=export)
+
+    stats_parser = commands.add_parser('stats', help='Print the keyword and subreddit statistics')
+    stats_parser.add_argument('--stats-dir', default=None, help='Write the statistics as CSV files into this directory')
+    stats_parser.set_defaults(handler=stats)
+
+    backfill_parser = commands.add_parser('backfill', help='Rebuild a derived table from the stored rows')
+    backfill_parser.add_argument('table', choices=['rollups', 'hits', 'text'],
+                                 help='keyword_daily_rollups, keyword_hits or the cleaned text columns')
+    backfill_parser.add_argument('--chunk-size', type=int, default=10000, help='Rows read from the database at a time')
+    backfill_parser.set_defaults(handler=backfill)
+
+    commands.add_parser('plan', help='Print the searches a crawl runs per subreddit').set_defaults(handler=plan)
+
+    duplicates_parser = commands.add_parser('duplicates', help='Print the near-duplicate rate of the crawled texts')
+    duplicates_parser.add_argument('table', choices=['submissions', 'comments'], help='The table whose texts are compared')
+    duplicates_parser.add_argument('--threshold', type=float, default=0.8, help='Minimum similarity of near-duplicates')
+    duplicates_parser.add_argument('--top', type=int, default=10, help='Number of largest clusters printed')
+    duplicates_parser.set_defaults(handler=duplicates)
+
+    args = arg_parser.parse_args()
+    args.handler(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+from collections import deque
+
+import numpy as np
+import pandas as pd
+
+
+def bot_comment_mask(bodies) -> np.ndarray:
+    """
+    Given the bodies of some comments, this function flags the ones written by bots (the ones stating "I am a bot").
+    :param bodies: The comment bodies (nulls are allowed).
+    :return: A boolean array, True for the bot comments.
+    """
+    return pd.Series(bodies, dtype=object).str.contains('am a bot', regex=False, na=False).to_numpy(dtype=bool)
+
+
+class CommentForest:
+    """
+    CommentForest holds the comment trees of many submissions in compact array-backed form. The submissions are the
+    roots (nodes 0 .. n_roots - 1) and the comments follow them (nodes n_roots .. n_nodes - 1, in the given order).
+    The tree is stored as a parent index per node and the children of each node in a CSR layout: the children of node i
+    are children[child_offsets[i]: child_offsets[i + 1]], in the order the comments were given.
+    Comments whose parent is unknown (not crawled, deleted, or excluded) are detached, and so is their whole subtree:
+    the traversals only reach the nodes connected to a root.
+    """
+
+    def __init__(self, node_ids: np.ndarray, parent: np.ndarray, n_roots: int):
+        self.node_ids = node_ids
+        self.parent = parent
+        self.n_roots = n_roots
+
+        # Group the nodes by parent: a counting pass for the offsets and a stable sort to keep the comment order
+        attached = np.flatnonzero(parent >= 0)
+        counts = np.bincount(parent[attached], minlength=len(parent))
+        self.child_offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        self.children = attached[np.argsort(parent[attached], kind='stable')].astype(np.int64)
+
+        self.depth, self.root, self._level_order = self._compute_levels()
+
+    @classmethod
+    def from_arrays(cls, root_ids, comment_ids, parent_ids, exclude=None):
+        """
+        Given the ids of the roots (submissions) and the ids and parent ids of the comments, this method builds the forest
+        in O(N) (besides the sort of the children by parent).
+        :param root_ids: The submission ids (fullnames, e.g. t3_...).
+        :param comment_ids: The comment ids (fullnames, e.g. t1_...), unique.
+        :param parent_ids: The parent id of each comment, either a submission or a comment fullname.
+        :param exclude: Optional boolean mask of the comments to leave out (e.g. bot_comment_mask of the bodies), their
+        replies are left out as well.
+        :return: The CommentForest.
+        """
+        root_ids = np.asarray(root_ids, dtype=object)
+        comment_ids = np.asarray(comment_ids, dtype=object)
+        node_ids = np.concatenate([root_ids, comment_ids])
+        index = pd.Index(node_ids)
+        if not index.is_unique:
+            raise ValueError('The submission and comment ids of a CommentForest must be unique')
+
+        parent = np.full(len(node_ids), -1, dtype=np.int64)
+        parent[len(root_ids):] = index.get_indexer(np.asarray(parent_ids, dtype=object))
+        if exclude is not None:
+            parent[len(root_ids):][np.asarray(exclude, dtype=bool)] = -1
+        return cls(node_ids=node_ids, parent=parent, n_roots=len(root_ids))
+
+    @property
+    def n_nodes(self) -> int:
+        return len(self.node_ids)
+
+    def child_indices(self, node: int) -> np.ndarray:
+        return self.children[self.child_offsets[node]: self.child_offsets[node + 1]]
+
+    def _expand(self, frontier: np.ndarray) -> np.ndarray:
+        # The children of all the frontier nodes at once, in frontier order
+        starts = self.child_offsets[frontier]
+        lengths = self.child_offsets[frontier + 1] - starts
+        total = lengths.sum()
+        if total == 0:
+            return frontier[:0]
+        shifts = np.repeat(starts - np.concatenate([[0], np.cumsum(lengths)[:-1]]), lengths)
+        return self.children[shifts + np.arange(total)]
+
+    def _compute_levels(self) -> tuple:
+        # Level by level from all the roots at once, the nodes which are never reached keep a depth and root of -1
+        depth = np.full(self.n_nodes, -1, dtype=np.int32)
+        root = np.full(self.n_nodes, -1, dtype=np.int64)
+        frontier = np.arange(self.n_roots, dtype=np.int64)
+        root[frontier] = frontier
+        levels = []
+        level = 0
+        while len(frontier):
+            depth[frontier] = level
+            levels.append(frontier)
+            frontier = self._expand(frontier)
+            root[frontier] = root[self.parent[frontier]]
+            level += 1
+        return depth, root, np.concatenate(levels) if levels else np.empty(0, dtype=np.int64)
+
+    def bfs_order(self, root: int) -> np.ndarray:
+        """
+        Given a node, this method returns its subtree in breadth-first order (the node first), expanding whole levels at
+        a time.
+        :param root: The index of the node.
+        :return: An array of node indices.
+        """
+        levels = [np.array([root], dtype=np.int64)]
+        while True:
+            frontier = self._expand(levels[-1])
+            if not len(frontier):
+                break
+            levels.append(frontier)
+        return np.concatenate(levels)
+
+    def bfs_order_all(self) -> tuple:
+        """
+        This method returns the breadth-first order of every tree of the forest at once. Restricted to one tree, the level
+        order of the whole forest is the breadth-first order of the tree, so a stable sort by root groups it per tree.
+        :return: A two-tuple of an array of node indices (tree after tree, in root order) and the offsets of the trees in
+        it: the nodes of the tree of root r are order[offsets[r]: offsets[r + 1]].
+        """
+        order = self._level_order[np.argsort(self.root[self._level_order], kind='stable')]
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(self.root[order], minlength=self.n_roots))]).astype(np.int64)
+        return order, offsets
+
+    def bfs(self, root: int):
+        """
+        Given a node, this method lazily iterates over its subtree in breadth-first order (the node first).
+        :param root: The index of the node.
+        :return: A generator of node indices.
+        """
+        queue = deque([root])
+        while queue:
+            node = queue.popleft()
+            yield node
+            queue.extend(self.children[self.child_offsets[node]: self.child_offsets[node + 1]].tolist())
+
+    def dfs(self, root: int):
+        """
+        Given a node, this method lazily iterates over its subtree in depth-first pre-order (the node first), without
+        recursion so that deep threads do not hit the recursion limit.
+        :param root: The index of the node.
+        :return: A generator of node indices.
+        """
+        stack = [root]
+        while stack:
+            node = stack.pop()
+            yield node
+            stack.extend(reversed(self.children[self.child_offsets[node]: self.child_offsets[node + 1]].tolist()))
+
+    def reachable_mask(self) -> np.ndarray:
+        """
+        :return: A boolean array, True for the nodes connected to a root.
+        """
+        return self.depth >= 0
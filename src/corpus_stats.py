@@ -0,0 +1,182 @@
+import os
+
+import pandas as pd
+
+from generic_db import GenericDBOperations
+
+# The emotion labels of the emotion model, in the column order of stats/emotion_stats.csv
+EMOTION_LABELS = ['neutral', 'curiosity', 'disapproval', 'approval', 'confusion', 'annoyance', 'disappointment',
+                  'admiration', 'optimism', 'disgust', 'anger', 'desire', 'caring', 'surprise', 'sadness',
+                  'embarrassment', 'excitement', 'fear', 'amusement', 'nervousness', 'love', 'joy', 'relief', 'grief',
+                  'remorse', 'gratitude', 'pride']
+
+_DOCUMENT_KEYS = ['sub', 'sentiment_direction', 'Topic']
+
+
+def _rollup(partial: pd.DataFrame, keys: list, columns: list) -> pd.DataFrame:
+    # partial holds a <column>_sum and a <column>_count (non-null values) per fine group, coarser groups add them up.
+    # columns is a list of (name, aggregation, column), the aggregation being count, sum or mean
+    grouped = partial.groupby(by=keys).sum(numeric_only=True)
+    stats = pd.DataFrame(index=grouped.index)
+    for name, agg, col in columns:
+        if agg == 'count':
+            stats[name] = grouped[f'{col}_count'].astype('int64')
+        elif agg == 'sum':
+            stats[name] = grouped[f'{col}_sum']
+        else:
+            stats[name] = grouped[f'{col}_sum'] / grouped[f'{col}_count']
+    return stats.reset_index()
+
+
+def document_stats(doc_info: pd.DataFrame) -> dict:
+    """
+    Given the doc_info DF of the topic, sentiment and emotion analyses, this function computes all the per subreddit,
+    sentiment and topic stats tables. The documents are grouped once by (sub, sentiment_direction, Topic), keeping the
+    sum and the number of non-null values of every column, and every table is rolled up from that small aggregate.
+    :param doc_info: The doc_info DF (with sub, doc_count, avg_score, sentiment_*, Topic, Name, Probability and the emotion
+    columns).
+    :return: A dict of table name to DF, the same tables (and columns) the data stats notebook computed.
+    """
+    emotions = [e for e in EMOTION_LABELS if e in doc_info.columns]
+    value_cols = ['doc_count', 'avg_score', 'sentiment_score', 'Probability'] + emotions
+    keys = [k for k in _DOCUMENT_KEYS if k in doc_info.columns]
+
+    grouped = doc_info.groupby(by=keys, dropna=False)
+    partial = grouped[value_cols].agg(['sum', 'count'])
+    partial.columns = [f'{col}_{agg}' for col, agg in partial.columns]
+    partial['Topic_count'] = grouped.size()
+    partial['Name_count'] = grouped['Name'].count()
+    partial = partial.reset_index()
+
+    return {
+        'document_count_stats': _rollup(partial, ['sub'], [('consolidated_document_count_total', 'count', 'doc_count'),
+                                                           ('reddit_document_count_total', 'sum', 'doc_count'),
+                                                           ('document_count_avg', 'mean', 'doc_count')]),
+        'sentiment_stats': _rollup(partial, ['sub', 'sentiment_direction'],
+                                   [('sentiment_score_avg', 'mean', 'sentiment_score'),
+                                    ('sentiment_direction_count', 'count', 'sentiment_score')]),
+        'emotion_stats': _rollup(partial, ['sub'], [(f'{e}_avg', 'mean', e) for e in emotions]),
+        'upvote_stats': _rollup(partial, ['sub'], [('upvote_avg', 'mean', 'avg_score')]),
+        'topic_stats': _rollup(partial, ['sub', 'Topic'], [('topic_count', 'count', 'Topic'),
+                                                           ('topic_probability_avg', 'mean', 'Probability')]),
+        'overall_topic_stats': _rollup(partial, ['Topic'], [('overall_topic_count', 'count', 'Name'),
+                                                            ('overall_topic_probability_avg', 'mean', 'Probability')]),
+    }
+
+
+def write_stats(stats: dict, stats_dir='stats'):
+    """
+    Writes the given stats tables together, as <stats_dir>/<table name>.csv.
+    :param stats: A dict of table name to DF.
+    :param stats_dir: The directory of the CSV files.
+    """
+    os.makedirs(stats_dir, exist_ok=True)
+    for name, df in stats.items():
+        df.to_csv(os.path.join(stats_dir, f'{name}.csv'))
+
+
+def corpus_stats_from_frames(submissions_all: pd.DataFrame, comments_all: pd.DataFrame,
+                             subreddits_all: pd.DataFrame) -> dict:
+    """
+    Given the exported submissions, comments and subreddits DFs (with submission_id and subreddit_id columns), this
+    function computes the per keyword and per subreddit post and comment counts with one group-by per table and
+    hash joins, instead of one scan of the comments per keyword or subreddit.
+    :param submissions_all: The submissions DF.
+    :param comments_all: The comments DF.
+    :param subreddits_all: The subreddits DF.
+    :return: A dict of table name to DF.
+    """
+    comment_counts = comments_all.groupby(by=['submission_id']).size().rename('comment_count')
+    submissions = submissions_all[['submission_id', 'keyword', 'subreddit_id']].join(comment_counts, on='submission_id')
+    submissions['comment_count'] = submissions['comment_count'].fillna(0).astype('int64')
+
+    keyword_stats = submissions.groupby(by=['keyword']).agg(
+        keyword_post_count=pd.NamedAgg('submission_id', 'count'),
+        keyword_comment_count=pd.NamedAgg('comment_count', 'sum')).reset_index()
+    keyword_stats = keyword_stats.sort_values(by='keyword_post_count', ascending=False)
+
+    subreddit_stats = submissions.groupby(by=['subreddit_id']).agg(
+        submission_count=pd.NamedAgg('submission_id', 'count')).reset_index()
+    subreddit_stats = subreddit_stats.join(comments_all.groupby(by=['subreddit_id']).size().rename('comment_count'),
+                                           on='subreddit_id')
+    subreddit_stats['comment_count'] = subreddit_stats['comment_count'].fillna(0).astype('int64')
+    subreddit_stats = pd.merge(left=subreddit_stats, right=subreddits_all[['subreddit_id', 'display_name']],
+                               on='subreddit_id').sort_values(by='submission_count', ascending=False)
+
+    keyword_subreddit_stats = submissions.groupby(by=['keyword', 'subreddit_id']).agg(
+        keyword_subreddit_count=pd.NamedAgg('submission_id', 'count')).reset_index()
+
+    return {
+        'keyword_post_and_comment_count': keyword_stats,
+        'subreddit_post_and_comment_count': subreddit_stats,
+        'keyword_subreddit_post_count': keyword_subreddit_stats,
+    }
+
+
+class CorpusStats:
+    """
+    CorpusStats computes the per keyword and per subreddit post and comment counts of the crawled corpus in the DB, so
+    that only the (small) results leave the DB. Every table is a single aggregation query over the submissions and
+    comments tables. A submission counts for the keyword it was registered with, as in the exported CSVs.
+    """
+
+    def __init__(self, generic_db: GenericDBOperations):
+        self.generic_db = generic_db
+
+    def keyword_stats(self) -> pd.DataFrame:
+        q = '''
+        WITH comment_counts AS (
+            SELECT submission, count(*) AS comment_count
+            FROM comments
+            GROUP BY submission
+        )
+        SELECT s.keyword,
+               count(*) AS keyword_post_count,
+               coalesce(sum(cc.comment_count), 0)::BIGINT AS keyword_comment_count
+        FROM submissions s
+        LEFT JOIN comment_counts cc ON cc.submission = s.submission_id
+        GROUP BY s.keyword
+        ORDER BY keyword_post_count DESC;
+        '''
+        return self.generic_db.read_query(q)
+
+    def subreddit_stats(self) -> pd.DataFrame:
+        q = '''
+        WITH submission_counts AS (
+            SELECT subreddit, count(*) AS submission_count
+            FROM submissions
+            GROUP BY subreddit
+        ), comment_counts AS (
+            SELECT subreddit, count(*) AS comment_count
+            FROM comments
+            GROUP BY subreddit
+        )
+        SELECT sc.subreddit AS subreddit_id,
+               sc.submission_count,
+               coalesce(cc.comment_count, 0) AS comment_count,
+               sr.display_name
+        FROM submission_counts sc
+        JOIN subreddits sr ON sr.subreddit_id = sc.subreddit
+        LEFT JOIN comment_counts cc ON cc.subreddit = sc.subreddit
+        ORDER BY sc.submission_count DESC;
+        '''
+        return self.generic_db.read_query(q)
+
+    def keyword_subreddit_stats(self) -> pd.DataFrame:
+        q = '''
+        SELECT keyword, subreddit AS subreddit_id, count(*) AS keyword_subreddit_count
+        FROM submissions
+        GROUP BY keyword, subreddit
+        ORDER BY keyword, subreddit;
+        '''
+        return self.generic_db.read_query(q)
+
+    def compute(self) -> dict:
+        """
+        :return: A dict of table name to DF, with the same tables as corpus_stats_from_frames.
+        """
+        return {
+            'keyword_post_and_comment_count': self.keyword_stats(),
+            'subreddit_post_and_comment_count': self.subreddit_stats(),
+            'keyword_subreddit_post_count': self.keyword_subreddit_stats(),
+        }
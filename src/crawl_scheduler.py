@@ -0,0 +1,294 @@
+import itertools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import prawcore
+
+from crawl_state import CrawlStateStore
+from metrics import METRICS, endpoint_of
+
+
+class TokenBucket:
+    """
+    TokenBucket is a thread-safe token bucket throttling the requests sent on behalf of one Reddit OAuth client. Its refill
+    rate starts at the configured requests per minute and then follows the X-Ratelimit-* headers returned by Reddit, so the
+    remaining budget of the current rate limit window is spread over the time left until the window resets.
+    """
+
+    def __init__(self, requests_per_minute=100, burst=10):
+        self.rate = requests_per_minute / 60
+        self.capacity = burst
+        self.tokens = burst
+        self.blocked_until = 0
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def wait_time(self) -> float:
+        """
+        :return: The number of seconds until a token becomes available (0 if one is available now).
+        """
+        with self.lock:
+            self._refill()
+            now = time.monotonic()
+            if self.blocked_until > now:
+                return self.blocked_until - now
+            if self.tokens >= 1:
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self) -> float:
+        """
+        Blocks until a token is available and takes it.
+        :return: The number of seconds spent waiting.
+        """
+        waited = 0
+        while True:
+            with self.lock:
+                self._refill()
+                now = time.monotonic()
+                if self.blocked_until > now:
+                    delay = self.blocked_until - now
+                elif self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                else:
+                    delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+    def update_from_headers(self, headers):
+        """
+        Given the headers of a Reddit response, this method adjusts the bucket to the remaining budget of the current rate
+        limit window.
+        :param headers: The response headers.
+        """
+        try:
+            remaining = float(headers['x-ratelimit-remaining'])
+            reset = float(headers['x-ratelimit-reset'])
+        except (KeyError, TypeError, ValueError):
+            return
+
+        with self.lock:
+            self._refill()
+            if remaining < 1:
+                # The budget of this window is used up, nothing can be sent until the window resets
+                METRICS.inc('rate_limit_exhausted_total')
+                self.tokens = 0
+                self.blocked_until = time.monotonic() + reset
+            else:
+                self.rate = remaining / max(reset, 1)
+                self.tokens = min(self.tokens, remaining)
+
+
+class InstrumentedRequestor(prawcore.Requestor):
+    """
+    A prawcore requestor timing every request sent to Reddit and counting the requests by endpoint and status code.
+    """
+
+    def request(self, method, url, *args, **kwargs):
+        endpoint = endpoint_of(url)
+        status = 'error'
+        try:
+            with METRICS.timer('reddit_request_seconds', endpoint=endpoint):
+                response = super().request(method, url, *args, **kwargs)
+            status = response.status_code
+            return response
+        finally:
+            METRICS.inc('reddit_requests_total', endpoint=endpoint, status=status)
+
+
+class RateLimitedRequestor(InstrumentedRequestor):
+    """
+    A prawcore requestor that takes a token from the bucket of its client before every request and feeds the rate limit
+    headers of every response back to it.
+    """
+
+    def __init__(self, *args, token_bucket: TokenBucket = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.token_bucket = token_bucket
+
+    def request(self, *args, **kwargs):
+        METRICS.observe('rate_limit_wait_seconds', self.token_bucket.acquire())
+        response = super().request(*args, **kwargs)
+        self.token_bucket.update_from_headers(response.headers)
+        return response
+
+
+class RedditClient:
+    """
+    RedditClient holds the token bucket of one configured OAuth app and hands out one praw.Reddit instance per worker thread
+    (praw instances are not thread-safe), all of which share the bucket.
+    """
+
+    def __init__(self, reddit_lookup, env_prefix='', requests_per_minute=100, burst=10):
+        self.reddit_lookup = reddit_lookup
+        self.env_prefix = env_prefix
+        self.token_bucket = TokenBucket(requests_per_minute=requests_per_minute, burst=burst)
+        self._local = threading.local()
+
+    def get_reddit(self):
+        reddit = getattr(self._local, 'reddit', None)
+        if reddit is None:
+            reddit = self.reddit_lookup.create_reddit(env_prefix=self.env_prefix,
+                                                      requestor_class=RateLimitedRequestor,
+                                                      requestor_kwargs={'token_bucket': self.token_bucket})
+            self._local.reddit = reddit
+        return reddit
+
+
+class CrawlScheduler:
+    """
+    CrawlScheduler runs the search jobs (one per planned search of every subreddit, see SearchPlanner, and one per search a
+    truncated listing is split into) and the per-submission comment expansion jobs of a crawl on a bounded worker pool.
+    Every job is assigned to the configured Reddit client whose token bucket has a token available the soonest, so the
+    request budgets of all the clients are used in parallel.
+    """
+
+    def __init__(self, reddit_lookup, crawler_config: dict):
+        self.reddit_lookup = reddit_lookup
+        self.max_workers = crawler_config.get('max_workers', 8)
+        clients_config = crawler_config.get('clients') or [{}]
+        self.clients = [RedditClient(reddit_lookup=reddit_lookup,
+                                     env_prefix=c.get('env_prefix', ''),
+                                     requests_per_minute=c.get('requests_per_minute', 100),
+                                     burst=c.get('burst', 10))
+                        for c in clients_config]
+        self._client_cycle = itertools.cycle(self.clients)
+        self._client_lock = threading.Lock()
+        self._futures = []
+        self._futures_lock = threading.Lock()
+        self._executor = None
+        self._run_id = None
+        self._planner = None
+        # (subreddit, planned search query) -> number of jobs left before the keywords of the search are done
+        self._pending_jobs = {}
+        # (subreddit, planned search query) -> lock of the results seen by the search jobs split from the planned search
+        self._seen_locks = {}
+        self._pending_lock = threading.Lock()
+
+    def _pick_client(self) -> RedditClient:
+        with self._client_lock:
+            # Ties (e.g. all buckets full) are broken round-robin
+            candidates = [next(self._client_cycle) for _ in range(len(self.clients))]
+        return min(candidates, key=lambda c: c.token_bucket.wait_time())
+
+    def _submit(self, fn, *args):
+        future = self._executor.submit(fn, *args)
+        with self._futures_lock:
+            self._futures.append(future)
+        return future
+
+    def _release_search(self, subreddit_name: str, root_search):
+        # The search jobs and the comment jobs of a planned search hold one count each, the last one to finish marks the
+        # keywords of the search as done
+        key = (subreddit_name, root_search.query)
+        with self._pending_lock:
+            self._pending_jobs[key] -= 1
+            search_done = self._pending_jobs[key] == 0
+            if search_done:
+                del self._seen_locks[key]
+        if search_done:
+            # Queued after all the writes of the search, see BackgroundWriter
+            self.reddit_lookup.write(self.reddit_lookup.crawl_state.mark_step, subreddit=subreddit_name,
+                                     keywords=root_search.keywords, run_id=self._run_id,
+                                     step=CrawlStateStore.STEP_DONE, group=key)
+
+    def _hold_search(self, subreddit_name: str, root_search, count: int):
+        with self._pending_lock:
+            key = (subreddit_name, root_search.query)
+            if key not in self._pending_jobs:
+                self._seen_locks[key] = threading.Lock()
+            self._pending_jobs[key] = self._pending_jobs.get(key, 0) + count
+
+    def _seen_lock(self, subreddit_name: str, root_search) -> threading.Lock:
+        with self._pending_lock:
+            return self._seen_locks[(subreddit_name, root_search.query)]
+
+    def _search_job(self, subreddit_name: str, search, root_search, seen: dict):
+        reddit = self._pick_client().get_reddit()
+        subreddit_instance = reddit.subreddit(subreddit_name)
+        print('Searching for:', search.query, f'(sort={search.sort}) in', subreddit_name)
+
+        search_results = self.reddit_lookup.iter_search_results(
+            query=search.query,
+            subreddit_instance=subreddit_instance,
+            time_filter=self.reddit_lookup.crawler_config.get('time_filter', 'year'),
+            sort=search.sort)
+        subreddit_id = self.reddit_lookup.get_subreddit_id(subreddit_instance)
+        batch_size = self.reddit_lookup.crawler_config.get('submission_batch_size', 100)
+        result_count = 0
+        # The jobs of the searches split from the same planned search run concurrently on the same seen results
+        seen_lock = self._seen_lock(subreddit_name, root_search)
+
+        for fetched_submissions in self.reddit_lookup.iter_batches(search_results, batch_size):
+            result_count += len(fetched_submissions)
+            registered = self.reddit_lookup.register_search_batch(
+                fetched_submissions=fetched_submissions, search=search, planner=self._planner, seen=seen,
+                seen_lock=seen_lock,
+                subreddit_name=subreddit_name, subreddit_id=subreddit_id, reddit=reddit, run_id=self._run_id,
+                group=(subreddit_name, root_search.query))
+
+            # Comments are registered after their submissions, each comment tree is expanded by its own job
+            to_expand = self.reddit_lookup.select_submissions_to_expand(registered)
+            self._hold_search(subreddit_name, root_search, len(to_expand))
+            for fs in to_expand:
+                self._submit(self._comments_job, fs.id, fs.num_comments, subreddit_id, subreddit_name, root_search)
+
+        # A truncated listing is split into searches of their own, sharing the results seen so far
+        splits = self.reddit_lookup.split_truncated_search(search=search, planner=self._planner,
+                                                           result_count=result_count, subreddit_name=subreddit_name)
+        self._hold_search(subreddit_name, root_search, len(splits))
+        for split_search in splits:
+            self._submit(self._search_job, subreddit_name, split_search, root_search, seen)
+
+        self._release_search(subreddit_name, root_search)
+
+    def _comments_job(self, submission_id: str, num_comments: int, subreddit_id: str, subreddit_name: str,
+                      root_search):
+        # The submission is re-created on this thread's praw instance, the comment tree fetch it triggers is needed anyway
+        reddit = self._pick_client().get_reddit()
+        comments = self.reddit_lookup.fetch_submission_comments(reddit=reddit, submission_id=submission_id)
+        self.reddit_lookup.register_submission_comments(submission_id=f't3_{submission_id}',
+                                                        num_comments=num_comments,
+                                                        comments=comments,
+                                                        subreddit_id=subreddit_id,
+                                                        group=(subreddit_name, root_search.query))
+        self._release_search(subreddit_name, root_search)
+
+    def run(self, run_id: int, done_pairs: set) -> bool:
+        """
+        Runs the crawl.
+        :param run_id: The id of the crawl run.
+        :param done_pairs: The (subreddit, keyword) pairs already completed by the run, which are skipped.
+        :return: Whether or not all the jobs succeeded.
+        """
+        self._run_id = run_id
+        self._planner = self.reddit_lookup.create_search_planner()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            self._executor = executor
+            for i, r in self.reddit_lookup.all_subs.iterrows():
+                keywords = [k for k in self.reddit_lookup.search_keywords if (r['display_name'], k) not in done_pairs]
+                for root_search in self._planner.plan(keywords):
+                    self._hold_search(r['display_name'], root_search, 1)
+                    self._submit(self._search_job, r['display_name'], root_search, root_search, {})
+
+            # Jobs keep submitting comment jobs, so wait until no job is pending anymore
+            while True:
+                with self._futures_lock:
+                    pending = [f for f in self._futures if not f.done()]
+                if not pending:
+                    break
+                wait(pending)
+
+        failed = [f for f in self._futures if f.exception() is not None]
+        for f in failed:
+            print('ERROR: Crawl job failed')
+            print(f.exception())
+        print(f'Crawl finished: {len(self._futures)} jobs, {len(failed)} failed')
+        return not failed
@@ -0,0 +1,139 @@
+from generic_db import GenericDBOperations
+
+
+class CrawlStateStore:
+    """
+    CrawlStateStore persists the progress of crawls, so that an interrupted crawl resumes where it stopped and a scheduled
+    crawl only expands the comment trees that are new or have grown since they were last expanded.
+    - crawl_runs: one row per crawl run, a run without finished_at is resumed by the next crawl.
+    - crawl_state: per (subreddit, keyword), the last completed step, the run it belongs to and the newest created_utc seen
+      (recorded for reporting only, see mark_step).
+    - submission_snapshots: per submission, the num_comments it had when its comment tree was last expanded.
+    """
+
+    STEP_SUBMISSIONS = 'submissions'
+    STEP_DONE = 'done'
+
+    def __init__(self, generic_db: GenericDBOperations):
+        self.generic_db = generic_db
+        self._ensure_tables()
+
+    def _ensure_tables(self):
+        q = '''
+        CREATE TABLE IF NOT EXISTS crawl_runs (
+            run_id SERIAL PRIMARY KEY,
+            started_at TIMESTAMP NOT NULL DEFAULT now(),
+            finished_at TIMESTAMP
+        );
+        CREATE TABLE IF NOT EXISTS crawl_state (
+            subreddit TEXT NOT NULL,
+            keyword TEXT NOT NULL,
+            run_id INTEGER NOT NULL REFERENCES crawl_runs (run_id),
+            last_step TEXT NOT NULL,
+            last_created_utc DOUBLE PRECISION,
+            updated_at TIMESTAMP NOT NULL DEFAULT now(),
+            PRIMARY KEY (subreddit, keyword)
+        );
+        CREATE TABLE IF NOT EXISTS submission_snapshots (
+            submission_id TEXT PRIMARY KEY,
+            num_comments INTEGER,
+            expanded_at TIMESTAMP NOT NULL DEFAULT now()
+        );
+        '''
+        self.generic_db.execute_query(q)
+
+    def start_run(self, resume=True) -> int:
+        """
+        Starts a crawl run, or resumes the last one if it did not finish.
+        :param resume: Whether or not to resume the last unfinished run.
+        :return: The id of the run.
+        """
+        if resume:
+            q = 'SELECT run_id FROM crawl_runs WHERE finished_at IS NULL ORDER BY run_id DESC LIMIT 1;'
+            rows = self.generic_db.execute_query(q, fetch_one=True)
+            if not self.generic_db.check_db_result_sanity(rows):
+                print('Resuming crawl run', rows[0][0])
+                return rows[0][0]
+
+        q = 'INSERT INTO crawl_runs DEFAULT VALUES RETURNING run_id;'
+        rows = self.generic_db.execute_query(q, fetch_one=True)
+        print('Starting crawl run', rows[0][0])
+        return rows[0][0]
+
+    def finish_run(self, run_id: int):
+        q = 'UPDATE crawl_runs SET finished_at = now() WHERE run_id = %s;'
+        self.generic_db.execute_query(q, params=(run_id,))
+
+    def get_done_pairs(self, run_id: int) -> set:
+        """
+        :param run_id: The id of the run.
+        :return: A set of the (subreddit, keyword) pairs already completed by the given run.
+        """
+        q = 'SELECT subreddit, keyword FROM crawl_state WHERE run_id = %s AND last_step = %s;'
+        rows = self.generic_db.execute_query(q, fetch_all=True, params=(run_id, self.STEP_DONE))
+        if self.generic_db.check_db_result_sanity(rows):
+            return set()
+        return {(r[0], r[1]) for r in rows}
+
+    def mark_step(self, subreddit: str, keywords: list, run_id: int, step: str, last_created_utc=None):
+        """
+        Records the last completed step of (subreddit, keyword) pairs, e.g. of all the keywords covered by a search.
+        :param subreddit: The display name of the subreddit.
+        :param keywords: The keywords.
+        :param run_id: The id of the run.
+        :param step: The completed step.
+        :param last_created_utc: The newest created_utc of the submissions seen by the step, if any.
+
+        last_created_utc is not read back by the crawler: the search listings, sort=new included, are intentionally
+        re-read in full on every run. It is the newest submission seen by any search of the keyword, which does not
+        imply that the older ones were all seen when a relevance listing was truncated. The older submissions also
+        carry the grown comment trees to expand again (see filter_submissions_to_expand) and the updated scores.
+        """
+        if not keywords:
+            return
+        # The rows are upserted in key order, searches running concurrently in a subreddit can cover the same keywords
+        q = '''
+        INSERT INTO crawl_state (subreddit, keyword, run_id, last_step, last_created_utc)
+        SELECT %s, keyword, %s, %s, %s
+        FROM unnest(%s::text[]) AS k (keyword)
+        ORDER BY keyword
+        ON CONFLICT (subreddit, keyword) DO UPDATE
+        SET run_id = EXCLUDED.run_id,
+            last_step = EXCLUDED.last_step,
+            last_created_utc = GREATEST(crawl_state.last_created_utc, EXCLUDED.last_created_utc),
+            updated_at = now();
+        '''
+        self.generic_db.execute_query(q, params=(subreddit, run_id, step, last_created_utc, list(keywords)))
+
+    def filter_submissions_to_expand(self, submissions: list) -> list:
+        """
+        Given a list of (submission_id, num_comments) pairs, this method keeps the submissions whose comment tree was never
+        expanded or has grown since it was last expanded.
+        :param submissions: A list of (submission_id, num_comments) pairs.
+        :return: The pairs to expand.
+        """
+        if not submissions:
+            return []
+        q = 'SELECT submission_id, num_comments FROM submission_snapshots WHERE submission_id = ANY(%s);'
+        rows = self.generic_db.execute_query(q, fetch_all=True, params=([s[0] for s in submissions],))
+        snapshots = {} if self.generic_db.check_db_result_sanity(rows) else dict(rows)
+        return [s for s in submissions
+                if s[0] not in snapshots or s[1] is None or snapshots[s[0]] is None or s[1] > snapshots[s[0]]]
+
+    def record_expansions(self, submissions: list):
+        """
+        Records the num_comments of the given submissions as of their comment tree expansion.
+        :param submissions: A list of (submission_id, num_comments) pairs.
+        """
+        if not submissions:
+            return
+        # A submission can only be upserted once per statement
+        submissions = list(dict(submissions).items())
+        q = '''
+        INSERT INTO submission_snapshots (submission_id, num_comments)
+        SELECT * FROM unnest(%s::text[], %s::integer[])
+        ON CONFLICT (submission_id) DO UPDATE
+        SET num_comments = EXCLUDED.num_comments,
+            expanded_at = now();
+        '''
+        self.generic_db.execute_query(q, params=([s[0] for s in submissions], [s[1] for s in submissions]))
@@ -0,0 +1,117 @@
+import itertools
+import queue
+import threading
+import time
+
+from metrics import METRICS
+
+
+class BackgroundWriter:
+    """
+    BackgroundWriter runs the database writes of a crawl on background threads, so the crawler keeps fetching from Reddit
+    while the previous batches are written instead of waiting for every transaction.
+    - The writes are callables queued by submit() into bounded queues: when the writers fall behind, submit() blocks until
+      a slot is free, which bounds the memory held by the queued DataFrames (backpressure).
+    - Every write belongs to a group (e.g. a planned search of a subreddit), the writes of a group always go to the same
+      writer thread and run in the order they were submitted: redditors before submissions before comments, and the step
+      marks of the crawl state after the rows they record. Writes without a group go to the first writer.
+    - A failed write is logged and marks its group as failed, the remaining writes of the group are skipped so it is never
+      marked as done and the next run crawls it again. The writes of the other groups go on.
+    - close() (or leaving the with block, also when the crawl raises) drains the queues before returning, so no queued
+      write is lost.
+    """
+
+    _STOP = object()
+
+    def __init__(self, num_threads=1, queue_size=16):
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in range(max(num_threads, 1))]
+        self.threads = []
+        self.failed_groups = set()
+        self.errors = []
+        self._lock = threading.Lock()
+        self._round_robin = itertools.count()
+
+    def start(self):
+        self.threads = [threading.Thread(target=self._run, args=(q,), name=f'db-writer_{i}', daemon=True)
+                        for i, q in enumerate(self.queues)]
+        for thread in self.threads:
+            thread.start()
+
+    def _queue_of(self, group) -> queue.Queue:
+        if group is None:
+            return self.queues[0]
+        return self.queues[hash(group) % len(self.queues)]
+
+    def submit(self, fn, *args, group=None, **kwargs):
+        """
+        Queues a write, blocking while the queue of its writer is full.
+        :param fn: The function doing the write.
+        :param args: The positional arguments of fn.
+        :param group: The group of the write, writes of the same group run in order.
+        :param kwargs: The keyword arguments of fn.
+        """
+        if not self.threads:
+            raise RuntimeError('The background writer is not running')
+        start = time.perf_counter()
+        self._queue_of(group).put((fn, args, kwargs, group))
+        METRICS.observe('db_writer_backpressure_seconds', time.perf_counter() - start)
+
+    def failed(self, group) -> bool:
+        """
+        :param group: A group of writes.
+        :return: Whether or not a write of the group failed.
+        """
+        with self._lock:
+            return group in self.failed_groups
+
+    def _run(self, tasks: queue.Queue):
+        while True:
+            task = tasks.get()
+            try:
+                if task is self._STOP:
+                    return
+                fn, args, kwargs, group = task
+                if group is not None and self.failed(group):
+                    METRICS.inc('db_writer_tasks_skipped_total')
+                    continue
+                try:
+                    with METRICS.timer('db_writer_task_seconds', task=fn.__name__):
+                        fn(*args, **kwargs)
+                except Exception as e:
+                    METRICS.inc('db_writer_errors_total', task=fn.__name__)
+                    print(f'ERROR: Background write {fn.__name__} failed for {group}')
+                    print(e)
+                    with self._lock:
+                        self.errors.append(e)
+                        if group is not None:
+                            self.failed_groups.add(group)
+            finally:
+                tasks.task_done()
+
+    def flush(self):
+        """
+        Blocks until all the writes queued so far are done.
+        """
+        for tasks in self.queues:
+            tasks.join()
+
+    def close(self) -> bool:
+        """
+        Drains the queues and stops the writer threads.
+        :return: Whether or not all the writes succeeded.
+        """
+        for tasks in self.queues[:len(self.threads)]:
+            tasks.put(self._STOP)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        if self.errors:
+            print(f'ERROR: {len(self.errors)} background writes failed, groups not completed: {len(self.failed_groups)}')
+        return not self.errors
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
@@ -0,0 +1,131 @@
+from collections import namedtuple
+
+import numpy as np
+
+from comment_forest import CommentForest
+
+# The budget the topic model documents were built with, in whitespace separated words
+WORD_BUDGET = 384
+
+# A packed document: its text, the subreddit of its thread, the summed score and the number of comments/submissions in it
+PackedDocument = namedtuple('PackedDocument', ['document', 'subreddit', 'score', 'doc_count'])
+
+
+class _DocumentBuffer:
+    """
+    The document being packed, with running counts so that nothing is re-split or re-concatenated while it grows.
+    """
+
+    def __init__(self):
+        self.parts = []
+        self.leading_space = False
+        self.units = 0
+        self.score = 0
+        self.doc_count = 0
+
+    def append(self, text: str, score, units: int):
+        # Appending to the notebook's concat_docs string always added a separating space, even to an empty one
+        if not self.doc_count:
+            self.leading_space = True
+        self.parts.append(text)
+        self.units += units
+        self.score += score
+        self.doc_count += 1
+
+    def restart(self, text: str, score, units: int):
+        self.parts = [text]
+        self.leading_space = False
+        self.units = units
+        self.score = score
+        self.doc_count = 1
+
+    def flush(self, subreddit) -> PackedDocument:
+        document = (' ' if self.leading_space else '') + ' '.join(self.parts)
+        packed = PackedDocument(document=document, subreddit=subreddit, score=self.score, doc_count=self.doc_count)
+        self.__init__()
+        return packed
+
+
+class DocumentPacker:
+    """
+    DocumentPacker packs the breadth-first ordered comments of each thread into documents within a budget, the way the
+    topic modelling notebook always did: a comment is appended to the current document while the document stays within
+    the budget, otherwise the document is emitted and a new one starts with the comment, and a comment reaching the budget
+    on its own is emitted alone. Documents never span two threads.
+    The budget is counted in whitespace separated words by default (reproducing the notebook exactly), or in tokens of
+    the given tokenizer (e.g. the tokenizer of the embedding model). Token counts are summed per comment, so they can
+    differ by a token or two from the count of the joined document.
+    """
+
+    def __init__(self, budget=WORD_BUDGET, tokenizer=None, batch_size=1024):
+        self.budget = budget
+        self.tokenizer = tokenizer
+        self.batch_size = batch_size
+
+    def count_units(self, texts: list) -> list:
+        """
+        Given some texts, this method counts their budget units in one batch.
+        :param texts: The texts.
+        :return: A list of the number of words (or tokens) of each text.
+        """
+        if self.tokenizer is None:
+            return [len(text.split()) for text in texts]
+        encoded = self.tokenizer(texts, add_special_tokens=False, return_attention_mask=False,
+                                 return_token_type_ids=False)
+        return [len(ids) for ids in encoded['input_ids']]
+
+    def _with_units(self, nodes):
+        batch = []
+        for node in nodes:
+            batch.append(node)
+            if len(batch) == self.batch_size:
+                yield from zip(batch, self.count_units([n[2] for n in batch]))
+                batch = []
+        if batch:
+            yield from zip(batch, self.count_units([n[2] for n in batch]))
+
+    def pack(self, nodes):
+        """
+        Given the nodes of some threads, this method lazily packs them into documents.
+        :param nodes: An iterable of (thread, subreddit, text, score) tuples, thread after thread, each thread in
+        breadth-first order. thread is any key identifying the thread (e.g. the index of its root).
+        :return: A generator of PackedDocument records.
+        """
+        buffer = _DocumentBuffer()
+        current_thread, current_subreddit = None, None
+        started = False
+        for (thread, subreddit, text, score), units in self._with_units(nodes):
+            if not started or thread != current_thread:
+                if buffer.doc_count:
+                    yield buffer.flush(current_subreddit)
+                current_thread, current_subreddit = thread, subreddit
+                started = True
+
+            if units >= self.budget:
+                if buffer.doc_count:
+                    yield buffer.flush(current_subreddit)
+                yield PackedDocument(document=text, subreddit=current_subreddit, score=score, doc_count=1)
+            elif buffer.units + units <= self.budget:
+                buffer.append(text, score, units)
+            else:
+                yield buffer.flush(current_subreddit)
+                buffer.restart(text, score, units)
+
+        if buffer.doc_count:
+            yield buffer.flush(current_subreddit)
+
+    def pack_forest(self, forest: CommentForest, node_texts: list, node_scores: list, root_subs: list):
+        """
+        Given a comment forest and the texts and scores of its nodes, this method lazily packs every thread of the forest
+        into documents, the thread of each submission in breadth-first order.
+        :param forest: The CommentForest.
+        :param node_texts: The (cleaned) text of each node of the forest.
+        :param node_scores: The score of each node of the forest.
+        :param root_subs: The subreddit of each root of the forest.
+        :return: A generator of PackedDocument records.
+        """
+        order, offsets = forest.bfs_order_all()
+        roots = np.repeat(np.arange(forest.n_roots), np.diff(offsets))
+        nodes = ((root, root_subs[root], node_texts[node], node_scores[node])
+                 for root, node in zip(roots.tolist(), order.tolist()))
+        return self.pack(nodes)
@@ -0,0 +1,122 @@
+import json
+import os
+
+import numpy as np
+
+from near_duplicates import NearDuplicateIndex
+from sentiment_scoring import content_hash
+
+# The sentence-transformer BERTopic embeds documents with by default
+EMBEDDING_MODEL = 'all-MiniLM-L6-v2'
+
+
+class EmbeddingStore:
+    """
+    EmbeddingStore keeps the embeddings of documents on disk, keyed by the content hash of the document, so that topic
+    model runs only embed the documents they have never seen. There is one directory per embedding model:
+    - meta.json: the model name, the embedding dimension and the storage dtype (float32, or float16 to halve the size).
+    - embeddings.bin: the embedding matrix, one row per document, read through a memory map.
+    - hashes.txt: the content hash of each row, one per line.
+    Rows are only ever appended (the matrix first, then the hashes), so a run interrupted while appending loses at most
+    the rows it was appending.
+    """
+
+    def __init__(self, root_dir: str, model_name=EMBEDDING_MODEL, dtype='float32'):
+        self.model_name = model_name
+        self.path = os.path.join(root_dir, model_name.replace('/', '__'))
+        self.dtype = np.dtype(dtype)
+        self.dim = None
+        self._index = {}
+        self._matrix = None
+        os.makedirs(self.path, exist_ok=True)
+        self._load()
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def _load(self):
+        if not os.path.exists(self._file('meta.json')):
+            return
+        with open(self._file('meta.json')) as meta_stream:
+            meta = json.load(meta_stream)
+        self.dim = meta['dim']
+        self.dtype = np.dtype(meta['dtype'])
+
+        hashes = []
+        if os.path.exists(self._file('hashes.txt')):
+            with open(self._file('hashes.txt')) as hashes_stream:
+                hashes = hashes_stream.read().split()
+        matrix_size = os.path.getsize(self._file('embeddings.bin')) if os.path.exists(self._file('embeddings.bin')) else 0
+        row_size = self.dim * self.dtype.itemsize
+        rows = min(len(hashes), matrix_size // row_size)
+        if rows < len(hashes) or rows * row_size < matrix_size:
+            # An interrupted append, drop its partial rows so that the next appends stay aligned
+            hashes = hashes[:rows]
+            os.truncate(self._file('embeddings.bin'), rows * row_size)
+            with open(self._file('hashes.txt'), 'w') as hashes_stream:
+                hashes_stream.write(''.join(f'{h}\n' for h in hashes))
+        self._index = {h: i for i, h in enumerate(hashes)}
+        self._matrix = None
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def _get_matrix(self) -> np.ndarray:
+        if self._matrix is None:
+            self._matrix = np.memmap(self._file('embeddings.bin'), dtype=self.dtype, mode='r', shape=(len(self), self.dim))
+        return self._matrix
+
+    def _append(self, hashes: list, embeddings: np.ndarray):
+        if self.dim is None:
+            self.dim = embeddings.shape[1]
+            with open(self._file('meta.json'), 'w') as meta_stream:
+                json.dump({'model': self.model_name, 'dim': self.dim, 'dtype': self.dtype.name}, meta_stream)
+        with open(self._file('embeddings.bin'), 'ab') as embeddings_stream:
+            embeddings_stream.write(np.ascontiguousarray(embeddings, dtype=self.dtype).tobytes())
+        with open(self._file('hashes.txt'), 'a') as hashes_stream:
+            hashes_stream.write(''.join(f'{h}\n' for h in hashes))
+        for h in hashes:
+            self._index[h] = len(self._index)
+        # The memory map is reopened with the new shape on the next read
+        self._matrix = None
+
+    def get_or_compute(self, documents: list, embed_fn=None, chunk_size=10000,
+                       near_duplicates: NearDuplicateIndex = None) -> np.ndarray:
+        """
+        Given some documents, this method embeds the ones not stored yet (chunk by chunk, each chunk being stored as soon
+        as it is embedded) and returns the embeddings of all of them, e.g. for BERTopic.fit_transform(documents,
+        embeddings=...).
+        :param documents: The documents.
+        :param embed_fn: A function embedding a list of documents into a 2D array, e.g. SentenceTransformer(...).encode.
+        Defaults to a SentenceTransformer of the model of the store.
+        :param chunk_size: The number of documents embedded and stored at a time.
+        :param near_duplicates: A NearDuplicateIndex, to only embed the canonical document of each cluster of
+        near-duplicates and give its embedding to all the documents of the cluster.
+        :return: A float32 array with one row per document, in the given order.
+        """
+        if near_duplicates is not None:
+            deduplication = near_duplicates.deduplicate(documents)
+            print(f'{len(documents)} documents, {len(deduplication.documents)} after removing near-duplicates')
+            embeddings = self.get_or_compute(deduplication.documents, embed_fn=embed_fn, chunk_size=chunk_size)
+            return deduplication.expand(embeddings)
+
+        hashes = [content_hash(d) for d in documents]
+        missing = {}
+        for h, d in zip(hashes, documents):
+            if h not in self._index and h not in missing:
+                missing[h] = d
+        print(f'{len(documents)} documents, {len(missing)} embeddings to compute')
+
+        if missing:
+            if embed_fn is None:
+                from sentence_transformers import SentenceTransformer
+                embed_fn = SentenceTransformer(self.model_name).encode
+            missing_hashes = list(missing.keys())
+            for start in range(0, len(missing_hashes), chunk_size):
+                chunk = missing_hashes[start: start + chunk_size]
+                self._append(chunk, np.asarray(embed_fn([missing[h] for h in chunk])))
+
+        if not documents:
+            return np.empty((0, self.dim or 0), dtype=np.float32)
+        rows = np.fromiter((self._index[h] for h in hashes), dtype=np.int64, count=len(hashes))
+        return np.asarray(self._get_matrix()[rows], dtype=np.float32)
@@ -1,21 +1,66 @@
+import itertools
+import threading
+from contextlib import contextmanager
 from typing import Optional
 
+import numpy as np
 import yaml
 import psycopg2 as pg
+import psycopg2.extras
+import psycopg2.pool
 import pandas as pd
-import re
+
+from metrics import METRICS, statement_of
+from text_normalizer import squeeze_spaces
 
 pd.set_option('display.expand_frame_repr', False)
 
+# The pool section used when the db config has none: stream_query outside of a transaction needs a second connection
+DEFAULT_POOL_CONFIG = {'min_size': 1, 'max_size': 2, 'acquire_timeout': 60}
+
+# dtype hints of the columns the analysis queries usually read, for stream_query and read_query
+ANALYSIS_DTYPES = {
+    'subreddit': 'category',
+    'subreddit_name': 'category',
+    'display_name': 'category',
+    'keyword': 'category',
+    'score': 'Int32',
+    'num_comments': 'Int32',
+    'created_at': 'datetime64[ns]',
+}
+
+# pyarrow type aliases of the Postgres types (by type OID) of the columns streamed as arrow, other types are inferred
+ARROW_TYPES = {
+    16: 'bool',
+    20: 'int64',
+    21: 'int16',
+    23: 'int32',
+    25: 'string',
+    700: 'float32',
+    701: 'float64',
+    1042: 'string',
+    1043: 'string',
+    1082: 'date32',
+    1114: 'timestamp[us]',
+}
+
 
 class GenericDBOperations:
     """
     GenericDBOperations is responsible for generic DB operations that are used by various categories of endpoint db operations.
+    Connections are taken from a thread-safe pool (sized by the optional `pool` section of the db config), so one instance
+    can be shared by multiple threads. A thread waits at most acquire_timeout seconds for a free connection, then raises
+    instead of hanging on an exhausted pool.
     """
 
     def __init__(self, path=None):
         self.db_config = None
-        self.connection = None
+        self.connection_pool = None
+        self._pool_lock = threading.Lock()
+        self._pool_slots = None
+        self._acquire_timeout = None
+        self._local = threading.local()
+        self._cursor_names = itertools.count()
 
         self._init_db_config(path=path)
 
@@ -27,16 +72,87 @@ class GenericDBOperations:
 
     def _connect_to_db(self):
         db_credentials = self.db_config['credentials']
-        if self.connection is None or self.connection.closed:
+        pool_config = {**DEFAULT_POOL_CONFIG, **(self.db_config.get('pool') or {})}
+        min_size = pool_config['min_size']
+        max_size = pool_config['max_size']
+        with self._pool_lock:
+            if self.connection_pool is None or self.connection_pool.closed:
+                try:
+                    self.connection_pool = pg.pool.ThreadedConnectionPool(min_size, max_size, **db_credentials)
+                except Exception as e:
+                    print('Connection to database not successful. Halting...')
+                    raise e
+                # The pool raises instead of blocking when exhausted, so threads wait on the semaphore for a free slot
+                self._pool_slots = threading.BoundedSemaphore(max_size)
+                self._acquire_timeout = pool_config['acquire_timeout']
+
+    def _close_connection(self):
+        if self.connection_pool is not None and not self.connection_pool.closed:
+            self.connection_pool.closeall()
+
+    def _acquire_connection(self):
+        if self.connection_pool is None or self.connection_pool.closed:
+            self._connect_to_db()
+        if not self._pool_slots.acquire(timeout=self._acquire_timeout):
+            raise RuntimeError(f'No free database connection after {self._acquire_timeout}s, all the connections of the '
+                               f'pool are in use (raise pool.max_size of the db config)')
+        try:
+            return self.connection_pool.getconn()
+        except Exception as e:
+            self._pool_slots.release()
+            raise e
+
+    def _release_connection(self, connection):
+        # Broken connections are discarded, healthy ones go back to the pool
+        try:
+            self.connection_pool.putconn(connection, close=bool(connection.closed))
+        finally:
+            self._pool_slots.release()
+
+    @contextmanager
+    def transaction(self):
+        """
+        A context manager scoping a transaction. All the statements executed through the yielded cursor (and through the
+        other methods of this class called by the same thread inside the scope) are committed together when the scope
+        exits, or rolled back if it raises. Nested scopes become savepoints of the enclosing transaction, so a failure inside
+        a nested scope only rolls back the nested statements.
+        :return: A cursor bound to the transaction.
+        """
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            self._local.depth += 1
+            savepoint = f'sp_{self._local.depth}'
+            cur = connection.cursor()
             try:
-                self.connection = pg.connect(**db_credentials)
+                cur.execute(f'SAVEPOINT {savepoint};')
+                yield cur
+                cur.execute(f'RELEASE SAVEPOINT {savepoint};')
             except Exception as e:
-                print('Connection to database not successful. Halting...')
+                if not connection.closed:
+                    cur.execute(f'ROLLBACK TO SAVEPOINT {savepoint};')
                 raise e
+            finally:
+                cur.close()
+                self._local.depth -= 1
+            return
 
-    def _close_connection(self):
-        if self.connection is not None and not self.connection.closed:
-            self.connection.close()
+        connection = self._acquire_connection()
+        self._local.connection = connection
+        self._local.depth = 0
+        try:
+            cur = connection.cursor()
+            try:
+                yield cur
+            finally:
+                cur.close()
+            connection.commit()
+        except Exception as e:
+            if not connection.closed:
+                connection.rollback()
+            raise e
+        finally:
+            self._local.connection = None
+            self._release_connection(connection)
 
     @staticmethod
     def check_db_result_sanity(db_res: list) -> bool:
@@ -69,20 +185,17 @@ class GenericDBOperations:
         FROM {table_name}
         LIMIT 0;
         """
-        if self.connection is None or self.connection.closed:
-            self._connect_to_db()
         try:
-            cur = self.connection.cursor()
-            cur.execute(query)
-            columns = [desc[0] for desc in cur.description]
-            cur.close()
+            with self.transaction() as cur:
+                cur.execute(query)
+                columns = [desc[0] for desc in cur.description]
         except Exception as e:
             print('Query execution error:\n{}\n'.format(query))
             raise e
 
         return columns
 
-    def execute_query(self, query: str, fetch_one=False, fetch_all=False, row_count=False):
+    def execute_query(self, query: str, fetch_one=False, fetch_all=False, row_count=False, params=None):
         """
         Provided with a raw SQL query, whether to fetch one or all rows of the result of query execution and whether to fetch
         the number of affected rows of the query execution, this method facilitates the execution of a raw query.
@@ -90,32 +203,28 @@ class GenericDBOperations:
         :param fetch_one: Whether or not to fetch the last result of query execution
         :param fetch_all: Whether or not to fetch all of the query execution results
         :param row_count: Whether or not to fetch the number of affected rows
+        :param params: Optional parameters of the query (psycopg2 style placeholders, e.g. %s or %(name)s)
         :return: A two-tuple (if asked for affected rows) of the result of query and affected rows, or simply the result of the
         query (if not asked for affected rows)
         """
         rows = None
         affected_rows = 0
-        if self.connection is None or self.connection.closed:
-            self._connect_to_db()
         try:
-            cur = self.connection.cursor()
-            cur.execute(query)
-
-            affected_rows = cur.rowcount
+            with self.transaction() as cur, METRICS.timer('db_query_seconds', statement=statement_of(query)):
+                cur.execute(query, params)
 
-            if cur.rowcount == 0:
-                rows = None
-            elif fetch_one:
-                rows = [cur.fetchone()]
-            elif fetch_all:
-                rows = cur.fetchall()
+                affected_rows = cur.rowcount
 
-            cur.close()
-            self.connection.commit()
+                if cur.rowcount == 0:
+                    rows = None
+                elif fetch_one:
+                    rows = [cur.fetchone()]
+                elif fetch_all:
+                    rows = cur.fetchall()
         except Exception as e:
+            METRICS.inc('db_query_errors_total', statement=statement_of(query))
             print('Query execution error:\n{}\n'.format(query))
             print(e)
-            self._close_connection()
             raise e
 
         if row_count:
@@ -123,6 +232,117 @@ class GenericDBOperations:
         else:
             return rows
 
+    @staticmethod
+    def _apply_dtypes(df: pd.DataFrame, dtypes: dict) -> pd.DataFrame:
+        for col, dtype in dtypes.items():
+            if col in df.columns:
+                df[col] = df[col].astype(dtype)
+        return df
+
+    def stream_query(self, query: str, params=None, chunk_size=10000, dtypes: Optional[dict] = None, as_arrow=False):
+        """
+        Provided with a raw SQL SELECT query, this method streams its result in chunks through a named (server-side)
+        cursor, so only one chunk of rows is held in memory at a time. Each chunk is turned into a typed DF whose column
+        names are read from the cursor description.
+        The stream runs on its own pooled connection (held until the generator is exhausted or closed), in a read-only
+        transaction of its own, so statements executed by the consumer between chunks are not part of it. Inside a
+        transaction() scope of the same thread, it runs on a named cursor of the transaction instead: it sees the writes of
+        the transaction and needs no second connection, and it must be consumed before the scope exits.
+        :param query: The raw SQL query.
+        :param params: Optional parameters of the query (psycopg2 style placeholders, e.g. %s or %(name)s)
+        :param chunk_size: The number of rows per chunk (and per round trip to the server).
+        :param dtypes: Optional dtype hints of the columns, e.g. ANALYSIS_DTYPES. Columns missing from the result are ignored.
+        :param as_arrow: Whether or not to yield pyarrow RecordBatches instead of Pandas DFs. The batches are built straight
+        from the rows, typed by the Postgres types of the columns (see ARROW_TYPES), so nulls stay nulls and every batch
+        has the same schema. dtypes are ignored.
+        :return: A generator of Pandas DFs (or pyarrow RecordBatches). An empty result yields a single empty chunk.
+        """
+        dtypes = dtypes or {}
+        if as_arrow:
+            import pyarrow as pa
+
+        connection = getattr(self._local, 'connection', None)
+        own_connection = connection is None
+        if own_connection:
+            connection = self._acquire_connection()
+        try:
+            if own_connection:
+                connection.set_session(readonly=True)
+            with connection.cursor(name=f'stream_{next(self._cursor_names)}') as cur:
+                cur.itersize = chunk_size
+                try:
+                    cur.execute(query, params)
+                except Exception as e:
+                    print('Query execution error:\n{}\n'.format(query))
+                    print(e)
+                    raise e
+
+                columns = None
+                while True:
+                    rows = cur.fetchmany(chunk_size)
+                    # The description of a named cursor is only available after the first fetch
+                    if columns is None:
+                        columns = [desc[0] for desc in cur.description]
+                        if as_arrow:
+                            arrow_types = [pa.type_for_alias(ARROW_TYPES[desc[1]]) if desc[1] in ARROW_TYPES else None
+                                           for desc in cur.description]
+                    elif not rows:
+                        break
+
+                    if as_arrow:
+                        values = list(zip(*rows)) if rows else [[] for _ in columns]
+                        yield pa.RecordBatch.from_arrays([pa.array(v, type=t) for v, t in zip(values, arrow_types)],
+                                                         names=columns)
+                    else:
+                        yield self._apply_dtypes(pd.DataFrame.from_records(rows, columns=columns), dtypes)
+                    if len(rows) < chunk_size:
+                        break
+        except pg.ProgrammingError as e:
+            # Left unconsumed by a transaction which ended since, the cursor was closed by the end of the transaction
+            if own_connection or getattr(self._local, 'connection', None) is connection:
+                raise e
+        finally:
+            if own_connection:
+                # The pooled connection goes back read-write, set_session only works outside of a transaction
+                if not connection.closed:
+                    connection.rollback()
+                    connection.set_session(readonly=False)
+                self._release_connection(connection)
+
+    def read_query(self, query: str, params=None, chunk_size=10000, dtypes: Optional[dict] = None) -> pd.DataFrame:
+        """
+        Provided with a raw SQL SELECT query, this method reads its whole result into a single typed DF through
+        stream_query. Unlike wrapping the rows of execute_query in a DF, the rows are never all held as Python tuples.
+        :param query: The raw SQL query.
+        :param params: Optional parameters of the query (psycopg2 style placeholders, e.g. %s or %(name)s)
+        :param chunk_size: The number of rows per chunk.
+        :param dtypes: Optional dtype hints of the columns, e.g. ANALYSIS_DTYPES.
+        :return: A Pandas DF of the query result.
+        """
+        chunks = list(self.stream_query(query, params=params, chunk_size=chunk_size, dtypes=dtypes))
+        # The chunks have their own categories, unify them so that the concatenation stays categorical
+        for col in chunks[0].columns:
+            if isinstance(chunks[0][col].dtype, pd.CategoricalDtype):
+                categories = pd.api.types.union_categoricals([c[col] for c in chunks]).categories
+                for c in chunks:
+                    c[col] = c[col].cat.set_categories(categories)
+        return pd.concat(chunks, ignore_index=True)
+
+    @staticmethod
+    def _clean_cell(item):
+        """
+        Normalizes a single cell before insertion, the same way for both the row-by-row and the bulk insertion paths.
+        :param item: The cell value.
+        :return: The cleaned cell value (NaN, NA and NaT values are turned into None, numpy scalars into Python ones).
+        """
+        if isinstance(item, str) and item:
+            return squeeze_spaces(item.replace('\'', ''))
+        if item is None or (np.ndim(item) == 0 and pd.isna(item)):
+            return None
+        if isinstance(item, np.generic):
+            return item.item()
+        return item
+
     def insert_into_table(self, table_name: str, data: pd.DataFrame, fetch_one=False, fetch_all=False, id_col=''):
         """
         Provided with the table name, the data to insert in the format of a Pandas DF, and whether to fetch one or all of the ids
@@ -141,18 +361,15 @@ class GenericDBOperations:
         cols = '({})'.format(', '.join(df_cols)).lower()
         values = ''
         for r in data.itertuples(index=False):
-            r2 = []
-            for item in r:
-                if item and isinstance(item, str):
-                    item = re.sub(' +', ' ', item.replace('\'', ''))
-                r2.append(item)
-            values += '({}),\n'.format(', '.join(f"'{item}'" for item in r2))
+            r2 = [self._clean_cell(item) for item in r]
+            values += '({}),\n'.format(', '.join('NULL' if item is None else f"'{item}'" for item in r2))
         values = values.strip()[:-1]
         if fetch_one or fetch_all:
             q = f'''
             INSERT INTO {table_name} {cols} VALUES
-            {values} RETURNING {id_col}
-            ON CONFLICT ({id_col}) DO NOTHING;
+            {values}
+            ON CONFLICT ({id_col}) DO NOTHING
+            RETURNING {id_col};
             '''
         else:
             q = f'''
@@ -208,3 +425,77 @@ class GenericDBOperations:
             """
         rows = self.execute_query(q, fetch_one=fetch_one, fetch_all=fetch_all)
         return rows
+
+    def bulk_insert_into_table(self, table_name: str, data: pd.DataFrame, id_col, page_size=1000,
+                               fetch_ids=False) -> tuple:
+        """
+        Provided with the table name, the data to insert in the format of a Pandas DF and the name of the id column, this
+        method inserts the data in batches of multi-row INSERT ... ON CONFLICT DO NOTHING statements (one transaction per
+        batch, or one savepoint per batch when called inside an enclosing transaction).
+        Duplicate ids inside the data are dropped before insertion. If a batch fails, its rows are inserted one by one
+        through insert_into_table so that a single bad row does not lose the whole batch.
+        :param table_name: The table to insert.
+        :param data: The data to insert (Pandas DF).
+        :param id_col: The name of the id_col, or a list of column names for composite keys.
+        :param page_size: The number of rows per batch.
+        :param fetch_ids: Whether or not to also return the ids of the inserted rows.
+        :return: A two-tuple of the number of inserted rows and the number of skipped rows (duplicates, conflicts or
+        failures), or a three-tuple (if asked for the ids) with the list of the id tuples of the inserted rows appended.
+        """
+        if self._check_df_sanity(data):
+            return (0, 0, []) if fetch_ids else (0, 0)
+
+        id_cols = [id_col] if isinstance(id_col, str) else list(id_col)
+        id_col = ', '.join(id_cols)
+        total = data.shape[0]
+        data = data[data[id_cols].notna().all(axis=1)].drop_duplicates(subset=id_cols, keep='first')
+
+        df_cols = data.columns.tolist()
+        cols = '({})'.format(', '.join(df_cols)).lower()
+        q = f'''
+        INSERT INTO {table_name} {cols} VALUES %s
+        ON CONFLICT ({id_col}) DO NOTHING
+        RETURNING {id_col};
+        '''
+
+        inserted_ids = []
+        for start in range(0, data.shape[0], page_size):
+            batch = data.iloc[start: start + page_size, :]
+            with METRICS.timer('db_insert_row_cleaning_seconds', table=table_name):
+                values = [tuple(self._clean_cell(item) for item in r) for r in batch.itertuples(index=False)]
+            try:
+                with METRICS.timer('db_insert_seconds', table=table_name), self.transaction() as cur:
+                    rows = psycopg2.extras.execute_values(cur, q, values, page_size=page_size, fetch=True)
+                inserted_ids.extend(tuple(r) for r in rows)
+            except Exception as e:
+                METRICS.inc('db_insert_fallbacks_total', table=table_name)
+                print(f'Bulk insertion into {table_name} failed, falling back to row-by-row insertion.')
+                print(e)
+                inserted_ids.extend(self._insert_rows_one_by_one(table_name=table_name, data=batch, id_col=id_col))
+
+        inserted = len(inserted_ids)
+        METRICS.inc('db_rows_inserted_total', inserted, table=table_name)
+        METRICS.inc('db_rows_skipped_total', total - inserted, table=table_name)
+        if fetch_ids:
+            return inserted, total - inserted, inserted_ids
+        return inserted, total - inserted
+
+    def _insert_rows_one_by_one(self, table_name: str, data: pd.DataFrame, id_col: str) -> list:
+        """
+        The fallback path of bulk_insert_into_table. Inserts the rows of the given DF one at a time.
+        :param table_name: The table to insert.
+        :param data: The data to insert (Pandas DF).
+        :param id_col: The name of the id_col.
+        :return: The list of the id tuples of the inserted rows.
+        """
+        inserted_ids = []
+        for i in range(data.shape[0]):
+            row_df = data.iloc[i: i + 1, :]
+            try:
+                rows = self.insert_into_table(table_name=table_name, data=row_df, fetch_one=True, id_col=id_col)
+                if not self.check_db_result_sanity(rows):
+                    inserted_ids.append(tuple(rows[0]))
+            except Exception:
+                print(f'ERROR: Cannot register {table_name}')
+                print(row_df)
+        return inserted_ids
@@ -0,0 +1,305 @@
+"""
+Tags the stored submissions and comments with the keywords of config/keywords.yml they contain, rebuilding the
+keyword_hits table, e.g. after keywords were added to the config. The crawler tags new rows on its own.
+
+Usage: python keyword_matcher.py --db-config config/db_config.yml
+"""
+import argparse
+from collections import deque
+
+import pandas as pd
+import yaml
+
+from generic_db import GenericDBOperations
+from query_planner import keyword_parts
+
+
+class KeywordMatcher:
+    """
+    KeywordMatcher finds all the keywords a text contains in one pass over the text, instead of one substring scan per
+    keyword part. The distinct parts of all the keywords are compiled into an Aho-Corasick automaton, which reports every
+    part occurring in the text (overlapping ones included, e.g. heat wave, heat and heatwave), and a keyword matches when
+    all the parts of its AND group occur. Like the has_exact_keyword check it replaces, matching is case insensitive and
+    a part matches anywhere in the text, also inside a longer word (heat in heatwave).
+    """
+
+    # The text fields of the submissions and comments, a hit records the fields a keyword matched in as a bit mask
+    FIELD_BITS = {'title': 1, 'selftext': 2, 'body': 4}
+    # table: (id column, text fields)
+    TABLE_FIELDS = {
+        'submissions': ('submission_id', ['title', 'selftext']),
+        'comments': ('comment_id', ['body']),
+    }
+
+    def __init__(self, keywords: list):
+        self.keywords = list(keywords)
+        self.parts = []
+        part_ids = {}
+        # keyword index -> the set of its part ids, part id -> the indexes of the keywords containing it
+        self.keyword_part_ids = []
+        self.part_keywords = []
+        for k, keyword in enumerate(self.keywords):
+            ids = set()
+            for part in keyword_parts(keyword):
+                if part not in part_ids:
+                    part_ids[part] = len(self.parts)
+                    self.parts.append(part)
+                    self.part_keywords.append([])
+                ids.add(part_ids[part])
+                self.part_keywords[part_ids[part]].append(k)
+            self.keyword_part_ids.append(frozenset(ids))
+        self._build_automaton()
+
+    @classmethod
+    def from_config(cls, path='config/keywords.yml') -> 'KeywordMatcher':
+        with open(path) as config_stream:
+            return cls(yaml.full_load(config_stream)['keywords'])
+
+    def _build_automaton(self):
+        # A trie of the parts (state -> {char: state}), whose failure links point to the state of the longest proper
+        # suffix which is also in the trie. The output of a state is the parts ending there, those of its failure state
+        # included, so the scan never has to follow the failure links to report a match.
+        self._goto = [{}]
+        self._output = [()]
+        for part_id, part in enumerate(self.parts):
+            state = 0
+            for char in part:
+                if char not in self._goto[state]:
+                    self._goto.append({})
+                    self._output.append(())
+                    self._goto[state][char] = len(self._goto) - 1
+                state = self._goto[state][char]
+            self._output[state] += (part_id,)
+
+        # The states one character deep fail to the root, the deeper ones are linked breadth first
+        self._fail = [0] * len(self._goto)
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(char, 0)
+                self._output[next_state] += self._output[self._fail[next_state]]
+
+    def find_parts(self, text: str) -> set:
+        """
+        :param text: A text.
+        :return: The ids of the keyword parts (indexes of self.parts) occurring in the text.
+        """
+        found = set()
+        if not text:
+            return found
+        goto, fail, output = self._goto, self._fail, self._output
+        root = goto[0]
+        state = 0
+        for char in text.lower():
+            if state == 0:
+                # Most characters do not start any part, they are skipped without a failure link walk
+                state = root.get(char, 0)
+            else:
+                while state and char not in goto[state]:
+                    state = fail[state]
+                state = goto[state].get(char, 0)
+            if output[state]:
+                found.update(output[state])
+        return found
+
+    def match_indexes(self, text: str) -> list:
+        """
+        :param text: A text.
+        :return: The indexes (in self.keywords) of the keywords the text contains, in the config order.
+        """
+        found = self.find_parts(text)
+        candidates = {k for part_id in found for k in self.part_keywords[part_id]}
+        return sorted(k for k in candidates if self.keyword_part_ids[k] <= found)
+
+    def match(self, text: str) -> list:
+        """
+        :param text: A text.
+        :return: The keywords the text contains, in the config order.
+        """
+        return [self.keywords[k] for k in self.match_indexes(text)]
+
+    def tag_frame(self, df: pd.DataFrame, id_col: str, fields: list) -> pd.DataFrame:
+        """
+        Given a DF of documents, this method tags every document with all the keywords its text fields contain, scanning
+        every field once. The parts of an AND group have to occur in the same field, as the title-only has_exact_keyword
+        check required.
+        :param df: The DF of documents.
+        :param id_col: The id column of the DF.
+        :param fields: The text columns of the DF (title, selftext or body).
+        :return: A DF with one row per (document, matched keyword), with document_id, keyword and fields columns (the bit
+        mask of FIELD_BITS of the fields the keyword matched in).
+        """
+        hits = {}
+        for field in fields:
+            bit = self.FIELD_BITS[field]
+            for document_id, text in zip(df[id_col].tolist(), df[field].tolist()):
+                if document_id is None or not isinstance(text, str):
+                    continue
+                for k in self.match_indexes(text):
+                    hits[(document_id, k)] = hits.get((document_id, k), 0) | bit
+        rows = [(document_id, self.keywords[k], mask) for (document_id, k), mask in hits.items()]
+        return pd.DataFrame.from_records(rows, columns=['document_id', 'keyword', 'fields'])
+
+    def filter_frame(self, df: pd.DataFrame, fields: list, keywords: list = None) -> pd.DataFrame:
+        """
+        Keeps the documents of a DF (e.g. of a snapshot or of a local crawl) containing a keyword, in any of the given
+        fields, without querying the API again.
+        :param df: The DF of documents.
+        :param fields: The text columns to match.
+        :param keywords: The keywords to keep the documents of, all of the keywords of the matcher by default.
+        :return: The matching rows of the DF.
+        """
+        wanted = set(range(len(self.keywords))) if keywords is None else \
+            {k for k, keyword in enumerate(self.keywords) if keyword in set(keywords)}
+        mask = pd.Series(False, index=df.index)
+        for field in fields:
+            mask |= df[field].map(lambda text: isinstance(text, str) and not wanted.isdisjoint(self.match_indexes(text)))
+        return df[mask]
+
+
+class KeywordHits:
+    """
+    KeywordHits maintains the keyword_hits table: one compact row per (document, keyword) for every submission and comment
+    containing one of the configured keywords, with the bit mask of the fields it was found in (title 1, selftext 2,
+    body 4). Unlike submission_keywords, which records the searches a submission was returned by, the hits come from the
+    text itself, so comments are tagged too and the keyword level statistics are one scan of this table.
+    The keywords are stored once in the keyword_ids table and referenced by a small integer id.
+    The tables are only created here. The rows stored before they existed are tagged by backfill() (python cli.py
+    backfill hits), which replaces all the hits in one transaction.
+    """
+
+    def __init__(self, generic_db: GenericDBOperations, matcher: KeywordMatcher):
+        self.generic_db = generic_db
+        self.matcher = matcher
+        self._ensure_tables()
+        self.keyword_ids = self._register_keyword_ids()
+
+    def _ensure_tables(self):
+        q = '''
+        CREATE TABLE IF NOT EXISTS keyword_ids (
+            keyword_id SMALLINT PRIMARY KEY,
+            keyword TEXT NOT NULL UNIQUE
+        );
+        CREATE TABLE IF NOT EXISTS keyword_hits (
+            document_id TEXT NOT NULL,
+            keyword_id SMALLINT NOT NULL,
+            fields SMALLINT NOT NULL,
+            PRIMARY KEY (document_id, keyword_id)
+        );
+        CREATE INDEX IF NOT EXISTS keyword_hits_keyword_idx ON keyword_hits (keyword_id);
+        '''
+        self.generic_db.execute_query(q)
+        q = "SELECT to_regclass('submissions') IS NOT NULL AND NOT EXISTS (SELECT 1 FROM keyword_hits);"
+        if self.generic_db.execute_query(q, fetch_one=True)[0][0] and \
+                self.generic_db.execute_query('SELECT 1 FROM submissions LIMIT 1;', fetch_one=True):
+            print('WARNING: keyword_hits is empty but submissions are stored, run python cli.py backfill hits')
+
+    def _register_keyword_ids(self) -> dict:
+        # Keywords keep their id when the config changes, new keywords get the next free ids
+        with self.generic_db.transaction() as cur:
+            cur.execute('LOCK TABLE keyword_ids IN SHARE ROW EXCLUSIVE MODE;')
+            for keyword in self.matcher.keywords:
+                cur.execute('''
+                INSERT INTO keyword_ids (keyword_id, keyword)
+                SELECT coalesce(max(keyword_id), 0) + 1, %s FROM keyword_ids
+                ON CONFLICT (keyword) DO NOTHING;
+                ''', (keyword,))
+            cur.execute('SELECT keyword, keyword_id FROM keyword_ids WHERE keyword = ANY(%s);', (self.matcher.keywords,))
+            return dict(cur.fetchall())
+
+    def tag_frame(self, df: pd.DataFrame, table_name: str) -> pd.DataFrame:
+        """
+        :param df: A DF in the format of the submissions or comments table.
+        :param table_name: The table of the DF, submissions or comments.
+        :return: The keyword hits of its rows, see KeywordMatcher.tag_frame.
+        """
+        id_col, fields = self.matcher.TABLE_FIELDS[table_name]
+        return self.matcher.tag_frame(df, id_col=id_col, fields=fields)
+
+    @staticmethod
+    def has_exact_keyword(submissions_df: pd.DataFrame, hits_df: pd.DataFrame) -> pd.Series:
+        """
+        Given a DF of submissions with a keyword column and their hits, this method tells which of them contain their
+        keyword (all the parts of its AND group) in their title.
+        :param submissions_df: The DF of submissions.
+        :param hits_df: Their hits, as returned by tag_frame.
+        :return: A boolean Series aligned with submissions_df, null where the title is missing.
+        """
+        title_bit = KeywordMatcher.FIELD_BITS['title']
+        in_title = {(d, k) for d, k, mask in hits_df.itertuples(index=False) if mask & title_bit}
+        has_exact_keyword = [(d, k) in in_title for d, k in zip(submissions_df['submission_id'], submissions_df['keyword'])]
+        return pd.Series(has_exact_keyword, index=submissions_df.index, dtype='boolean').where(
+            submissions_df['title'].notna(), pd.NA)
+
+    def register(self, hits_df: pd.DataFrame) -> tuple:
+        """
+        Stores keyword hits, the hits already stored are skipped.
+        :param hits_df: The hits, as returned by tag_frame.
+        :return: A two-tuple of the number of inserted and skipped hits.
+        """
+        if hits_df.empty:
+            return 0, 0
+        rows_df = pd.DataFrame({'document_id': hits_df['document_id'],
+                                'keyword_id': hits_df['keyword'].map(self.keyword_ids),
+                                'fields': hits_df['fields']})
+        return self.generic_db.bulk_insert_into_table(table_name='keyword_hits', data=rows_df,
+                                                      id_col=['document_id', 'keyword_id'])
+
+    def backfill(self, chunk_size=10000) -> dict:
+        """
+        Tags all the stored submissions and comments again, in one scan of each table, replacing the stored hits.
+        :param chunk_size: The number of rows read and tagged at a time.
+        :return: A dict of the number of hits per table.
+        """
+        with self.generic_db.transaction() as cur:
+            cur.execute('LOCK TABLE keyword_hits IN SHARE ROW EXCLUSIVE MODE;')
+            cur.execute('TRUNCATE keyword_hits;')
+            stored = {}
+            for table, (id_col, fields) in self.matcher.TABLE_FIELDS.items():
+                stored[table] = 0
+                q = f'SELECT {id_col}, {", ".join(fields)} FROM {table};'
+                # Streamed on a cursor of this transaction, the backfill holds a single connection
+                for chunk in self.generic_db.stream_query(q, chunk_size=chunk_size):
+                    inserted, _ = self.register(self.tag_frame(chunk, table))
+                    stored[table] += inserted
+                print(f'Tagged {table}: {stored[table]} keyword hits')
+        return stored
+
+    def keyword_stats(self) -> pd.DataFrame:
+        """
+        :return: A Pandas DF with one row per configured keyword: the number of submissions containing it (in their title
+        or selftext), in their title, and the number of comments containing it.
+        """
+        q = '''
+        SELECT k.keyword,
+               count(*) FILTER (WHERE h.document_id LIKE 't3\\_%%') AS submission_count,
+               count(*) FILTER (WHERE h.document_id LIKE 't3\\_%%' AND h.fields & 1 = 1) AS title_count,
+               count(*) FILTER (WHERE h.document_id LIKE 't1\\_%%') AS comment_count
+        FROM keyword_ids k
+        LEFT JOIN keyword_hits h ON h.keyword_id = k.keyword_id
+        WHERE k.keyword = ANY(%s)
+        GROUP BY k.keyword, k.keyword_id
+        ORDER BY k.keyword_id;
+        '''
+        return self.generic_db.read_query(q, params=(self.matcher.keywords,))
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument('--db-config', default=None, help='Path of the db config (defaults to config/db_config.yml)')
+    arg_parser.add_argument('--keywords', default='config/keywords.yml', help='Path of the keywords config')
+    arg_parser.add_argument('--chunk-size', type=int, default=10000, help='Rows read from the database at a time')
+    args = arg_parser.parse_args()
+
+    keyword_hits = KeywordHits(GenericDBOperations(path=args.db_config), KeywordMatcher.from_config(args.keywords))
+    keyword_hits.backfill(chunk_size=args.chunk_size)
+    print(keyword_hits.keyword_stats())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,209 @@
+"""
+Rebuilds the keyword_daily_rollups table from the stored submissions, keyword matches and comments, e.g. after a
+migration or after rows were deleted by hand. The crawler keeps the table up to date on its own.
+
+Usage: python keyword_rollups.py --db-config config/db_config.yml
+"""
+import argparse
+
+import pandas as pd
+
+from generic_db import GenericDBOperations
+
+
+class KeywordRollups:
+    """
+    KeywordRollups maintains the keyword_daily_rollups table: per (subreddit, keyword, day), the number of submissions
+    matching the keyword and the sum of their scores, and the number of comments of those submissions and the sum of their
+    scores. Submissions are counted on the day they were created, comments on the day they were created, and a submission
+    matching several keywords (and its comments) counts for each of them, as in the submission_keywords table.
+    The crawler updates the table in the transaction inserting the rows, from the newly inserted keyword matches and
+    comments only, so the table is a cheap index lookup for the per keyword, per subreddit and per day questions instead of
+    an export of the whole corpus.
+    The table is only created here. The rows stored before it existed are added by backfill() (python cli.py backfill
+    rollups), which also creates the index of the comments by submission the updates look the comments up with.
+    """
+
+    def __init__(self, generic_db: GenericDBOperations):
+        self.generic_db = generic_db
+        self._ensure_table()
+
+    def _ensure_table(self):
+        q = '''
+        CREATE TABLE IF NOT EXISTS keyword_daily_rollups (
+            subreddit TEXT NOT NULL,
+            keyword TEXT NOT NULL,
+            day DATE NOT NULL,
+            submission_count INTEGER NOT NULL DEFAULT 0,
+            submission_score_sum BIGINT NOT NULL DEFAULT 0,
+            comment_count INTEGER NOT NULL DEFAULT 0,
+            comment_score_sum BIGINT NOT NULL DEFAULT 0,
+            PRIMARY KEY (subreddit, keyword, day)
+        );
+        CREATE INDEX IF NOT EXISTS keyword_daily_rollups_keyword_idx ON keyword_daily_rollups (keyword, day);
+        '''
+        self.generic_db.execute_query(q)
+        q = '''
+        SELECT to_regclass('submission_keywords') IS NOT NULL AND NOT EXISTS (SELECT 1 FROM keyword_daily_rollups);
+        '''
+        if self.generic_db.execute_query(q, fetch_one=True)[0][0] and \
+                self.generic_db.execute_query('SELECT 1 FROM submission_keywords LIMIT 1;', fetch_one=True):
+            print('WARNING: keyword_daily_rollups is empty but keyword matches are stored, run python cli.py backfill '
+                  'rollups')
+
+    @staticmethod
+    def _upsert(deltas_q: str, ctes='') -> str:
+        # deltas_q selects (subreddit, keyword, day, submission_count, submission_score_sum, comment_count,
+        # comment_score_sum) rows, which are added to the stored ones. ctes are common table expressions deltas_q reads.
+        # The rows are upserted in key order, so concurrent transactions lock the rows they share in the same order instead
+        # of deadlocking. The order only holds within a statement, so a transaction must update the rollups of a table in
+        # a single call rather than once per batch.
+        return f'''
+        WITH {ctes}deltas AS ({deltas_q})
+        INSERT INTO keyword_daily_rollups (subreddit, keyword, day, submission_count, submission_score_sum,
+                                           comment_count, comment_score_sum)
+        SELECT subreddit, keyword, day, sum(submission_count), sum(submission_score_sum), sum(comment_count),
+               sum(comment_score_sum)
+        FROM deltas
+        GROUP BY subreddit, keyword, day
+        ORDER BY subreddit, keyword, day
+        ON CONFLICT (subreddit, keyword, day) DO UPDATE
+        SET submission_count = keyword_daily_rollups.submission_count + EXCLUDED.submission_count,
+            submission_score_sum = keyword_daily_rollups.submission_score_sum + EXCLUDED.submission_score_sum,
+            comment_count = keyword_daily_rollups.comment_count + EXCLUDED.comment_count,
+            comment_score_sum = keyword_daily_rollups.comment_score_sum + EXCLUDED.comment_score_sum;
+        '''
+
+    @staticmethod
+    def _lock_submissions(cur, submissions_q: str, params: tuple):
+        # The comments of a submission and its keyword matches can be inserted by concurrent transactions, neither seeing
+        # the rows of the other. Locking the submissions (in a consistent order) makes the second transaction wait for the
+        # first one, so that its next statement sees the committed rows and every (comment, keyword) pair counts once.
+        cur.execute(f'''
+        SELECT pg_advisory_xact_lock(hashtext(submission_id))
+        FROM ({submissions_q} ORDER BY 1) locked;
+        ''', params)
+
+    def add_keyword_matches(self, matches: list):
+        """
+        Adds newly inserted keyword matches to the rollups: the submission itself and the comments of it stored so far.
+        Called in the transaction inserting the matches.
+        :param matches: A list of the (submission_id, keyword) pairs inserted into submission_keywords.
+        """
+        if not matches:
+            return
+        params = ([m[0] for m in matches], [m[1] for m in matches])
+        deltas_q = '''
+        SELECT s.subreddit, m.keyword, s.created_at::date AS day, count(*) AS submission_count,
+               coalesce(sum(s.score), 0) AS submission_score_sum, 0 AS comment_count, 0 AS comment_score_sum
+        FROM matches m
+        JOIN submissions s ON s.submission_id = m.submission_id
+        WHERE s.created_at IS NOT NULL
+        GROUP BY s.subreddit, m.keyword, s.created_at::date
+        UNION ALL
+        SELECT c.subreddit, m.keyword, c.created_at::date, 0, 0, count(*), coalesce(sum(c.score), 0)
+        FROM matches m
+        JOIN comments c ON c.submission = m.submission_id
+        WHERE c.created_at IS NOT NULL
+        GROUP BY c.subreddit, m.keyword, c.created_at::date
+        '''
+        matches_q = 'SELECT * FROM unnest(%s::text[], %s::text[]) AS m (submission_id, keyword)'
+        with self.generic_db.transaction() as cur:
+            self._lock_submissions(cur, 'SELECT DISTINCT submission_id FROM unnest(%s::text[]) AS m (submission_id)',
+                                   params[:1])
+            cur.execute(self._upsert(deltas_q, ctes=f'matches AS ({matches_q}), '), params)
+
+    def add_comments(self, comment_ids: list):
+        """
+        Adds newly inserted comments to the rollups, once for every keyword their submission matches so far. Called once
+        in the transaction inserting the comments, with all the comments it inserted.
+        :param comment_ids: The ids of the comments inserted into comments.
+        """
+        if not comment_ids:
+            return
+        deltas_q = '''
+        SELECT c.subreddit, sk.keyword, c.created_at::date AS day, 0 AS submission_count, 0 AS submission_score_sum,
+               count(*) AS comment_count, coalesce(sum(c.score), 0) AS comment_score_sum
+        FROM comments c
+        JOIN submission_keywords sk ON sk.submission_id = c.submission
+        WHERE c.comment_id = ANY(%s) AND c.created_at IS NOT NULL
+        GROUP BY c.subreddit, sk.keyword, c.created_at::date
+        '''
+        with self.generic_db.transaction() as cur:
+            self._lock_submissions(cur, 'SELECT DISTINCT submission AS submission_id FROM comments '
+                                        'WHERE comment_id = ANY(%s)', (comment_ids,))
+            cur.execute(self._upsert(deltas_q), (comment_ids,))
+
+    def update(self, table_name: str, inserted_ids: list):
+        """
+        Given the ids of the rows just inserted into a table, this method adds them to the rollups if the table is rolled
+        up (submission_keywords or comments), and does nothing otherwise.
+        :param table_name: The table the rows were inserted into.
+        :param inserted_ids: The id tuples of the inserted rows, as returned by bulk_insert_into_table(fetch_ids=True).
+        """
+        if table_name == 'submission_keywords':
+            self.add_keyword_matches(inserted_ids)
+        elif table_name == 'comments':
+            self.add_comments([i[0] for i in inserted_ids])
+
+    def backfill(self):
+        """
+        Recomputes the whole table from the stored rows. The table is locked until the recomputed rows are committed, so
+        concurrent crawls wait instead of updating rows which are being replaced.
+        """
+        deltas_q = '''
+        SELECT s.subreddit, sk.keyword, s.created_at::date AS day, count(*) AS submission_count,
+               coalesce(sum(s.score), 0) AS submission_score_sum, 0 AS comment_count, 0 AS comment_score_sum
+        FROM submission_keywords sk
+        JOIN submissions s ON s.submission_id = sk.submission_id
+        WHERE s.created_at IS NOT NULL
+        GROUP BY s.subreddit, sk.keyword, s.created_at::date
+        UNION ALL
+        SELECT c.subreddit, sk.keyword, c.created_at::date, 0, 0, count(*), coalesce(sum(c.score), 0)
+        FROM submission_keywords sk
+        JOIN comments c ON c.submission = sk.submission_id
+        WHERE c.created_at IS NOT NULL
+        GROUP BY c.subreddit, sk.keyword, c.created_at::date
+        '''
+        with self.generic_db.transaction() as cur:
+            cur.execute('CREATE INDEX IF NOT EXISTS comments_submission_idx ON comments (submission);')
+            cur.execute('TRUNCATE keyword_daily_rollups;')
+            cur.execute(self._upsert(deltas_q))
+            print(f'Backfilled keyword_daily_rollups: {cur.rowcount} rows')
+
+    def daily_volume(self, keyword=None, subreddit=None, start=None, end=None) -> pd.DataFrame:
+        """
+        Reads the rollups, optionally restricted to a keyword, a subreddit and a range of days.
+        :param keyword: The keyword, or None for every keyword.
+        :param subreddit: The id of the subreddit, or None for every subreddit.
+        :param start: The first day (inclusive), or None.
+        :param end: The last day (inclusive), or None.
+        :return: A Pandas DF with one row per (subreddit, keyword, day).
+        """
+        conditions = []
+        params = []
+        for condition, value in [('keyword = %s', keyword), ('subreddit = %s', subreddit), ('day >= %s', start),
+                                 ('day <= %s', end)]:
+            if value is not None:
+                conditions.append(condition)
+                params.append(value)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        q = f'''
+        SELECT subreddit, keyword, day, submission_count, submission_score_sum, comment_count, comment_score_sum
+        FROM keyword_daily_rollups
+        {where}
+        ORDER BY subreddit, keyword, day;
+        '''
+        return self.generic_db.read_query(q, params=tuple(params))
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument('--db-config', default=None, help='Path of the db config (defaults to config/db_config.yml)')
+    args = arg_parser.parse_args()
+
+    KeywordRollups(GenericDBOperations(path=args.db_config)).backfill()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,260 @@
+import json
+import os
+import re
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+# Path segments following these ones are ids or names, they are replaced by a placeholder in the endpoint label
+_PATH_PARAMS = {'r': '{subreddit}', 'comments': '{id}', 'user': '{user}', 'u': '{user}', 'duplicates': '{id}'}
+_METRIC_NAME = re.compile(r'[^a-zA-Z0-9_]')
+
+
+def endpoint_of(url: str) -> str:
+    """
+    Given the URL of a Reddit API request, this function returns its endpoint, e.g. /r/{subreddit}/search.
+    :param url: The URL.
+    :return: The path of the URL, with the ids and names replaced by placeholders.
+    """
+    segments = [s for s in urlparse(url).path.split('/') if s]
+    for i in range(1, len(segments)):
+        if segments[i - 1] in _PATH_PARAMS:
+            segments[i] = _PATH_PARAMS[segments[i - 1]]
+    if segments and segments[-1].endswith('.json'):
+        segments[-1] = segments[-1][:-len('.json')]
+    return '/' + '/'.join(segments)
+
+
+def statement_of(query: str) -> str:
+    """
+    :param query: A raw SQL query.
+    :return: Its first keyword in upper case (SELECT, INSERT, ...), the label the query timings are grouped by.
+    """
+    words = query.split(None, 1)
+    return words[0].upper() if words else ''
+
+
+class MetricsRegistry:
+    """
+    MetricsRegistry is a thread-safe store of counters and timers, labelled by a few low-cardinality labels (an endpoint, a
+    table, a statement type). A timer keeps the number of observations, their sum and their maximum. The metrics are
+    exported in the Prometheus text format (timers as summaries) or as JSON lines, one line per export.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = Counter()
+        # (name, labels) -> [count, sum, max]
+        self.timers = {}
+        self.started_at = time.time()
+
+    @staticmethod
+    def _key(name: str, labels: dict) -> tuple:
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name: str, value=1, **labels):
+        """
+        Increments a counter.
+        :param name: The name of the counter.
+        :param value: The increment.
+        :param labels: The labels of the counter.
+        """
+        with self._lock:
+            self.counters[self._key(name, labels)] += value
+
+    def observe(self, name: str, seconds: float, **labels):
+        """
+        Records one observation of a timer.
+        :param name: The name of the timer.
+        :param seconds: The observed duration.
+        :param labels: The labels of the timer.
+        """
+        key = self._key(name, labels)
+        with self._lock:
+            timer = self.timers.get(key)
+            if timer is None:
+                self.timers[key] = [1, seconds, seconds]
+            else:
+                timer[0] += 1
+                timer[1] += seconds
+                timer[2] = max(timer[2], seconds)
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        """
+        A context manager timing its scope, recorded even if the scope raises.
+        :param name: The name of the timer.
+        :param labels: The labels of the timer.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def reset(self):
+        with self._lock:
+            self.counters = Counter()
+            self.timers = {}
+            self.started_at = time.time()
+
+    def snapshot(self) -> dict:
+        """
+        :return: A dict with the counters and the timers (count, sum and max of seconds), each a list of entries with the
+        name, the labels and the values.
+        """
+        with self._lock:
+            counters = [{'name': name, 'labels': dict(labels), 'value': value}
+                        for (name, labels), value in sorted(self.counters.items())]
+            timers = [{'name': name, 'labels': dict(labels), 'count': t[0], 'sum': t[1], 'max': t[2]}
+                      for (name, labels), t in sorted(self.timers.items())]
+        return {'timestamp': time.time(), 'started_at': self.started_at, 'counters': counters, 'timers': timers}
+
+    @staticmethod
+    def _prometheus_labels(labels: dict) -> str:
+        if not labels:
+            return ''
+        escaped = {k: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for k, v in labels.items()}
+        return '{' + ','.join(f'{k}="{v}"' for k, v in escaped.items()) + '}'
+
+    def to_prometheus(self, prefix='reddit_crawler_') -> str:
+        """
+        :param prefix: The prefix of the metric names.
+        :return: The metrics in the Prometheus text exposition format.
+        """
+        snapshot = self.snapshot()
+        lines = []
+        declared = set()
+        for c in snapshot['counters']:
+            name = _METRIC_NAME.sub('_', prefix + c['name'])
+            if name not in declared:
+                lines.append(f'# TYPE {name} counter')
+                declared.add(name)
+            lines.append(f"{name}{self._prometheus_labels(c['labels'])} {c['value']}")
+        timer_names = sorted({t['name'] for t in snapshot['timers']})
+        for timer_name in timer_names:
+            # Every metric family is one group of lines, the summary first and then the gauge of the maximums
+            timers = [t for t in snapshot['timers'] if t['name'] == timer_name]
+            name = _METRIC_NAME.sub('_', prefix + timer_name)
+            lines.append(f'# TYPE {name} summary')
+            for t in timers:
+                lines.append(f"{name}_count{self._prometheus_labels(t['labels'])} {t['count']}")
+                lines.append(f"{name}_sum{self._prometheus_labels(t['labels'])} {t['sum']:.6f}")
+            lines.append(f'# TYPE {name}_max gauge')
+            for t in timers:
+                lines.append(f"{name}_max{self._prometheus_labels(t['labels'])} {t['max']:.6f}")
+        return '\n'.join(lines) + '\n'
+
+    def export(self, path: str, fmt='prometheus'):
+        """
+        Writes the metrics to a file: the Prometheus format replaces the file (e.g. for the textfile collector of the node
+        exporter), the jsonl format appends one line per export.
+        :param path: The path of the file.
+        :param fmt: prometheus or jsonl.
+        """
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        if fmt == 'jsonl':
+            with open(path, 'a') as metrics_stream:
+                metrics_stream.write(json.dumps(self.snapshot()) + '\n')
+        else:
+            # Written next to the file and renamed, so a scrape never reads a partial file
+            with open(f'{path}.tmp', 'w') as metrics_stream:
+                metrics_stream.write(self.to_prometheus())
+            os.replace(f'{path}.tmp', path)
+
+    def summary(self, top=20) -> str:
+        """
+        :param top: The number of timers to list.
+        :return: A human readable table of the timers with the largest total time.
+        """
+        timers = sorted(self.snapshot()['timers'], key=lambda t: t['sum'], reverse=True)[:top]
+        lines = [f"{'timer':<60}{'count':>10}{'total s':>12}{'avg ms':>10}{'max ms':>10}"]
+        for t in timers:
+            label = t['name'] + self._prometheus_labels(t['labels'])
+            lines.append(f"{label:<60}{t['count']:>10}{t['sum']:>12.2f}{t['sum'] / t['count'] * 1000:>10.1f}"
+                         f"{t['max'] * 1000:>10.1f}")
+        return '\n'.join(lines)
+
+
+# The registry all the hooks of the crawler and the DB layer record to
+METRICS = MetricsRegistry()
+
+
+class SamplingProfiler:
+    """
+    SamplingProfiler samples the stacks of all the threads of the process every interval seconds from a background
+    thread, so it can stay on during a whole crawl. The samples tell whether the crawl spends its time waiting on the
+    network, waiting on the DB or building DataFrames. They are written in the collapsed stack format (one line per stack
+    with its number of samples), which flamegraph.pl and speedscope read.
+    """
+
+    def __init__(self, interval=0.01, max_depth=64):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        own_id = threading.get_ident()
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_id:
+                continue
+            frames = traceback.extract_stack(frame, limit=self.max_depth)
+            stack = ';'.join(f'{os.path.basename(f.filename)}:{f.name}' for f in frames)
+            # Worker threads are merged under their pool name, e.g. ThreadPoolExecutor-0
+            thread_name = names.get(thread_id, 'thread').rsplit('_', 1)[0]
+            self.stacks[f'{thread_name};{stack}'] += 1
+        self.samples += 1
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.stop()
+
+    def top_functions(self, top=20) -> list:
+        """
+        :param top: The number of functions to return.
+        :return: A list of (function, share of the samples) pairs of the functions the sampled stacks were in the most,
+        i.e. their self time.
+        """
+        leaves = Counter()
+        for stack, count in self.stacks.items():
+            leaves[stack.rsplit(';', 1)[-1]] += count
+        total = sum(leaves.values()) or 1
+        return [(f, count / total) for f, count in leaves.most_common(top)]
+
+    def write_collapsed(self, path: str):
+        """
+        Writes the sampled stacks in the collapsed stack format.
+        :param path: The path of the file.
+        """
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as stacks_stream:
+            for stack, count in self.stacks.most_common():
+                stacks_stream.write(f'{stack} {count}\n')
@@ -0,0 +1,136 @@
+import itertools
+import os
+from collections import namedtuple
+from zoneinfo import ZoneInfo
+
+import pandas as pd
+from dateutil import tz
+
+# A column of a table: its name, the field of the reddit payload it is read from and its pandas dtype
+ColumnSpec = namedtuple('ColumnSpec', ['name', 'field', 'dtype'])
+
+# Columns without a payload field (field=None) are provided by the caller through extra_columns
+SUBMISSION_COLUMNS = [
+    ColumnSpec('submission_id', 'name', 'string'),
+    ColumnSpec('author', 'author_fullname', 'string'),
+    ColumnSpec('subreddit', 'subreddit_id', 'string'),
+    ColumnSpec('keyword', None, 'string'),
+    ColumnSpec('has_exact_keyword', None, 'boolean'),
+    ColumnSpec('title', 'title', 'string'),
+    ColumnSpec('score', 'score', 'Int64'),
+    ColumnSpec('selftext', 'selftext', 'string'),
+    ColumnSpec('upvote_ratio', 'upvote_ratio', 'Float64'),
+    ColumnSpec('num_comments', 'num_comments', 'Int64'),
+    ColumnSpec('url', 'url', 'string'),
+    ColumnSpec('permalink', 'permalink', 'string'),
+    ColumnSpec('author_flair_text', 'author_flair_text', 'string'),
+    ColumnSpec('link_flair_text', 'link_flair_text', 'string'),
+    ColumnSpec('distinguished', 'distinguished', 'string'),
+    ColumnSpec('is_self', 'is_self', 'boolean'),
+    ColumnSpec('locked', 'locked', 'boolean'),
+    ColumnSpec('over_18', 'over_18', 'boolean'),
+    ColumnSpec('created_at', None, 'datetime64[ns]'),
+    ColumnSpec('created_utc', 'created_utc', 'Float64'),
+]
+
+COMMENT_COLUMNS = [
+    ColumnSpec('comment_id', 'name', 'string'),
+    ColumnSpec('author', 'author_fullname', 'string'),
+    ColumnSpec('submission', 'link_id', 'string'),
+    ColumnSpec('subreddit', 'subreddit_id', 'string'),
+    ColumnSpec('body', 'body', 'string'),
+    ColumnSpec('score', 'score', 'Int64'),
+    ColumnSpec('distinguished', 'distinguished', 'string'),
+    ColumnSpec('is_submitter', 'is_submitter', 'boolean'),
+    ColumnSpec('parent_id', 'parent_id', 'string'),
+    ColumnSpec('permalink', 'permalink', 'string'),
+    ColumnSpec('created_at', None, 'datetime64[ns]'),
+    ColumnSpec('created_utc', 'created_utc', 'Float64'),
+]
+
+SUBREDDIT_COLUMNS = [
+    ColumnSpec('subreddit_id', 'name', 'string'),
+    ColumnSpec('display_name', 'display_name', 'string'),
+    ColumnSpec('description', 'public_description', 'string'),
+    ColumnSpec('subscribers', 'subscribers', 'Int64'),
+    ColumnSpec('over18', 'over18', 'boolean'),
+    ColumnSpec('created_utc', 'created_utc', 'Float64'),
+    ColumnSpec('created_at', None, 'datetime64[ns]'),
+]
+
+
+def _get_payload(reddit_model) -> dict:
+    # praw keeps the fetched JSON fields in the instance dict, reading them from there never triggers a lazy fetch
+    if reddit_model is None:
+        return {}
+    if isinstance(reddit_model, dict):
+        return reddit_model
+    return vars(reddit_model)
+
+
+def _to_array(values, dtype: str):
+    try:
+        return pd.array(values, dtype=dtype)
+    except (TypeError, ValueError):
+        # Unexpected payload values (e.g. a flair that is not a string) are kept as they are
+        return pd.array(values, dtype=object)
+
+
+def local_timezone():
+    """
+    :return: The local timezone by its name (from TZ or /etc/localtime), which pandas converts to in vectorized code, or
+    dateutil's tzlocal (converted row by row) when it has no name.
+    """
+    name = os.environ.get('TZ', '').lstrip(':')
+    if not name and os.path.islink('/etc/localtime'):
+        name = os.path.realpath('/etc/localtime').partition('/zoneinfo/')[2]
+    try:
+        return ZoneInfo(name)
+    except Exception:
+        return tz.tzlocal()
+
+
+def _local_datetimes(created_utc) -> pd.api.extensions.ExtensionArray:
+    # The naive local times datetime.fromtimestamp gives, as the crawler always stored created_at
+    utc = pd.to_datetime(pd.Series(created_utc, dtype='Float64'), unit='s', utc=True)
+    return utc.dt.tz_convert(local_timezone()).dt.tz_localize(None).astype('datetime64[ns]').array
+
+
+def extract_frame(reddit_models: list, columns: list, extra_columns: dict = None, as_arrow=False):
+    """
+    Given a list of reddit models (or raw payload dicts) and the column spec of a table, this function reads the payload
+    fields of all the models column by column and builds typed columns out of them. Missing fields become nulls, created_at
+    is derived from created_utc (in local time, as the crawler always stored it).
+    :param reddit_models: The praw models or payload dicts.
+    :param columns: The column spec of the table, e.g. SUBMISSION_COLUMNS.
+    :param extra_columns: Values of the columns not read from the payload (or overriding it), either one value per model
+    or a single value for all of them.
+    :param as_arrow: Whether or not to return a pyarrow Table instead of a Pandas DF.
+    :return: A Pandas DF (or a pyarrow Table) with one row per model and the columns of the spec.
+    """
+    extra_columns = extra_columns or {}
+    payload_columns = [c for c in columns if c.field is not None and c.name not in extra_columns]
+
+    payloads = list(map(_get_payload, reddit_models))
+    # One pass over the payloads per field, the lookups run in C instead of a Python loop per row
+    values = {c.name: list(map(dict.get, payloads, itertools.repeat(c.field))) for c in payload_columns}
+
+    data = {}
+    for c in columns:
+        if c.name in extra_columns:
+            v = extra_columns[c.name]
+            column_values = v if isinstance(v, (list, tuple, pd.Series)) else [v] * len(payloads)
+        elif c.name == 'created_at':
+            continue
+        else:
+            column_values = values.get(c.name, [])
+        data[c.name] = _to_array(list(column_values), c.dtype)
+
+    if any(c.name == 'created_at' and c.name not in extra_columns for c in columns):
+        data['created_at'] = _local_datetimes(data['created_utc'])
+
+    df = pd.DataFrame({c.name: data[c.name] for c in columns})
+    if as_arrow:
+        import pyarrow as pa
+        return pa.Table.from_pandas(df, preserve_index=False)
+    return df
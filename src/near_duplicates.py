@@ -0,0 +1,249 @@
+"""
+Reports the near-duplicate rate of the cleaned submissions or comments.
+
+Usage: python near_duplicates.py --table submissions [--threshold 0.8]
+"""
+import argparse
+import itertools
+import re
+import zlib
+
+import numpy as np
+import pandas as pd
+
+# Combines the hashes of the words of a shingle, any odd multiplier works
+_SHINGLE_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+_MAX_HASH = np.uint32(0xFFFFFFFF)
+
+_WORD = re.compile(r'\w+')
+
+
+def shingle_hashes(documents: list, shingle_size=5) -> tuple:
+    """
+    Given some documents, this function hashes their shingles: the runs of shingle_size consecutive lower case words, so
+    that the punctuation, case and spacing of the copies of a text do not matter.
+    :param documents: The documents.
+    :param shingle_size: The number of words per shingle.
+    :return: A two-tuple of a uint64 array of the 64 bit hashes of the shingles, document after document (a single
+    shingle for a document shorter than shingle_size, none for a document without words), and an int64 array of the
+    number of shingles of each document.
+    """
+    words = [_WORD.findall(d.lower()) if isinstance(d, str) else [] for d in documents]
+    lengths = np.fromiter(map(len, words), dtype=np.int64, count=len(words))
+    n = int(lengths.sum())
+    word_hashes = np.fromiter(map(zlib.crc32, map(str.encode, itertools.chain.from_iterable(words))),
+                              dtype=np.uint64, count=n)
+    ends = np.repeat(np.cumsum(lengths), lengths)
+    positions = np.arange(n)
+    hashes = np.zeros(n, dtype=np.uint64)
+    for offset in range(shingle_size):
+        in_document = positions + offset < ends
+        hashes[in_document] = hashes[in_document] * _SHINGLE_MULTIPLIER + word_hashes[positions[in_document] + offset]
+    # A shingle starts wherever shingle_size words are left, or at the first word of a shorter document
+    starts = np.repeat(np.cumsum(lengths) - lengths, lengths)
+    is_shingle = (positions + shingle_size <= ends) | ((positions == starts) & (ends - starts < shingle_size))
+    counts = np.where(lengths >= shingle_size, lengths - shingle_size + 1, np.minimum(lengths, 1))
+    return hashes[is_shingle], counts
+
+
+class _UnionFind:
+    def __init__(self, n: int):
+        self.parent = list(range(n))
+
+    def find(self, i: int) -> int:
+        root = i
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[i] != root:
+            self.parent[i], i = root, self.parent[i]
+        return root
+
+    def union(self, i: int, j: int):
+        # The smaller row stays the root, so the root of a cluster is its first document
+        root_i, root_j = self.find(i), self.find(j)
+        if root_i != root_j:
+            self.parent[max(root_i, root_j)] = min(root_i, root_j)
+
+    def roots(self) -> np.ndarray:
+        roots = np.array(self.parent, dtype=np.int64)
+        while True:
+            parents = roots[roots]
+            if np.array_equal(parents, roots):
+                return roots
+            roots = parents
+
+
+class Deduplication:
+    """
+    The near-duplicate clusters of some documents: documents holds the canonical (first) document of every cluster, in
+    the order of the documents, and mapping the index in documents of the cluster of every given document. Whatever is
+    computed on the canonical documents is fanned out to all of them with expand().
+    """
+
+    def __init__(self, all_documents: list, roots: np.ndarray):
+        self.canonical_rows, self.mapping = np.unique(roots, return_inverse=True)
+        self.documents = [all_documents[i] for i in self.canonical_rows.tolist()]
+
+    def __len__(self) -> int:
+        return len(self.mapping)
+
+    @property
+    def duplicate_rate(self) -> float:
+        """
+        :return: The share of the documents which are not the canonical document of their cluster.
+        """
+        return 1 - len(self.documents) / len(self) if len(self) else 0.0
+
+    def expand(self, results):
+        """
+        Given the results computed for the canonical documents, this method fans them out to all the documents.
+        :param results: A list, a numpy array or a Pandas DF/Series with one row per canonical document.
+        :return: The same type of results with one row per document, in the order of the documents.
+        """
+        if isinstance(results, (pd.DataFrame, pd.Series)):
+            return results.iloc[self.mapping].reset_index(drop=True)
+        if isinstance(results, np.ndarray):
+            return results[self.mapping]
+        return [results[i] for i in self.mapping.tolist()]
+
+
+class NearDuplicateIndex:
+    """
+    NearDuplicateIndex finds the near-duplicate documents (cross-posts, quoted articles, bot comments) with MinHash and
+    locality sensitive hashing, so that expensive models only run once per cluster of copies:
+    - Every document is reduced to its shingle hashes, and the shingles to a MinHash signature of num_perm values, two
+      documents agreeing on a share of the values close to the Jaccard similarity of their shingles.
+    - The signatures are split into bands, the documents sharing all the values of a band are candidates, and a candidate
+      is kept if its signature agrees with the first document of its bucket on at least threshold of the values.
+    - The kept pairs are merged into clusters (union-find), the first document of a cluster being its canonical document.
+    With the default 16 bands of 4 values, a pair with a similarity of 0.8 is a candidate with a probability above 0.999.
+    Documents without words are never clustered.
+    """
+
+    def __init__(self, threshold=0.8, num_perm=64, bands=16, shingle_size=5, seed=1, chunk_size=10000):
+        if num_perm % bands:
+            raise ValueError(f'num_perm ({num_perm}) must be a multiple of bands ({bands})')
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands = bands
+        self.shingle_size = shingle_size
+        self.chunk_size = chunk_size
+        # The permutations are multiply-shift hashes of the shingle hashes, (a * hash + b) >> 32 with an odd a
+        rng = np.random.default_rng(seed)
+        self._a = rng.integers(0, 2 ** 64 - 1, size=num_perm, dtype=np.uint64, endpoint=True) | np.uint64(1)
+        self._b = rng.integers(0, 2 ** 64 - 1, size=num_perm, dtype=np.uint64, endpoint=True)
+
+    def signatures(self, documents: list) -> np.ndarray:
+        """
+        Given some documents, this method computes their MinHash signatures, chunk_size documents at a time.
+        :param documents: The documents.
+        :return: A uint32 array with one row of num_perm values per document, all of them the maximum value for a document
+        without words.
+        """
+        signatures = np.full((len(documents), self.num_perm), _MAX_HASH, dtype=np.uint32)
+        shift = np.uint64(32)
+        for start in range(0, len(documents), self.chunk_size):
+            hashes, counts = shingle_hashes(documents[start: start + self.chunk_size], self.shingle_size)
+            rows = start + np.flatnonzero(counts)
+            offsets = np.cumsum(counts[counts > 0]) - counts[counts > 0]
+            for i in range(self.num_perm):
+                permuted = ((hashes * self._a[i] + self._b[i]) >> shift).astype(np.uint32)
+                signatures[rows, i] = np.minimum.reduceat(permuted, offsets)
+        return signatures
+
+    def cluster(self, signatures: np.ndarray) -> np.ndarray:
+        """
+        Given the signatures of some documents, this method clusters the near-duplicate ones.
+        :param signatures: The signatures, from signatures().
+        :return: An int64 array of the row of the canonical document of the cluster of every document.
+        """
+        pairs = []
+        valid = np.flatnonzero((signatures != _MAX_HASH).any(axis=1))
+        rows_per_band = self.num_perm // self.bands
+        for band in range(self.bands):
+            band_values = np.ascontiguousarray(signatures[valid, band * rows_per_band: (band + 1) * rows_per_band])
+            keys = band_values.view(np.dtype((np.void, band_values.dtype.itemsize * rows_per_band))).ravel()
+            _, buckets, counts = np.unique(keys, return_inverse=True, return_counts=True)
+            shared = counts[buckets] > 1
+            if not shared.any():
+                continue
+            members = valid[shared]
+            member_buckets = buckets.ravel()[shared]
+            order = np.argsort(member_buckets, kind='stable')
+            members, member_buckets = members[order], member_buckets[order]
+            # The first (smallest) row of every bucket, against which the other rows of the bucket are verified
+            starts = np.r_[True, member_buckets[1:] != member_buckets[:-1]]
+            firsts = members[starts][np.cumsum(starts) - 1]
+            kept = (signatures[members] == signatures[firsts]).mean(axis=1) >= self.threshold
+            pairs.append(firsts[kept & ~starts] * len(signatures) + members[kept & ~starts])
+
+        union_find = _UnionFind(len(signatures))
+        if pairs:
+            # Most pairs are found by several bands
+            for pair in np.unique(np.concatenate(pairs)).tolist():
+                union_find.union(*divmod(pair, len(signatures)))
+        return union_find.roots()
+
+    def deduplicate(self, documents: list) -> Deduplication:
+        """
+        Given some documents, this method clusters their near-duplicates.
+        :param documents: The documents, e.g. the documents of the DocumentPacker or the cleaned texts of a table.
+        :return: The Deduplication of the documents.
+        """
+        return Deduplication(documents, self.cluster(self.signatures(documents)))
+
+    def deduplicate_frame(self, df: pd.DataFrame, id_col: str, text_col: str) -> pd.DataFrame:
+        """
+        Given a DF of documents, e.g. the submissions or comments with their cleaned text, this method maps every
+        document to the canonical document of its cluster.
+        :param df: The DF.
+        :param id_col: The id column of the DF.
+        :param text_col: The text column of the DF.
+        :return: A DF of document_id, canonical_id and cluster_size, in the order of the DF.
+        """
+        deduplication = self.deduplicate(df[text_col].tolist())
+        ids = df[id_col].to_numpy()
+        return pd.DataFrame({'document_id': ids,
+                             'canonical_id': ids[deduplication.canonical_rows[deduplication.mapping]],
+                             'cluster_size': np.bincount(deduplication.mapping)[deduplication.mapping]})
+
+
+def print_duplicates(generic_db, table_name: str, threshold=0.8, top=10):
+    """
+    Prints the near-duplicate rate of the cleaned texts of a table and its largest clusters.
+    :param generic_db: The GenericDBOperations of the database.
+    :param table_name: submissions or comments.
+    :param threshold: The minimum similarity of near-duplicates.
+    :param top: The number of clusters printed.
+    """
+    from text_normalizer import TextNormalizer
+
+    id_col, _, clean_col = TextNormalizer.CLEAN_COLUMNS[table_name]
+    df = generic_db.read_query(f'SELECT {id_col}, {clean_col} FROM {table_name} ORDER BY created_utc, {id_col};')
+    duplicates_df = NearDuplicateIndex(threshold=threshold).deduplicate_frame(df, id_col=id_col, text_col=clean_col)
+    n_clusters = duplicates_df['canonical_id'].nunique()
+    print(f'{len(duplicates_df)} {table_name}, {n_clusters} clusters, '
+          f'duplicate rate {1 - n_clusters / max(len(duplicates_df), 1):.1%}')
+    canonical_df = duplicates_df[duplicates_df['document_id'] == duplicates_df['canonical_id']]
+    texts = df.set_index(id_col)[clean_col]
+    largest_df = canonical_df[canonical_df['cluster_size'] > 1].nlargest(top, 'cluster_size')
+    for canonical_id, cluster_size in zip(largest_df['canonical_id'], largest_df['cluster_size']):
+        print(f'{cluster_size:>6}  {canonical_id}  {str(texts[canonical_id])[:100]}')
+
+
+def main():
+    from generic_db import GenericDBOperations
+
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument('--db-config', default=None, help='Path of the db config')
+    arg_parser.add_argument('--table', choices=['submissions', 'comments'], default='submissions',
+                            help='The table whose cleaned texts are compared')
+    arg_parser.add_argument('--threshold', type=float, default=0.8, help='Minimum similarity of near-duplicates')
+    arg_parser.add_argument('--top', type=int, default=10, help='Number of largest clusters printed')
+    args = arg_parser.parse_args()
+
+    print_duplicates(GenericDBOperations(path=args.db_config), args.table, threshold=args.threshold, top=args.top)
+
+
+if __name__ == '__main__':
+    main()
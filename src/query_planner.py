@@ -0,0 +1,185 @@
+"""
+Prints the searches a crawl runs per subreddit for the keywords of config/keywords.yml.
+
+Usage: python query_planner.py --keywords config/keywords.yml
+"""
+import argparse
+import re
+from collections import namedtuple
+
+import yaml
+
+# One search listing of a subreddit: the query, its terms (each a tuple of title words which must all occur), the keywords
+# it covers, the sort of the listing and how many times it was split already
+PlannedSearch = namedtuple('PlannedSearch', ['query', 'terms', 'keywords', 'sort', 'depth'])
+
+_WORD = re.compile(r'\w+')
+
+
+def keyword_term(keyword: str) -> tuple:
+    """
+    :param keyword: A keyword of config/keywords.yml, e.g. climate change AND heat.
+    :return: The lower case title words its search requires, e.g. ('climate', 'change', 'heat').
+    """
+    return tuple(dict.fromkeys(word.lower() for word in keyword.replace('AND ', '').split()))
+
+
+def keyword_parts(keyword: str) -> list:
+    """
+    :param keyword: A keyword of config/keywords.yml, e.g. climate change AND heat.
+    :return: The lower case parts of its AND group, all of which a text must contain, e.g. ['climate change', 'heat'].
+    """
+    return [part.strip().lower() for part in keyword.split(' AND ')]
+
+
+def term_query(term: tuple) -> str:
+    """
+    :param term: A tuple of title words.
+    :return: The search query matching the titles containing all of them, e.g. title:heat AND title:dome.
+    """
+    return ' AND '.join(f'title:{word}' for word in term)
+
+
+def or_query(terms: list) -> str:
+    """
+    :param terms: A list of terms.
+    :return: The search query matching the titles matching any of the terms.
+    """
+    if len(terms) == 1:
+        return term_query(terms[0])
+    return ' OR '.join(term_query(term) if len(term) == 1 else f'({term_query(term)})' for term in terms)
+
+
+def title_words(title) -> frozenset:
+    """
+    :param title: A submission title.
+    :return: Its lower case words, which the title: search terms match.
+    """
+    return frozenset(_WORD.findall(title.lower())) if isinstance(title, str) else frozenset()
+
+
+class SearchPlanner:
+    """
+    SearchPlanner turns the keywords into as few search listings per subreddit as it can, instead of one listing per
+    keyword:
+    - A keyword whose words include all the words of another keyword is dropped, as the results of its search are a
+      subset of the results of the other one (title:heat returns every result of title:heat AND title:dome).
+    - The remaining terms are OR-combined into queries of at most max_terms terms (and max_query_length characters).
+    - The results of a query are assigned back to the keywords locally: a keyword gets the results whose title contains
+      all of its words, or all the parts of its AND group like the keyword matcher does (heat in heatwave). Reddit also
+      matches titles neither check sees (e.g. stemmed words), such a result is kept under the keywords the query
+      searched directly, like the search of that keyword alone would have kept it.
+    Reddit returns at most result_cap results per listing. A listing reaching the cap is split: an OR query into two
+    queries with half of its terms, a single term into the same query sorted by each of split_sorts, which reach other
+    parts of the results (Reddit search has no date range, so this is the closest to splitting it into time windows).
+    Every sort of a query returns the same capped number of results, so the sorts cannot tell whether they covered the
+    results of the narrower keywords of the term (title:heat reaching the cap may have missed heat dome results): these
+    are planned again as searches of their own when the term is split. A single term still reaching the cap with every
+    sort is reported as truncated.
+    """
+
+    def __init__(self, keywords: list, max_terms=10, max_query_length=512, result_cap=250,
+                 split_sorts=('new', 'top', 'comments')):
+        self.keywords = list(keywords)
+        self.max_terms = max_terms
+        self.max_query_length = max_query_length
+        self.result_cap = result_cap
+        self.split_sorts = list(split_sorts)
+        self.keyword_terms = {keyword: keyword_term(keyword) for keyword in self.keywords}
+        self.keyword_parts = {keyword: keyword_parts(keyword) for keyword in self.keywords}
+
+    @classmethod
+    def from_config(cls, keywords: list, crawler_config: dict) -> 'SearchPlanner':
+        return cls(keywords,
+                   max_terms=crawler_config.get('search_max_terms', 10),
+                   max_query_length=crawler_config.get('search_max_query_length', 512),
+                   result_cap=crawler_config.get('search_result_cap', 250),
+                   split_sorts=crawler_config.get('search_split_sorts', ['new', 'top', 'comments']))
+
+    def minimal_terms(self, keywords: list) -> list:
+        """
+        :param keywords: The keywords to search.
+        :return: The terms of the keywords not covered by a broader keyword, in the keywords order.
+        """
+        terms = list(dict.fromkeys(self.keyword_terms[keyword] for keyword in keywords))
+        return [term for term in terms
+                if not any(other != term and set(other) <= set(term) for other in terms)]
+
+    def _covered_keywords(self, terms: list, keywords: list) -> list:
+        return [keyword for keyword in keywords if any(set(term) <= set(self.keyword_terms[keyword]) for term in terms)]
+
+    def _search(self, terms: list, keywords: list, sort='relevance', depth=0) -> PlannedSearch:
+        return PlannedSearch(query=or_query(terms), terms=tuple(terms), keywords=tuple(keywords), sort=sort, depth=depth)
+
+    def plan(self, keywords: list = None) -> list:
+        """
+        :param keywords: The keywords to search, all of them by default.
+        :return: The list of the searches covering the keywords.
+        """
+        keywords = self.keywords if keywords is None else [k for k in self.keywords if k in set(keywords)]
+        return self._plan(keywords)
+
+    def _plan(self, keywords: list, depth=0) -> list:
+        groups = []
+        for term in self.minimal_terms(keywords):
+            if groups and len(groups[-1]) < self.max_terms and \
+                    len(or_query(groups[-1] + [term])) <= self.max_query_length:
+                groups[-1].append(term)
+            else:
+                groups.append([term])
+        return [self._search(terms, self._covered_keywords(terms, keywords), depth=depth) for terms in groups]
+
+    def is_truncated(self, result_count: int) -> bool:
+        """
+        :param result_count: The number of results a listing returned.
+        :return: Whether or not the listing reached the cap, i.e. may have more results than it returned.
+        """
+        return result_count >= self.result_cap
+
+    def split(self, search: PlannedSearch) -> list:
+        """
+        :param search: A search whose listing reached the cap.
+        :return: The searches to run instead, an empty list if it cannot be split anymore.
+        """
+        if len(search.terms) > 1:
+            half = len(search.terms) // 2
+            return [self._search(list(terms), self._covered_keywords(terms, search.keywords), depth=search.depth + 1)
+                    for terms in [search.terms[:half], search.terms[half:]]]
+        if search.sort == 'relevance':
+            narrower = [keyword for keyword in search.keywords if self.keyword_terms[keyword] != search.terms[0]]
+            return [self._search(list(search.terms), search.keywords, sort=sort, depth=search.depth + 1)
+                    for sort in self.split_sorts] + self._plan(narrower, depth=search.depth + 1)
+        return []
+
+    def assign(self, title, search: PlannedSearch) -> list:
+        """
+        :param title: The title of a result of the search.
+        :param search: The search.
+        :return: The keywords of the search matching the title, in the keywords order, or the keywords the search
+        searched directly if none of them matches.
+        """
+        words = title_words(title)
+        text = title.lower() if isinstance(title, str) else ''
+        assigned = [keyword for keyword in search.keywords
+                    if words.issuperset(self.keyword_terms[keyword])
+                    or all(part in text for part in self.keyword_parts[keyword])]
+        return assigned or [keyword for keyword in search.keywords if self.keyword_terms[keyword] in search.terms]
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument('--keywords', default='config/keywords.yml', help='Path of the keywords config')
+    arg_parser.add_argument('--max-terms', type=int, default=10, help='Maximum number of OR-combined terms per query')
+    args = arg_parser.parse_args()
+
+    with open(args.keywords) as config_stream:
+        keywords = yaml.full_load(config_stream)['keywords']
+    searches = SearchPlanner(keywords, max_terms=args.max_terms).plan()
+    print(f'{len(keywords)} keywords -> {len(searches)} searches per subreddit')
+    for search in searches:
+        print(search.query)
+        print('  covers:', ', '.join(search.keywords))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,8 @@
+import contextlib
 import json
 import os
 import time
 import praw
-import datetime
-from datetime import datetime
 from praw.models import MoreComments
 
 import dotenv
@@ -12,109 +11,142 @@ import requests
 import yaml
 from dateutil import parser
 
+from crawl_scheduler import CrawlScheduler, InstrumentedRequestor
+from crawl_state import CrawlStateStore
+from db_writer import BackgroundWriter
 from generic_db import GenericDBOperations
+from keyword_matcher import KeywordHits, KeywordMatcher
+from keyword_rollups import KeywordRollups
+from metrics import METRICS, SamplingProfiler
+from model_extractor import COMMENT_COLUMNS, SUBMISSION_COLUMNS, SUBREDDIT_COLUMNS, extract_frame
+from query_planner import PlannedSearch, SearchPlanner
+from redditor_resolver import RedditorResolver
+from submission_registry import SubmissionRegistry
+from text_normalizer import TextNormalizer
 
 pd.set_option('display.expand_frame_repr', False)
 
 
+def load_env(config_dir='config'):
+    """
+    Loads the .env file of the directory of the config directory (src by default, where the crawler always read it from),
+    whatever the working directory is.
+    :param config_dir: The config directory.
+    """
+    dotenv_file = os.path.join(os.path.dirname(os.path.abspath(config_dir)), '.env')
+    if os.path.isfile(dotenv_file):
+        dotenv.load_dotenv(dotenv_file)
+
+
+def load_credentials(env_prefix='') -> dict:
+    # Additional OAuth apps are configured with prefixed environment variables, e.g. app2_client_id
+    return {
+        'client_id': os.environ[f'{env_prefix}client_id'],
+        'client_secret': os.environ[f'{env_prefix}client_secret'],
+        'username': os.environ[f'{env_prefix}username'],
+        'password': os.environ[f'{env_prefix}password'],
+        'user_agent': os.environ[f'{env_prefix}user_agent'],
+    }
+
+
+def create_reddit(env_prefix='', **reddit_kwargs) -> praw.Reddit:
+    """
+    :param env_prefix: The prefix of the environment variables of the credentials of the OAuth app.
+    :param reddit_kwargs: Passed to praw.Reddit, e.g. the requestor of the offline stand-in of reddit_standin.
+    :return: A praw instance, whose requests are counted in the metrics.
+    """
+    reddit = praw.Reddit(**load_credentials(env_prefix=env_prefix),
+                         **{'requestor_class': InstrumentedRequestor, **reddit_kwargs})
+    assert isinstance(reddit, praw.Reddit)
+    return reddit
+
+
+def register_subreddits(generic_db: GenericDBOperations, config_dir: str, get_reddit) -> tuple:
+    """
+    Registers the subreddits of subreddits.yml missing from the subreddits table. The registered subreddits are looked up
+    in one query, the missing ones are fetched in batched info requests (100 subreddits per request) and inserted
+    together.
+    :param generic_db: The GenericDBOperations of the database.
+    :param config_dir: The directory of subreddits.yml.
+    :param get_reddit: A function returning the praw instance to fetch the missing subreddits with, only called if any
+    subreddit is missing.
+    :return: A two-tuple of the number of inserted and skipped subreddits.
+    """
+    with open(os.path.join(config_dir, 'subreddits.yml')) as config_stream:
+        subreddits = yaml.full_load(config_stream)['subreddits']
+
+    registered = generic_db.lookup_table_col_in(table='subreddits', fetch_cols=['display_name'],
+                                                lookup_col='display_name', lookup_values=subreddits, fetch_all=True)
+    registered = set() if generic_db.check_db_result_sanity(registered) else {r[0] for r in registered}
+    missing = [sub_name for sub_name in subreddits if sub_name not in registered]
+    print(f'Subreddits: {len(registered)} already registered, {len(missing)} to register.')
+    if not missing:
+        return 0, 0
+
+    subreddit_instances = list(get_reddit().info(subreddits=missing))
+    not_found = {m.lower() for m in missing} - {s.display_name.lower() for s in subreddit_instances}
+    if not_found:
+        print('ERROR: Cannot fetch subreddits')
+        print(sorted(not_found))
+    subreddits_df = extract_frame(reddit_models=subreddit_instances, columns=SUBREDDIT_COLUMNS)
+    inserted, skipped = generic_db.bulk_insert_into_table(table_name='subreddits', data=subreddits_df,
+                                                          id_col='subreddit_id')
+    print(f'Registered subreddits: {inserted} inserted, {skipped} skipped')
+    return inserted, skipped
+
+
 class RedditLookup:
-    def __init__(self):
-        self._load_env()
-        self._load_reddit()
+    def __init__(self, reddit_kwargs: dict = None, db_config_path=None, config_dir='config'):
+        # reddit_kwargs are passed to every praw.Reddit instance, e.g. to plug in the offline stand-in of reddit_standin
+        self.reddit_kwargs = reddit_kwargs or {}
+        # The directory of keywords.yml, subreddits.yml and crawler.yml
+        self.config_dir = config_dir
+        self._reddit = None
+        # The writer of the running crawl, see write()
+        self.db_writer = None
+        load_env(self.config_dir)
         self._load_search_keywords()
-        self.generic_db = GenericDBOperations()
-        self._register_subreddits()
+        self._load_crawler_config()
+        self.generic_db = GenericDBOperations(path=db_config_path)
+        self.crawl_state = CrawlStateStore(self.generic_db)
+        self.submission_registry = SubmissionRegistry(self.generic_db)
+        self.redditor_resolver = RedditorResolver(
+            self.generic_db, fetch_profiles=self.crawler_config.get('fetch_redditor_profiles', True))
+        self.text_normalizer = TextNormalizer(self.generic_db)
+        self.keyword_rollups = KeywordRollups(self.generic_db)
+        self.keyword_hits = KeywordHits(self.generic_db, self.keyword_matcher)
+        register_subreddits(self.generic_db, self.config_dir, get_reddit=lambda: self.reddit)
         self._load_subreddits()
         self.results_so_far = 0
 
-    @staticmethod
-    def _load_env():
-        dotenv_file = os.path.join(os.getcwd(), '.env')
-        if os.path.isfile(dotenv_file):
-            dotenv.load_dotenv(dotenv_file)
-
-    def _load_credentials(self):
-        return {
-            'client_id': os.environ['client_id'],
-            'client_secret': os.environ['client_secret'],
-            'username': os.environ['username'],
-            'password': os.environ['password'],
-            'user_agent': os.environ['user_agent'],
-        }
-
-    def _load_reddit(self):
-        creds = self._load_credentials()
-        self.reddit = praw.Reddit(**creds)
-        assert isinstance(self.reddit, praw.Reddit)
+    @property
+    def reddit(self) -> praw.Reddit:
+        # Created on first use, so a lookup which never talks to Reddit (e.g. all the subreddits are registered already
+        # and nothing is crawled) does not authenticate
+        if self._reddit is None:
+            self._reddit = self.create_reddit()
+        return self._reddit
+
+    def create_reddit(self, env_prefix='', **reddit_kwargs) -> praw.Reddit:
+        kwargs = {**self.reddit_kwargs, **reddit_kwargs}
+        kwargs['requestor_kwargs'] = {**self.reddit_kwargs.get('requestor_kwargs', {}),
+                                      **reddit_kwargs.get('requestor_kwargs', {})}
+        return create_reddit(env_prefix=env_prefix, **kwargs)
 
     def _load_search_keywords(self):
-        with open('config/keywords.yml') as config_stream:
+        with open(os.path.join(self.config_dir, 'keywords.yml')) as config_stream:
             self.search_keywords = yaml.full_load(config_stream)['keywords']
+        # All the keywords are matched against the crawled texts at once, see KeywordMatcher
+        self.keyword_matcher = KeywordMatcher(self.search_keywords)
         print('Search Keywords:')
         print(self.search_keywords)
 
-    @staticmethod
-    def _create_subreddit_df(subreddit_instance: praw.models.Subreddit):
-        subreddit_df = {}
-        try:
-            subreddit_df['subreddit_id'] = [subreddit_instance.fullname]
-        except:
-            try:
-                subreddit_df['subreddit_id'] = [subreddit_instance.name]
-            except:
-                subreddit_df['subreddit_id'] = [subreddit_instance.id]
-
-        try:
-            subreddit_df['display_name'] = [subreddit_instance.display_name]
-        except:
-            subreddit_df['display_name'] = [None]
-
-        try:
-            subreddit_df['description'] = [subreddit_instance.public_description]
-        except:
-            subreddit_df['description'] = [None]
-
-        try:
-            subreddit_df['subscribers'] = [subreddit_instance.subscribers]
-        except:
-            subreddit_df['subscribers'] = [None]
-
-        try:
-            subreddit_df['over18'] = [subreddit_instance.over18]
-        except:
-            subreddit_df['over18'] = [None]
-
-        try:
-            subreddit_df['created_utc'] = [subreddit_instance.created_utc]
-        except:
-            subreddit_df['created_utc'] = [None]
-
-        try:
-            created_at = datetime.fromtimestamp(subreddit_instance.created_utc)
-            subreddit_df['created_at'] = [created_at]
-        except:
-            subreddit_df['created_at'] = [None]
-
-        subreddit_df = pd.DataFrame.from_dict(data=subreddit_df)
-        return subreddit_df
-
-    def _register_subreddits(self):
-        with open('config/subreddits.yml') as config_stream:
-            subreddits = yaml.full_load(config_stream)['subreddits']
-
-        for sub_name in subreddits:
-            fetched_sub = self.generic_db.lookup_table(table='subreddits', fetch_cols=['subreddit_id'],
-                                                       lookup_cols=['display_name'], lookup_values=[sub_name],
-                                                       fetch_one=True)
-            # If the subreddit is not already registered, then register it to DB
-            if self.generic_db.check_db_result_sanity(fetched_sub):
-                subreddit_instance = self.reddit.subreddit(sub_name)
-                assert isinstance(subreddit_instance, praw.models.Subreddit)
-                subreddit_to_insert = self._create_subreddit_df(subreddit_instance)
-                self.generic_db.insert_into_table(table_name='subreddits', data=subreddit_to_insert,
-                                                  id_col='subreddit_id')
-            else:
-                print(f'Subreddit {sub_name} already registered.')
+    def _load_crawler_config(self):
+        self.crawler_config = {}
+        crawler_config_path = os.path.join(self.config_dir, 'crawler.yml')
+        if os.path.isfile(crawler_config_path):
+            with open(crawler_config_path) as config_stream:
+                self.crawler_config = yaml.full_load(config_stream)['crawler']
 
     def _load_subreddits(self):
         subreddit_cols = self.generic_db.get_columns_of_table(table_name='subreddits')
@@ -128,9 +160,9 @@ class RedditLookup:
         print(all_subs)
 
     @staticmethod
-    def search_subreddit(query: str, subreddit_instance: praw.models.Subreddit, time_filter='year'):
-        submissions_generator = subreddit_instance.search(query=query, time_filter=time_filter)
-        submissions = []
+    def iter_search_results(query: str, subreddit_instance: praw.models.Subreddit, time_filter='year', sort='relevance'):
+        # The listing is fetched page by page while it is consumed
+        submissions_generator = subreddit_instance.search(query=query, sort=sort, time_filter=time_filter, limit=None)
 
         for s in submissions_generator:
             if not isinstance(s, praw.models.Submission):
@@ -138,9 +170,23 @@ class RedditLookup:
                 print(query)
                 print(subreddit_instance.display_name)
                 continue
-            submissions.append(s)
+            yield s
+
+    @staticmethod
+    def search_subreddit(query: str, subreddit_instance: praw.models.Subreddit, time_filter='year', sort='relevance'):
+        return list(RedditLookup.iter_search_results(query=query, subreddit_instance=subreddit_instance,
+                                                     time_filter=time_filter, sort=sort))
 
-        return submissions
+    @staticmethod
+    def iter_batches(iterable, batch_size: int):
+        batch = []
+        for item in iterable:
+            batch.append(item)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
 
     @staticmethod
     def get_reddit_model_id(reddit_model: praw.models.Submission | praw.models.Redditor | praw.models.Comment):
@@ -153,368 +199,337 @@ class RedditLookup:
                 reddit_model_id = reddit_model.id
         return reddit_model_id
 
-    def _create_submissions_df(self, submissions, authors, keywords, has_exact_keyword, subreddit_id):
-        submissions_df = {
-            'submission_id': [],
-            'author': authors,
-            'subreddit': [subreddit_id] * len(submissions),
-            'keyword': keywords,
-            'has_exact_keyword': has_exact_keyword,
-            'title': [],
-            'score': [],
-            'selftext': [],
-            'upvote_ratio': [],
-            'num_comments': [],
-            'url': [],
-            'permalink': [],
-            'author_flair_text': [],
-            'link_flair_text': [],
-            'distinguished': [],
-            'is_self': [],
-            'locked': [],
-            'over_18': [],
-            'created_at': [],
-            'created_utc': [],
-        }
-        for submission in submissions:
-            try:
-                submission_id = self.get_reddit_model_id(reddit_model=submission)
-                submissions_df['submission_id'].append(submission_id)
-            except:
-                print('THIS SHOULD NOT HAPPEN 1')
-                submissions_df['submission_id'].append(None)
-            try:
-                submissions_df['title'].append(submission.title)
-            except:
-                submissions_df['title'].append(None)
-            try:
-                submissions_df['score'].append(submission.score)
-            except:
-                submissions_df['score'].append(None)
-            try:
-                submissions_df['selftext'].append(submission.selftext)
-            except:
-                submissions_df['selftext'].append(None)
-            try:
-                submissions_df['upvote_ratio'].append(submission.upvote_ratio)
-            except:
-                submissions_df['upvote_ratio'].append(None)
-            try:
-                submissions_df['num_comments'].append(submission.num_comments)
-            except:
-                submissions_df['num_comments'].append(None)
-            try:
-                submissions_df['url'].append(submission.url)
-            except:
-                submissions_df['url'].append(None)
-            try:
-                submissions_df['permalink'].append(submission.permalink)
-            except:
-                submissions_df['permalink'].append(None)
-            try:
-                submissions_df['author_flair_text'].append(submission.author_flair_text)
-            except:
-                submissions_df['author_flair_text'].append(None)
-            try:
-                submissions_df['link_flair_text'].append(submission.link_flair_text)
-            except:
-                submissions_df['link_flair_text'].append(None)
-            try:
-                submissions_df['distinguished'].append(submission.distinguished)
-            except:
-                submissions_df['distinguished'].append(None)
-            try:
-                submissions_df['is_self'].append(submission.is_self)
-            except:
-                submissions_df['is_self'].append(None)
-            try:
-                submissions_df['locked'].append(submission.locked)
-            except:
-                submissions_df['locked'].append(None)
-            try:
-                submissions_df['over_18'].append(submission.over_18)
-            except:
-                submissions_df['over_18'].append(None)
-            try:
-                submissions_df['created_utc'].append(submission.created_utc)
-            except:
-                submissions_df['created_utc'].append(None)
-            try:
-                created_at = datetime.fromtimestamp(submission.created_utc)
-                submissions_df['created_at'].append(created_at)
-            except:
-                submissions_df['created_at'].append(None)
-
-        submissions_df = pd.DataFrame.from_dict(data=submissions_df)
-        return submissions_df
-
-    # column_names exclude id column and created_at column
-    def _create_df_from_reddit_models(self, reddit_models: list, column_names: list, reddit_property_names: list,
-                                      id_col_name: str):
-        assert len(column_names) == len(reddit_property_names)
-        reddit_models_df = {
-            col: [] for col in column_names
-        }
-        for rm in reddit_models:
-            try:
-                id_col = self.get_reddit_model_id(reddit_model=rm)
-                reddit_models_df[id_col_name].append(id_col)
-            except Exception as e:
-                print('Cannot retrieve ID from model:', rm, id_col_name)
-                print(e)
-                reddit_models_df[id_col_name].append(None)
-            for i in range(len(column_names)):
-                cn = column_names[i]
-                rpn = reddit_property_names[i]
-                try:
-                    reddit_models_df[cn].append(rm.__getattribute__(rpn))
-                except:
-                    reddit_models_df[cn].append(None)
-            try:
-                created_at = datetime.fromtimestamp(rm.created_utc)
-                reddit_models_df['created_at'].append(created_at)
-            except:
-                reddit_models_df['created_at'].append(None)
-
-        return reddit_models_df
-
-    def _create_authors_df(self, authors):
-        authors_df = {
-            'redditor_id': [],
-            'username': [],
-            'link_karma': [],
-            'comment_karma': [],
-            'icon_img': [],
-            'has_verified_email': [],
-            'is_employee': [],
-            'is_mod': [],
-            'is_gold': [],
-            'is_suspended': [],
-            'created_at': [],
-            'created_utc': [],
-        }
-        for author in authors:
-            try:
-                author_id = self.get_reddit_model_id(reddit_model=author)
-                authors_df['redditor_id'].append(author_id)
-            except:
-                print('THIS SHOULD NOT HAPPEN 2')
-                authors_df['redditor_id'].append(None)
-            try:
-                authors_df['username'].append(author.name)
-            except:
-                authors_df['username'].append(None)
-            try:
-                authors_df['link_karma'].append(author.link_karma)
-            except:
-                authors_df['link_karma'].append(None)
-            try:
-                authors_df['comment_karma'].append(author.comment_karma)
-            except:
-                authors_df['comment_karma'].append(None)
-            try:
-                authors_df['icon_img'].append(author.icon_img)
-            except:
-                authors_df['icon_img'].append(None)
-            try:
-                authors_df['has_verified_email'].append(author.has_verified_email)
-            except:
-                authors_df['has_verified_email'].append(None)
-            try:
-                authors_df['is_employee'].append(author.is_employee)
-            except:
-                authors_df['is_employee'].append(None)
-            try:
-                authors_df['is_mod'].append(author.is_mod)
-            except:
-                authors_df['is_mod'].append(None)
-            try:
-                authors_df['is_gold'].append(author.is_gold)
-            except:
-                authors_df['is_gold'].append(None)
-            try:
-                authors_df['is_suspended'].append(author.is_suspended)
-            except:
-                authors_df['is_suspended'].append(None)
-            try:
-                authors_df['created_utc'].append(author.created_utc)
-            except:
-                authors_df['created_utc'].append(None)
-            try:
-                created_at = datetime.fromtimestamp(author.created_utc)
-                authors_df['created_at'].append(created_at)
-            except:
-                authors_df['created_at'].append(None)
-
-        authors_df = pd.DataFrame.from_dict(data=authors_df)
-        return authors_df
-
-    def _create_comments_df(self, comments: list, submission_ids: list, subreddit_id: str):
-        comments_df = {
-            'comment_id': [],
-            'author': [],
-            'submission': submission_ids,
-            'subreddit': [subreddit_id] * len(submission_ids),
-            'body': [],
-            'score': [],
-            'distinguished': [],
-            'is_submitter': [],
-            'parent_id': [],
-            'permalink': [],
-            'created_at': [],
-            'created_utc': [],
-        }
-        for comment in comments:
-            try:
-                comment_id = self.get_reddit_model_id(reddit_model=comment)
-                comments_df['comment_id'].append(comment_id)
-            except:
-                print('THIS SHOULD NOT HAPPEN 3')
-                comments_df['comment_id'].append(None)
-            try:
-                author_id = self.get_reddit_model_id(comment.author)
-                comments_df['author'].append(author_id)
-            except:
-                print('THIS SHOULD NOT HAPPEN 4')
-                comments_df['author'].append(None)
-            try:
-                comments_df['body'].append(comment.body)
-            except:
-                comments_df['body'].append(None)
-            try:
-                comments_df['score'].append(comment.score)
-            except:
-                comments_df['score'].append(None)
-            try:
-                comments_df['distinguished'].append(comment.distinguished)
-            except:
-                comments_df['distinguished'].append(None)
-            try:
-                comments_df['is_submitter'].append(comment.is_submitter)
-            except:
-                comments_df['is_submitter'].append(None)
-            try:
-                comments_df['parent_id'].append(comment.parent_id)
-            except:
-                comments_df['parent_id'].append(None)
-            try:
-                comments_df['permalink'].append(comment.permalink)
-            except:
-                comments_df['permalink'].append(None)
-            try:
-                comments_df['created_utc'].append(comment.created_utc)
-            except:
-                comments_df['created_utc'].append(None)
-            try:
-                created_at = datetime.fromtimestamp(comment.created_utc)
-                comments_df['created_at'].append(created_at)
-            except:
-                comments_df['created_at'].append(None)
-
-        comments_df = pd.DataFrame.from_dict(data=comments_df)
-        return comments_df
-
-    def perform_query(self, query: str, keyword: str, keyword_parts: list, subreddit_instance: praw.models.Subreddit):
-        # Returns list of praw.models.Submission instances
-        fetched_submissions = self.search_subreddit(query=query, subreddit_instance=subreddit_instance)
+    def create_search_planner(self) -> SearchPlanner:
+        return SearchPlanner.from_config(self.search_keywords, self.crawler_config)
 
-        # Before registering submissions, we need to register authors
-        authors = []  # List of author instances
-        keywords = [keyword] * len(fetched_submissions)
-        has_exact_keyword = []
-        for fs in fetched_submissions:
-            try:
-                author_instance = fs.author
-                authors.append(author_instance)
-            except Exception as e:
-                print('Cannot get author from submission', fs.id)
-                print(e)
-                authors.append(None)
-            try:
-                for kp in keyword_parts:
-                    if kp.lower() not in fs.title.lower():
-                        has_exact_keyword.append(False)
-                        break
-                else:
-                    has_exact_keyword.append(True)
-            except:
-                has_exact_keyword.append(None)
-
-        assert len(authors) == len(fetched_submissions)
-
-        # authors_df = self._create_authors_df(authors)
-        column_names = ['username', 'link_karma', 'comment_karma', 'icon_img', 'has_verified_email', 'is_employee',
-                        'is_mod', 'is_gold', 'is_suspended', 'created_utc']
-        reddit_property_names = column_names.copy()
-        reddit_property_names[0] = 'name'
-        authors_df = self._create_df_from_reddit_models(reddit_models=authors,
-                                                        column_names=column_names,
-                                                        reddit_property_names=reddit_property_names,
-                                                        id_col_name='redditor_id')
+    @staticmethod
+    def get_subreddit_id(subreddit_instance: praw.models.Subreddit):
         try:
             subreddit_id = subreddit_instance.fullname
         except:
             subreddit_id = subreddit_instance.name
+        return subreddit_id
+
+    def assign_search_results(self, fetched_submissions: list, search: PlannedSearch, planner: SearchPlanner,
+                              seen: dict, seen_lock=None) -> tuple:
+        """
+        Given a batch of results of a planned search, this method assigns every result to the keywords of the search
+        it belongs to (see SearchPlanner.assign), and drops the results already assigned to all of these keywords by the
+        search (or by the searches split from the same search).
+        :param seen: The keywords assigned so far to each submission id, updated in place.
+        :param seen_lock: The lock guarding seen when the split searches run concurrently (see CrawlScheduler), so a
+        result is assigned to a keyword by only one of them.
+        :return: A two-tuple of the kept submissions and the list of the newly assigned keywords of each of them.
+        """
+        kept, keywords = [], []
+        with seen_lock or contextlib.nullcontext():
+            for fs in fetched_submissions:
+                known = seen.setdefault(self.get_reddit_model_id(fs), set())
+                assigned = [keyword for keyword in planner.assign(getattr(fs, 'title', None), search)
+                            if keyword not in known]
+                if not assigned:
+                    continue
+                known.update(assigned)
+                kept.append(fs)
+                keywords.append(assigned)
+        return kept, keywords
+
+    def create_submission_frames(self, fetched_submissions: list, keywords: list, subreddit_id: str,
+                                 reddit: praw.Reddit):
+        # keywords holds the keywords of every submission, the first one is the keyword of the submissions table and all
+        # of them are recorded in submission_keywords
+        # Before registering submissions, we need to register authors
+        authors = [self.redditor_resolver.get_author_fullname(fs) for fs in fetched_submissions]  # Author fullnames
+
+        # Only the authors not registered yet are resolved, in batches
+        authors_df = self.redditor_resolver.resolve(reddit=reddit, author_fullnames=authors)
+
+        with METRICS.timer('frame_build_seconds', table='submissions'):
+            submissions_df = extract_frame(reddit_models=fetched_submissions,
+                                           columns=SUBMISSION_COLUMNS,
+                                           extra_columns={'author': authors,
+                                                          'subreddit': subreddit_id,
+                                                          'keyword': [k[0] for k in keywords],
+                                                          'has_exact_keyword': None})
+        # The titles and selftexts are tagged with every keyword they contain in one pass, the title hits of a keyword
+        # tell whether the submission really contains it
+        with METRICS.timer('keyword_tagging_seconds', table='submissions'):
+            hits_df = self.keyword_hits.tag_frame(submissions_df, table_name='submissions')
+        submissions_df['has_exact_keyword'] = self.keyword_hits.has_exact_keyword(submissions_df, hits_df)
+        counts = [len(k) for k in keywords]
+        matches_df = pd.DataFrame({'submission_id': submissions_df['submission_id'].repeat(counts).tolist(),
+                                   'keyword': [keyword for k in keywords for keyword in k],
+                                   'title': submissions_df['title'].repeat(counts).tolist()})
+        matches_df['has_exact_keyword'] = self.keyword_hits.has_exact_keyword(matches_df, hits_df)
+        return authors_df, submissions_df, matches_df.drop(columns='title'), hits_df
 
-        submissions_df = self._create_submissions_df(submissions=fetched_submissions,
-                                                     authors=authors_df['redditor_id'].tolist(),
-                                                     keywords=keywords,
-                                                     has_exact_keyword=has_exact_keyword,
-                                                     subreddit_id=subreddit_id)
-        assert authors_df.shape[0] == submissions_df.shape[0]
-
-        all_comments = []
-        comment_submissions = []
-        for fs in fetched_submissions:
-            try:
-                fs.comments.replace_more(limit=None)
-                for c in fs.comments.list():
-                    all_comments.append(c)
-                    comment_submissions.append(self.get_reddit_model_id(fs))
-            except Exception as e:
-                print('ERROR: Cannot replace more comments')
-                print(fs.fullname)
-                continue
-
-        assert len(all_comments) == len(comment_submissions)
-        comments_df = self._create_comments_df(comments=all_comments, submission_ids=comment_submissions,
-                                               subreddit_id=subreddit_id)
+    @staticmethod
+    def create_comments_frame(comments: list, submission_ids: list, subreddit_id: str):
+        with METRICS.timer('frame_build_seconds', table='comments'):
+            return extract_frame(reddit_models=comments,
+                                 columns=COMMENT_COLUMNS,
+                                 extra_columns={'submission': submission_ids, 'subreddit': subreddit_id})
 
-        return authors_df, submissions_df, comments_df
+    @staticmethod
+    def expand_submission_comments(submission: praw.models.Submission):
+        # None (not an empty list) when the comment tree cannot be fetched, so the failure is not recorded as an expansion
+        try:
+            # The first access fetches the comment tree, replace_more then fetches the collapsed comments
+            with METRICS.timer('comment_tree_fetch_seconds'):
+                comment_forest = submission.comments
+            with METRICS.timer('replace_more_seconds'):
+                comment_forest.replace_more(limit=None)
+            comments = comment_forest.list()
+            METRICS.inc('comment_trees_expanded_total')
+            METRICS.inc('comments_expanded_total', len(comments))
+            return comments
+        except Exception as e:
+            METRICS.inc('comment_tree_errors_total')
+            print('ERROR: Cannot replace more comments')
+            print(submission.fullname)
+            print(e)
+            return None
 
-    def register_reddit_model(self, df: pd.DataFrame, table_name: str, id_col: str):
-        # Register one-by-one in case there are any duplicates (same author appears in multiple results)
-        for i in range(df.shape[0]):
-            row_df = df.iloc[i: i + 1, :]
-            try:
-                self.generic_db.insert_into_table(table_name=table_name, data=row_df, id_col=id_col)
-            except:
-                print(f'ERROR: Cannot register {table_name}')
-                print(row_df)
+    def fetch_submission_comments(self, reddit: praw.Reddit, submission_id: str):
+        # A fresh submission instance is expanded, so its comment forest is released as soon as its comments are written
+        # instead of living as long as the search result it came from
+        return self.expand_submission_comments(reddit.submission(id=submission_id))
+
+    def write(self, fn, *args, group=None, **kwargs):
+        """
+        Runs a database write on the background writer of the running crawl (after the writes queued before it in the
+        same group), or right away outside of a crawl.
+        :param fn: The function doing the write.
+        :param group: The group of the write, see BackgroundWriter.
+        """
+        if self.db_writer is None:
+            fn(*args, **kwargs)
+        else:
+            self.db_writer.submit(fn, *args, group=group, **kwargs)
+
+    def register_submission_comments(self, submission_id: str, num_comments: int, comments: list, subreddit_id: str,
+                                     group=None):
+        # A comment tree which could not be fetched is left unrecorded, so the next crawl expands it again
+        if comments is None:
+            return
+        # The frames are built right away, so the praw comments are released before the write is queued
+        batch_size = self.crawler_config.get('comment_batch_size', 1000)
+        comments_dfs = [self.create_comments_frame(comments=batch, submission_ids=[submission_id] * len(batch),
+                                                   subreddit_id=subreddit_id)
+                        for batch in self.iter_batches(comments, batch_size)]
+        self.write(self.write_submission_comments, submission_id=submission_id, num_comments=num_comments,
+                   comments_dfs=comments_dfs, group=group)
+
+    def write_submission_comments(self, submission_id: str, num_comments: int, comments_dfs: list):
+        # The comments of a submission are committed together with its snapshot, so progress is kept per submission.
+        # The rollups are updated once for all the batches: a single ordered upsert locks the rollup rows in key order,
+        # which one upsert per batch would not across the batches
+        with self.generic_db.transaction():
+            inserted_ids = []
+            for comments_df in comments_dfs:
+                comments_df = self.text_normalizer.normalize_frame(comments_df, table_name='comments')
+                inserted_ids += self.register_reddit_model(df=comments_df, table_name='comments', id_col='comment_id',
+                                                           update_rollups=False)[2]
+                with METRICS.timer('keyword_tagging_seconds', table='comments'):
+                    hits_df = self.keyword_hits.tag_frame(comments_df, table_name='comments')
+                self.keyword_hits.register(hits_df)
+            self.keyword_rollups.update(table_name='comments', inserted_ids=inserted_ids)
+            self.crawl_state.record_expansions([(submission_id, num_comments)])
 
-    def search_for_keywords(self, subreddit_instance: praw.models.Subreddit):
-        assert isinstance(subreddit_instance, praw.models.Subreddit)
-
-        for keyword in self.search_keywords:
-            keys = keyword.replace('AND ', '').split()
-            query = ' AND '.join(f'title:{key}' for key in keys)
-            keyword_parts = keyword.split(' AND ')
-            print('Searching for keyword:', keyword)
-            authors_df, submissions_df, comments_df = self.perform_query(query=query,
-                                                                         keyword=keyword,
-                                                                         keyword_parts=keyword_parts,
-                                                                         subreddit_instance=subreddit_instance)
+    @staticmethod
+    def get_last_created_utc(submissions_df: pd.DataFrame):
+        last_created_utc = submissions_df['created_utc'].max() if not submissions_df.empty else None
+        return None if pd.isna(last_created_utc) else float(last_created_utc)
+
+    def select_submissions_to_expand(self, fetched_submissions: list) -> list:
+        # Only the comment trees that are new or have grown since their last expansion are expanded again, and only once
+        # per run even if the submission matches several keywords
+        snapshots = [(self.get_reddit_model_id(fs), fs.num_comments) for fs in fetched_submissions]
+        changed = [s[0] for s in self.crawl_state.filter_submissions_to_expand(snapshots)]
+        to_expand = set(self.submission_registry.claim(changed))
+        print(f'Expanding {len(to_expand)} of {len(fetched_submissions)} comment trees')
+        return [fs for fs in fetched_submissions if self.get_reddit_model_id(fs) in to_expand]
+
+    def register_search_batch(self, fetched_submissions: list, search: PlannedSearch, planner: SearchPlanner,
+                              seen: dict, subreddit_name: str, subreddit_id: str, reddit: praw.Reddit, run_id: int,
+                              group=None, seen_lock=None) -> list:
+        """
+        Assigns a batch of results of a planned search to its keywords and registers the assigned submissions (through
+        the background writer during a crawl).
+        :return: The registered submissions.
+        """
+        fetched_submissions, keywords = self.assign_search_results(fetched_submissions=fetched_submissions,
+                                                                   search=search, planner=planner, seen=seen,
+                                                                   seen_lock=seen_lock)
+        if not fetched_submissions:
+            return []
+        authors_df, submissions_df, matches_df, hits_df = self.create_submission_frames(
+            fetched_submissions=fetched_submissions,
+            keywords=keywords,
+            subreddit_id=subreddit_id,
+            reddit=reddit)
+        self.write(self.register_submissions, authors_df=authors_df, submissions_df=submissions_df,
+                   matches_df=matches_df, hits_df=hits_df, group=group)
+        self.write(self.crawl_state.mark_step, subreddit=subreddit_name, keywords=search.keywords, run_id=run_id,
+                   step=CrawlStateStore.STEP_SUBMISSIONS, last_created_utc=self.get_last_created_utc(submissions_df),
+                   group=group)
+        return fetched_submissions
+
+    def split_truncated_search(self, search: PlannedSearch, planner: SearchPlanner, result_count: int,
+                               subreddit_name: str) -> list:
+        """
+        :return: The searches to run if the listing of the given search reached the result cap, an empty list otherwise.
+        """
+        if not planner.is_truncated(result_count):
+            return []
+        searches = planner.split(search)
+        if searches:
+            METRICS.inc('searches_split_total')
+            print(f'Search reached {result_count} results, split into {len(searches)} searches: {search.query} '
+                  f'(sort={search.sort}) in {subreddit_name}')
+        else:
+            METRICS.inc('searches_truncated_total')
+            print(f'WARNING: Search truncated at {result_count} results: {search.query} (sort={search.sort}) '
+                  f'in {subreddit_name}')
+        return searches
+
+    def perform_query(self, search: PlannedSearch, planner: SearchPlanner, seen: dict,
+                      subreddit_instance: praw.models.Subreddit, run_id: int, group=None) -> tuple:
+        # Streams search results -> submission batches -> comment batches -> DB, so memory is bounded by the batch sizes
+        # (and the largest comment tree) instead of the number of results
+        search_results = self.iter_search_results(query=search.query, subreddit_instance=subreddit_instance,
+                                                  time_filter=self.crawler_config.get('time_filter', 'year'),
+                                                  sort=search.sort)
+        subreddit_id = self.get_subreddit_id(subreddit_instance)
+        batch_size = self.crawler_config.get('submission_batch_size', 100)
+        result_count = 0
+        submission_count = 0
+
+        for fetched_submissions in self.iter_batches(search_results, batch_size):
+            result_count += len(fetched_submissions)
+            registered = self.register_search_batch(fetched_submissions=fetched_submissions, search=search,
+                                                    planner=planner, seen=seen,
+                                                    subreddit_name=subreddit_instance.display_name,
+                                                    subreddit_id=subreddit_id, reddit=self.reddit, run_id=run_id,
+                                                    group=group)
+            submission_count += len(registered)
+
+            for fs in self.select_submissions_to_expand(registered):
+                comments = self.fetch_submission_comments(reddit=self.reddit, submission_id=fs.id)
+                self.register_submission_comments(submission_id=self.get_reddit_model_id(fs),
+                                                  num_comments=fs.num_comments,
+                                                  comments=comments,
+                                                  subreddit_id=subreddit_id,
+                                                  group=group)
+
+        return result_count, submission_count
+
+    def register_reddit_model(self, df: pd.DataFrame, table_name: str, id_col: str, update_rollups=True):
+        # Duplicates (same author appears in multiple results) are dropped inside the batch and conflicts with already
+        # registered rows are skipped by the DB, row-by-row insertion is only used for batches that fail.
+        # The rollups are updated from the newly inserted rows in the same transaction, unless the caller updates them
+        # from the returned ids itself.
+        with self.generic_db.transaction():
+            inserted, skipped, inserted_ids = self.generic_db.bulk_insert_into_table(table_name=table_name, data=df,
+                                                                                     id_col=id_col, fetch_ids=True)
+            if update_rollups:
+                self.keyword_rollups.update(table_name=table_name, inserted_ids=inserted_ids)
+        print(f'Registered {table_name}: {inserted} inserted, {skipped} skipped')
+        return inserted, skipped, inserted_ids
+
+    def register_submissions(self, authors_df: pd.DataFrame, submissions_df: pd.DataFrame, matches_df: pd.DataFrame,
+                             hits_df: pd.DataFrame):
+        with self.generic_db.transaction():
             self.register_reddit_model(df=authors_df, table_name='redditors', id_col='redditor_id')
+            submissions_df = self.text_normalizer.normalize_frame(submissions_df, table_name='submissions')
             self.register_reddit_model(df=submissions_df, table_name='submissions', id_col='submission_id')
-            self.register_reddit_model(df=comments_df, table_name='comments', id_col='comment_id')
+            # The submissions table only keeps the first matching keyword, every match is kept in submission_keywords
+            _, _, inserted_matches = self.submission_registry.register_keywords(matches_df, fetch_ids=True)
+            self.keyword_rollups.update(table_name='submission_keywords', inserted_ids=inserted_matches)
+            self.keyword_hits.register(hits_df)
+        self.redditor_resolver.mark_registered(authors_df['redditor_id'])
 
-    def search_reddit(self):
-        for i, r in self.all_subs.iterrows():
-            subreddit_name = r['display_name']
-            print('Now searching:', subreddit_name)
-            subreddit_instance = self.reddit.subreddit(subreddit_name)
-            self.search_for_keywords(subreddit_instance=subreddit_instance)
+    def search_for_keywords(self, subreddit_instance: praw.models.Subreddit, run_id: int, done_pairs: set):
+        assert isinstance(subreddit_instance, praw.models.Subreddit)
 
+        keywords = [k for k in self.search_keywords if (subreddit_instance.display_name, k) not in done_pairs]
+        if len(keywords) < len(self.search_keywords):
+            print(f'Already searched in this run: {len(self.search_keywords) - len(keywords)} keywords')
+        planner = self.create_search_planner()
+
+        for root_search in planner.plan(keywords):
+            # The searches a truncated listing is split into share the results seen so far, which are only registered again
+            # for the keywords they were not assigned to yet
+            searches = [root_search]
+            seen = {}
+            group = (subreddit_instance.display_name, root_search.query)
+            while searches:
+                search = searches.pop(0)
+                print('Searching for:', search.query, f'(sort={search.sort})')
+                result_count, submission_count = self.perform_query(search=search, planner=planner, seen=seen,
+                                                                    subreddit_instance=subreddit_instance,
+                                                                    run_id=run_id, group=group)
+                print(f'Search done: {result_count} results, {submission_count} new submissions')
+                searches.extend(self.split_truncated_search(search=search, planner=planner, result_count=result_count,
+                                                            subreddit_name=subreddit_instance.display_name))
+            self.write(self.crawl_state.mark_step, subreddit=subreddit_instance.display_name,
+                       keywords=root_search.keywords, run_id=run_id, step=CrawlStateStore.STEP_DONE, group=group)
+
+    def export_metrics(self):
+        # Without a metrics_path in config/crawler.yml the metrics are only printed
+        print(METRICS.summary())
+        metrics_path = self.crawler_config.get('metrics_path')
+        if metrics_path:
+            METRICS.export(metrics_path, fmt=self.crawler_config.get('metrics_format', 'prometheus'))
+            print('Metrics written to', metrics_path)
 
-rl = RedditLookup()
-rl.search_reddit()
+    def search_reddit(self):
+        # The optional sampling profiler shows where the time not covered by the metrics goes, e.g. DataFrame building
+        profile_interval = self.crawler_config.get('profile_interval', 0)
+        profiler = SamplingProfiler(interval=profile_interval) if profile_interval else None
+        if profiler is not None:
+            profiler.start()
+        try:
+            with METRICS.timer('crawl_seconds'):
+                self.crawl()
+        finally:
+            if profiler is not None:
+                profiler.stop()
+                profiler.write_collapsed(self.crawler_config.get('profile_path', 'metrics/crawl_profile.txt'))
+                for function, share in profiler.top_functions(10):
+                    print(f'{share:>7.1%}  {function}')
+            self.export_metrics()
+
+    def crawl(self):
+        run_id = self.crawl_state.start_run(resume=self.crawler_config.get('resume', True))
+        done_pairs = self.crawl_state.get_done_pairs(run_id)
+        self.submission_registry.reset()
+
+        # The rows are written by background writers while the crawl goes on fetching, the writers are drained before
+        # the crawl returns, also when it raises
+        self.db_writer = BackgroundWriter(num_threads=self.crawler_config.get('writer_threads', 1),
+                                          queue_size=self.crawler_config.get('writer_queue_size', 16))
+        self.db_writer.start()
+        try:
+            if self.crawler_config.get('max_workers', 1) > 1:
+                scheduler = CrawlScheduler(reddit_lookup=self, crawler_config=self.crawler_config)
+                crawled = scheduler.run(run_id=run_id, done_pairs=done_pairs)
+            else:
+                for i, r in self.all_subs.iterrows():
+                    subreddit_name = r['display_name']
+                    print('Now searching:', subreddit_name)
+                    subreddit_instance = self.reddit.subreddit(subreddit_name)
+                    self.search_for_keywords(subreddit_instance=subreddit_instance, run_id=run_id,
+                                             done_pairs=done_pairs)
+                crawled = True
+        finally:
+            written = self.db_writer.close()
+            self.db_writer = None
+
+        if crawled and written:
+            self.crawl_state.finish_run(run_id)
+
+
+if __name__ == '__main__':
+    rl = RedditLookup()
+    rl.search_reddit()
@@ -0,0 +1,420 @@
+"""
+Offline stand-ins for the Reddit endpoints used by RedditLookup, so the crawler can be measured and regression-tested
+without credentials or network access. They are requests sessions, plugged into praw through its requestor:
+
+    session = SyntheticRedditSession(latency=0.05, submissions_per_search=50)
+    rl = RedditLookup(reddit_kwargs=standin_reddit_kwargs(session))
+
+- SyntheticRedditSession answers from a deterministic synthetic corpus.
+- RecordingSession forwards to Reddit and records every response into a directory.
+- ReplaySession answers from such a recording.
+The stand-ins add a configurable latency to every request and return X-Ratelimit-* headers computed from a configurable
+budget per window, like Reddit does.
+"""
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from collections import Counter, OrderedDict
+from urllib.parse import parse_qsl, urlparse
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+TOKEN_PATH = '/api/v1/access_token'
+MORECHILDREN_BATCH = 100
+
+VOCABULARY = ['heat', 'wave', 'heatwave', 'dome', 'extreme', 'climate', 'change', 'hot', 'summer', 'day', 'hottest',
+              'stroke', 'warming', 'planet', 'urban', 'island', 'stress', 'weather', 'crisis', 'action', 'BC', 'year',
+              'illness', 'rash', 'exhaustion', 'the', 'in', 'city', 'cooling', 'centre', 'AC', 'power', 'outage']
+
+
+def standin_reddit_kwargs(session: requests.Session) -> dict:
+    """
+    :param session: One of the stand-in sessions.
+    :return: The praw.Reddit keyword arguments routing all the requests of praw through the given session.
+    """
+    return {'requestor_kwargs': {'session': session}, 'check_for_updates': False}
+
+
+def _base36(number: int) -> str:
+    digits = '0123456789abcdefghijklmnopqrstuvwxyz'
+    result = ''
+    while True:
+        number, remainder = divmod(number, 36)
+        result = digits[remainder] + result
+        if number == 0:
+            return result
+
+
+def _request_key(method: str, path: str, query: dict, form: dict) -> str:
+    query = {k: v for k, v in query.items() if k != 'raw_json'}
+    key = json.dumps([method, path, sorted(query.items()), sorted(form.items())])
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def _listing(children: list, after=None) -> dict:
+    return {'kind': 'Listing', 'data': {'after': after, 'before': None, 'dist': len(children), 'children': children}}
+
+
+class StandInSession(requests.Session):
+    """
+    The base of the stand-in sessions: parses requests, answers the OAuth token endpoint, adds the synthetic latency and
+    rate limit headers, and counts the requests per endpoint. Subclasses implement handle().
+    """
+
+    def __init__(self, latency=0.0, rate_limit_budget=600, rate_limit_window=600):
+        super().__init__()
+        self.latency = latency
+        self.rate_limit_budget = rate_limit_budget
+        self.rate_limit_window = rate_limit_window
+        self.requests_by_endpoint = Counter()
+        self._window_start = time.monotonic()
+        self._window_used = 0
+        self._lock = threading.Lock()
+
+    @property
+    def request_count(self) -> int:
+        return sum(self.requests_by_endpoint.values())
+
+    def _rate_limit_headers(self, endpoint: str) -> dict:
+        with self._lock:
+            self.requests_by_endpoint[endpoint] += 1
+            now = time.monotonic()
+            if now - self._window_start >= self.rate_limit_window:
+                self._window_start = now
+                self._window_used = 0
+            self._window_used += 1
+            remaining = max(self.rate_limit_budget - self._window_used, 0)
+            reset = max(int(self.rate_limit_window - (now - self._window_start)), 0)
+        return {'x-ratelimit-used': str(self._window_used),
+                'x-ratelimit-remaining': f'{remaining:.1f}',
+                'x-ratelimit-reset': str(reset)}
+
+    @staticmethod
+    def _make_response(method: str, url: str, status: int, payload, headers: dict) -> requests.Response:
+        response = requests.Response()
+        response.status_code = status
+        response.reason = 'OK' if status == 200 else 'Not Found'
+        response._content = json.dumps(payload).encode('utf-8')
+        response.encoding = 'utf-8'
+        response.headers = CaseInsensitiveDict({'content-type': 'application/json; charset=UTF-8', **headers})
+        response.url = url
+        response.request = requests.Request(method=method, url=url).prepare()
+        return response
+
+    def request(self, method, url, params=None, data=None, **kwargs):
+        method = method.upper()
+        parsed = urlparse(url)
+        path = '/' + parsed.path.strip('/')
+        query = dict(parse_qsl(parsed.query))
+        query.update(dict(params or {}))
+        form = dict(parse_qsl(data)) if isinstance(data, (str, bytes)) else dict(data or {})
+
+        if self.latency:
+            time.sleep(self.latency)
+        if path == TOKEN_PATH:
+            payload = {'access_token': 'standin-token', 'token_type': 'bearer', 'expires_in': 86400, 'scope': '*'}
+            return self._make_response(method, url, 200, payload, {})
+
+        status, payload, endpoint = self.handle(method, path, query, form)
+        return self._make_response(method, url, status, payload, self._rate_limit_headers(endpoint))
+
+    def handle(self, method: str, path: str, query: dict, form: dict) -> tuple:
+        """
+        :return: A three-tuple of the status code, the JSON payload and the name of the endpoint.
+        """
+        raise NotImplementedError
+
+
+class SyntheticRedditSession(StandInSession):
+    """
+    Answers from a deterministic synthetic corpus. Every subreddit has a pool of submissions_per_search * 3 submissions, a
+    search returns the ones whose title contains the words of its query (title:word terms combined with AND and OR, so
+    overlapping keywords return overlapping results), in the order of its sort and capped at search_cap results like on
+    Reddit, and every submission has a comment tree of about
+    comments_per_submission comments, of which only inline_comments are returned with the submission, the rest being
+    loaded through morechildren like on Reddit.
+    """
+
+    def __init__(self, submissions_per_search=25, comments_per_submission=50, inline_comments=20, seed=0, search_cap=250,
+                 **kwargs):
+        super().__init__(**kwargs)
+        self.submissions_per_search = submissions_per_search
+        self.search_cap = search_cap
+        self.comments_per_submission = comments_per_submission
+        self.inline_comments = inline_comments
+        self.seed = seed
+        self._comment_trees = OrderedDict()
+        # Subreddit id -> display name of the subreddits seen so far, to find the subreddit of a submission id
+        self._display_names = {}
+
+    def _rng(self, *key) -> random.Random:
+        digest = hashlib.sha1(json.dumps([self.seed, *key]).encode('utf-8')).hexdigest()
+        return random.Random(int(digest, 16))
+
+    def _subreddit_id(self, display_name: str) -> str:
+        return _base36(self._rng('subreddit', display_name.lower()).randrange(36 ** 6)).rjust(6, '0')
+
+    @staticmethod
+    def _author(k: int) -> tuple:
+        return f'user_{k}', f't2_{_base36(k)}'
+
+    def _subreddit(self, display_name: str) -> dict:
+        rng = self._rng('subreddit', display_name.lower())
+        subreddit_id = self._subreddit_id(display_name)
+        return {'kind': 't5', 'data': {
+            'id': subreddit_id,
+            'name': f't5_{subreddit_id}',
+            'display_name': display_name,
+            'public_description': f'The {display_name} subreddit',
+            'subscribers': rng.randrange(1000, 1000000),
+            'over18': False,
+            'created_utc': 1200000000.0 + rng.randrange(400000000),
+        }}
+
+    def _submission_location(self, submission_id: str) -> tuple:
+        # Submission ids are the 6 characters of their subreddit id followed by the 4 characters of their pool index
+        return submission_id[:6], int(submission_id[6:], 36)
+
+    def _submission(self, display_name: str, k: int) -> dict:
+        subreddit_id = self._subreddit_id(display_name)
+        submission_id = subreddit_id + _base36(k).rjust(4, '0')
+        rng = self._rng('submission', submission_id)
+        author_name, author_fullname = self._author(rng.randrange(self.submissions_per_search * 20))
+        created_utc = 1672531200.0 + rng.randrange(365 * 86400)
+        return {'kind': 't3', 'data': {
+            'id': submission_id,
+            'name': f't3_{submission_id}',
+            'author': author_name,
+            'author_fullname': author_fullname,
+            'subreddit': display_name,
+            'subreddit_id': f't5_{subreddit_id}',
+            'title': ' '.join(rng.choice(VOCABULARY) for _ in range(rng.randrange(4, 14))),
+            'selftext': ' '.join(rng.choice(VOCABULARY) for _ in range(rng.randrange(0, 120))),
+            'score': rng.randrange(0, 3000),
+            'upvote_ratio': round(rng.random(), 2),
+            'num_comments': self._comment_count(submission_id),
+            'url': f'https://www.reddit.com/r/{display_name}/comments/{submission_id}/',
+            'permalink': f'/r/{display_name}/comments/{submission_id}/',
+            'author_flair_text': None,
+            'link_flair_text': rng.choice([None, 'News', 'Discussion']),
+            'distinguished': None,
+            'is_self': rng.random() < 0.5,
+            'locked': False,
+            'over_18': False,
+            'created_utc': created_utc,
+        }}
+
+    def _comment_count(self, submission_id: str) -> int:
+        return self._rng('comment_count', submission_id).randrange(2 * self.comments_per_submission + 1)
+
+    def _comment_tree(self, display_name: str, submission_id: str) -> list:
+        with self._lock:
+            if submission_id in self._comment_trees:
+                self._comment_trees.move_to_end(submission_id)
+                return self._comment_trees[submission_id]
+
+        rng = self._rng('comments', submission_id)
+        link_id = f't3_{submission_id}'
+        comments = []
+        for i in range(self._comment_count(submission_id)):
+            parent = None if i == 0 or rng.random() < 0.4 else rng.randrange(i)
+            comment_id = submission_id + _base36(i)
+            author_name, author_fullname = self._author(rng.randrange(self.comments_per_submission * 50))
+            comments.append({
+                'id': comment_id,
+                'name': f't1_{comment_id}',
+                'author': author_name,
+                'author_fullname': author_fullname,
+                'link_id': link_id,
+                'parent_id': link_id if parent is None else comments[parent]['name'],
+                'depth': 0 if parent is None else comments[parent]['depth'] + 1,
+                'subreddit': display_name,
+                'subreddit_id': f't5_{self._subreddit_id(display_name)}',
+                'body': ' '.join(rng.choice(VOCABULARY) for _ in range(rng.randrange(1, 80))),
+                'score': rng.randrange(-20, 500),
+                'distinguished': None,
+                'is_submitter': rng.random() < 0.05,
+                'permalink': f'/r/{display_name}/comments/{submission_id}/_/{comment_id}/',
+                'created_utc': 1672531200.0 + rng.randrange(365 * 86400),
+                'replies': '',
+            })
+
+        with self._lock:
+            self._comment_trees[submission_id] = comments
+            while len(self._comment_trees) > 256:
+                self._comment_trees.popitem(last=False)
+        return comments
+
+    @staticmethod
+    def _query_terms(q: str) -> list:
+        # (title:a AND title:b) OR title:c -> [{'a', 'b'}, {'c'}]
+        return [{word.split(':', 1)[-1].strip('()').lower() for word in group.split(' AND ')} for group in q.split(' OR ')]
+
+    def _search(self, display_name: str, query: dict) -> dict:
+        pool_size = self.submissions_per_search * 3
+        terms = self._query_terms(query.get('q', ''))
+        children = []
+        for k in range(pool_size):
+            submission = self._submission(display_name, k)
+            words = set(submission['data']['title'].lower().split())
+            if any(term <= words for term in terms):
+                children.append(submission)
+        sort_keys = {'new': 'created_utc', 'top': 'score', 'comments': 'num_comments'}
+        if query.get('sort') in sort_keys:
+            children.sort(key=lambda c: c['data'][sort_keys[query['sort']]], reverse=True)
+        children = children[:self.search_cap]
+
+        names = [c['data']['name'] for c in children]
+        start = names.index(query['after']) + 1 if query.get('after') in names else 0
+        limit = int(query.get('limit', 100))
+        page = children[start: start + limit]
+        after = page[-1]['data']['name'] if start + limit < len(children) else None
+        return _listing(page, after=after)
+
+    def _comments(self, display_name: str, submission_id: str) -> list:
+        submission = self._submission(display_name, self._submission_location(submission_id)[1])
+        comments = self._comment_tree(display_name, submission_id)
+
+        # Comments are returned nested, their parents always come first since they are created earlier
+        things = {}
+        top_level = []
+        for c in comments[:self.inline_comments]:
+            thing = {'kind': 't1', 'data': dict(c)}
+            things[c['name']] = thing
+            if c['parent_id'] == c['link_id']:
+                top_level.append(thing)
+            else:
+                parent = things[c['parent_id']]['data']
+                if not parent['replies']:
+                    parent['replies'] = _listing([])
+                parent['replies']['data']['children'].append(thing)
+
+        remaining = [c['id'] for c in comments[self.inline_comments:]]
+        if remaining:
+            top_level.append(self._more(remaining, parent_id=f't3_{submission_id}'))
+        return [_listing([submission]), _listing(top_level)]
+
+    @staticmethod
+    def _more(children: list, parent_id: str) -> dict:
+        return {'kind': 'more', 'data': {'count': len(children), 'name': f't1_{children[0]}', 'id': children[0],
+                                         'parent_id': parent_id, 'depth': 0, 'children': children}}
+
+    def _morechildren(self, params: dict) -> dict:
+        submission_id = params['link_id'][3:]
+        display_name = self._display_names.get(self._submission_location(submission_id)[0])
+        comments = {c['id']: c for c in self._comment_tree(display_name, submission_id)}
+        children = params['children'].split(',')
+
+        things = [{'kind': 't1', 'data': comments[c]} for c in children[:MORECHILDREN_BATCH] if c in comments]
+        if len(children) > MORECHILDREN_BATCH:
+            things.append(self._more(children[MORECHILDREN_BATCH:], parent_id=params['link_id']))
+        return {'json': {'errors': [], 'data': {'things': things}}}
+
+    def _user(self, name: str) -> dict:
+        k = int(name.split('_')[-1])
+        rng = self._rng('user', k)
+        author_name, author_fullname = self._author(k)
+        return {'kind': 't2', 'data': {
+            'id': author_fullname[3:],
+            'name': author_name,
+            'link_karma': rng.randrange(100000),
+            'comment_karma': rng.randrange(100000),
+            'icon_img': '',
+            'has_verified_email': rng.random() < 0.8,
+            'is_employee': False,
+            'is_mod': rng.random() < 0.05,
+            'is_gold': rng.random() < 0.05,
+            'created_utc': 1200000000.0 + rng.randrange(500000000),
+        }}
+
+    def _user_data(self, ids: str) -> dict:
+        users = {}
+        for fullname in ids.split(','):
+            user = self._user(f'user_{int(fullname[3:], 36)}')['data']
+            users[fullname] = {'name': user['name'], 'created_utc': user['created_utc'],
+                               'link_karma': user['link_karma'], 'comment_karma': user['comment_karma'],
+                               'profile_img': '', 'profile_color': '', 'profile_over_18': False}
+        return users
+
+    def _remember_subreddit(self, display_name: str):
+        with self._lock:
+            self._display_names[self._subreddit_id(display_name)] = display_name
+
+    def handle(self, method: str, path: str, query: dict, form: dict) -> tuple:
+        parts = path.strip('/').split('/')
+        params = {**query, **form}
+        if len(parts) == 3 and parts[0] == 'r' and parts[2] == 'about':
+            self._remember_subreddit(parts[1])
+            return 200, self._subreddit(parts[1]), 'subreddit_about'
+        if len(parts) == 3 and parts[0] == 'r' and parts[2] == 'search':
+            self._remember_subreddit(parts[1])
+            return 200, self._search(parts[1], params), 'search'
+        if path == '/api/info' and 'sr_name' in params:
+            display_names = params['sr_name'].split(',')
+            for display_name in display_names:
+                self._remember_subreddit(display_name)
+            return 200, _listing([self._subreddit(display_name) for display_name in display_names]), 'info'
+        if len(parts) >= 2 and parts[0] == 'comments':
+            display_name = self._display_names.get(self._submission_location(parts[1])[0])
+            if display_name is None:
+                return 404, {'message': 'Not Found', 'error': 404}, 'comments'
+            return 200, self._comments(display_name, parts[1]), 'comments'
+        if path == '/api/morechildren':
+            return 200, self._morechildren(params), 'morechildren'
+        if len(parts) == 3 and parts[0] == 'user' and parts[2] == 'about':
+            if not parts[1].startswith('user_'):
+                return 404, {'message': 'Not Found', 'error': 404}, 'user_about'
+            return 200, self._user(parts[1]), 'user_about'
+        if path == '/api/user_data_by_account_ids':
+            return 200, self._user_data(params['ids']), 'user_data_by_account_ids'
+        return 404, {'message': 'Not Found', 'error': 404}, 'unknown'
+
+
+class RecordingSession(requests.Session):
+    """
+    Forwards every request to Reddit and records its response into record_dir, to be replayed by ReplaySession.
+    The OAuth token endpoint is never recorded.
+    """
+
+    def __init__(self, record_dir: str):
+        super().__init__()
+        self.record_dir = record_dir
+        os.makedirs(record_dir, exist_ok=True)
+
+    def request(self, method, url, params=None, data=None, **kwargs):
+        response = super().request(method, url, params=params, data=data, **kwargs)
+        parsed = urlparse(url)
+        path = '/' + parsed.path.strip('/')
+        if path == TOKEN_PATH:
+            return response
+
+        query = dict(parse_qsl(parsed.query))
+        query.update(dict(params or {}))
+        form = dict(parse_qsl(data)) if isinstance(data, (str, bytes)) else dict(data or {})
+        record = {'method': method.upper(), 'path': path, 'status': response.status_code, 'payload': response.json()}
+        key = _request_key(method.upper(), path, query, form)
+        with open(os.path.join(self.record_dir, f'{key}.json'), 'w') as record_stream:
+            json.dump(record, record_stream)
+        return response
+
+
+class ReplaySession(StandInSession):
+    """
+    Answers from the responses recorded by RecordingSession, requests that were not recorded get a 404.
+    """
+
+    def __init__(self, record_dir: str, **kwargs):
+        super().__init__(**kwargs)
+        self.record_dir = record_dir
+
+    def handle(self, method: str, path: str, query: dict, form: dict) -> tuple:
+        record_path = os.path.join(self.record_dir, f'{_request_key(method, path, query, form)}.json')
+        if not os.path.isfile(record_path):
+            return 404, {'message': 'Not Found', 'error': 404}, path
+        with open(record_path) as record_stream:
+            record = json.load(record_stream)
+        return record['status'], record['payload'], record['path']
@@ -0,0 +1,160 @@
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+import pandas as pd
+import praw
+
+from generic_db import GenericDBOperations
+
+# The columns of the redditors table which user_data_by_account_ids does not return, see RedditorResolver
+PROFILE_COLUMNS = ['has_verified_email', 'is_employee', 'is_mod', 'is_gold']
+
+
+class LRUTTLCache:
+    """
+    A thread-safe LRU cache whose entries also expire after a time to live.
+    """
+
+    def __init__(self, max_size=100000, ttl_seconds=86400):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, key) -> bool:
+        with self._lock:
+            expires_at = self._entries.get(key)
+            if expires_at is None:
+                return False
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return False
+            self._entries.move_to_end(key)
+            return True
+
+    def add(self, key):
+        with self._lock:
+            self._entries[key] = time.monotonic() + self.ttl_seconds
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+
+class RedditorResolver:
+    """
+    RedditorResolver turns the author fullnames found in submission and comment payloads into rows of the redditors table,
+    without one /user/<name>/about request per author. Authors are looked up in an in-process cache first, then in the
+    redditors table (one IN query per batch), and only the remaining ones are fetched from Reddit in batches of 100
+    through the user_data_by_account_ids endpoint.
+    That endpoint only returns the public profile fields. With fetch_profiles, the PROFILE_COLUMNS of the fetched authors
+    are then read from their /user/<name>/about profiles (one request per new author, registered authors are never
+    fetched again), otherwise they are left null.
+    Fetched authors only become known once the caller committed them (see mark_registered), so authors whose write
+    failed are fetched again.
+    """
+
+    BATCH_SIZE = 100
+
+    def __init__(self, generic_db: GenericDBOperations, cache_size=100000, ttl_seconds=86400, fetch_profiles=True):
+        self.generic_db = generic_db
+        self.known_redditors = LRUTTLCache(max_size=cache_size, ttl_seconds=ttl_seconds)
+        self.fetch_profiles = fetch_profiles
+
+    @staticmethod
+    def get_author_fullname(reddit_model: praw.models.Submission | praw.models.Comment):
+        # Read from the already fetched payload, accessing reddit_model.author.fullname would fetch the redditor
+        return vars(reddit_model).get('author_fullname')
+
+    def _lookup_registered(self, redditor_ids: list) -> set:
+        registered = set()
+        for start in range(0, len(redditor_ids), self.BATCH_SIZE):
+            batch = redditor_ids[start: start + self.BATCH_SIZE]
+            rows = self.generic_db.execute_query('SELECT redditor_id FROM redditors WHERE redditor_id = ANY(%s);',
+                                                 fetch_all=True, params=(batch,))
+            if not self.generic_db.check_db_result_sanity(rows):
+                registered.update(r[0] for r in rows)
+        return registered
+
+    @staticmethod
+    def _fetch_profiles(reddit: praw.Reddit, partial_redditors: list) -> dict:
+        profiles = {}
+        for pr in partial_redditors:
+            try:
+                # Reading an attribute of the lazy redditor fetches its /user/<name>/about profile
+                redditor = reddit.redditor(pr.name)
+                profiles[pr.fullname] = {col: getattr(redditor, col, None) for col in PROFILE_COLUMNS}
+            except Exception as e:
+                print('ERROR: Cannot fetch redditor profile', getattr(pr, 'name', None))
+                print(e)
+        return profiles
+
+    @staticmethod
+    def _create_authors_df(partial_redditors: list, profiles: dict) -> pd.DataFrame:
+        authors_df = {
+            'redditor_id': [],
+            'username': [],
+            'link_karma': [],
+            'comment_karma': [],
+            'icon_img': [],
+            'has_verified_email': [],
+            'is_employee': [],
+            'is_mod': [],
+            'is_gold': [],
+            'is_suspended': [],
+            'created_at': [],
+            'created_utc': [],
+        }
+        for pr in partial_redditors:
+            created_utc = getattr(pr, 'created_utc', None)
+            authors_df['redditor_id'].append(pr.fullname)
+            authors_df['username'].append(getattr(pr, 'name', None))
+            authors_df['link_karma'].append(getattr(pr, 'link_karma', None))
+            authors_df['comment_karma'].append(getattr(pr, 'comment_karma', None))
+            authors_df['icon_img'].append(getattr(pr, 'profile_img', None))
+            profile = profiles.get(pr.fullname, {})
+            for col in PROFILE_COLUMNS:
+                authors_df[col].append(profile.get(col))
+            authors_df['is_suspended'].append(getattr(pr, 'is_suspended', None))
+            authors_df['created_utc'].append(created_utc)
+            authors_df['created_at'].append(datetime.fromtimestamp(created_utc) if created_utc else None)
+
+        authors_df = pd.DataFrame.from_dict(data=authors_df)
+        return authors_df
+
+    def resolve(self, reddit: praw.Reddit, author_fullnames: list) -> pd.DataFrame:
+        """
+        Given the author fullnames of some submissions or comments, this method resolves the authors which are not
+        registered yet.
+        :param reddit: The praw instance to fetch the missing authors with.
+        :param author_fullnames: The author fullnames (None for deleted authors, duplicates are allowed).
+        :return: A DF of the authors to register, in the format of the redditors table.
+        """
+        candidates = list(dict.fromkeys(a for a in author_fullnames if a and a not in self.known_redditors))
+        registered = self._lookup_registered(candidates)
+        for redditor_id in registered:
+            self.known_redditors.add(redditor_id)
+        missing = [a for a in candidates if a not in registered]
+
+        partial_redditors = []
+        if missing:
+            try:
+                partial_redditors = list(reddit.redditors.partial_redditors(missing))
+            except Exception as e:
+                print('ERROR: Cannot resolve redditors')
+                print(e)
+        profiles = self._fetch_profiles(reddit, partial_redditors) if self.fetch_profiles else {}
+        print(f'Resolved redditors: {len(author_fullnames)} authors, {len(registered)} registered, '
+              f'{len(partial_redditors)} fetched in {-(-len(missing) // self.BATCH_SIZE)} requests, '
+              f'{len(profiles)} profiles fetched')
+
+        return self._create_authors_df(partial_redditors, profiles)
+
+    def mark_registered(self, redditor_ids):
+        """
+        Remembers authors as registered, to be called once the transaction inserting them is committed.
+        :param redditor_ids: The ids of the registered authors.
+        """
+        for redditor_id in redditor_ids:
+            self.known_redditors.add(redditor_id)
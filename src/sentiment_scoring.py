@@ -0,0 +1,149 @@
+import hashlib
+import json
+
+import pandas as pd
+
+from generic_db import GenericDBOperations
+from near_duplicates import NearDuplicateIndex
+
+SENTIMENT_MODEL = 'siebert/sentiment-roberta-large-english'
+EMOTION_MODEL = 'SamLowe/roberta-base-go_emotions'
+
+
+def content_hash(text: str) -> str:
+    """
+    Given a document, this function hashes its content, the key its scores are cached with.
+    :param text: The document.
+    :return: The hex digest of the document.
+    """
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=16).hexdigest()
+
+
+class DocumentScorer:
+    """
+    DocumentScorer scores documents with a text classification model (e.g. the sentiment or the emotion model) on CPU and
+    caches the scores in the document_scores table, keyed by the content hash of the document and the model name.
+    Only the documents which were never scored by the model are run through it, sorted by token length and batched so
+    that each batch is padded to a similar length. The scores are committed every commit_every documents, so an
+    interrupted run resumes where it stopped.
+    Any transformers model (or local path) works, e.g. a tiny random classification model as a stand-in for tests, and
+    an already built text-classification pipeline can be given instead.
+    """
+
+    LOOKUP_BATCH_SIZE = 10000
+
+    def __init__(self, generic_db: GenericDBOperations, model_name: str, batch_size=32, num_threads=None,
+                 max_length=512, commit_every=512, text_classifier=None):
+        self.generic_db = generic_db
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.num_threads = num_threads
+        self.max_length = max_length
+        self.commit_every = commit_every
+        self.text_classifier = text_classifier
+        self._ensure_table()
+
+    def _ensure_table(self):
+        q = '''
+        CREATE TABLE IF NOT EXISTS document_scores (
+            content_hash TEXT NOT NULL,
+            model TEXT NOT NULL,
+            scores JSONB NOT NULL,
+            scored_at TIMESTAMP NOT NULL DEFAULT now(),
+            PRIMARY KEY (content_hash, model)
+        );
+        '''
+        self.generic_db.execute_query(q)
+
+    def _load_text_classifier(self):
+        if self.text_classifier is None:
+            import torch
+            from transformers import pipeline
+            if self.num_threads:
+                torch.set_num_threads(self.num_threads)
+            self.text_classifier = pipeline('text-classification', model=self.model_name, top_k=None)
+        return self.text_classifier
+
+    @property
+    def labels(self) -> list:
+        """
+        :return: The labels of the model, in the order of the model config.
+        """
+        if self.text_classifier is not None:
+            id2label = self.text_classifier.model.config.id2label
+        else:
+            from transformers import AutoConfig
+            id2label = AutoConfig.from_pretrained(self.model_name).id2label
+        return [id2label[i] for i in sorted(id2label)]
+
+    def _lookup_scores(self, hashes: list) -> dict:
+        scores = {}
+        q = 'SELECT content_hash, scores FROM document_scores WHERE model = %s AND content_hash = ANY(%s);'
+        for start in range(0, len(hashes), self.LOOKUP_BATCH_SIZE):
+            batch = hashes[start: start + self.LOOKUP_BATCH_SIZE]
+            rows = self.generic_db.execute_query(q, fetch_all=True, params=(self.model_name, batch))
+            if not self.generic_db.check_db_result_sanity(rows):
+                scores.update(rows)
+        return scores
+
+    def _length_sorted_batches(self, texts: list) -> list:
+        # Sorting by token length keeps the padding of every batch small
+        tokenizer = self._load_text_classifier().tokenizer
+        lengths = [len(ids) for ids in tokenizer(texts, truncation=True, max_length=self.max_length)['input_ids']]
+        order = sorted(range(len(texts)), key=lambda i: lengths[i])
+        return [order[start: start + self.batch_size] for start in range(0, len(order), self.batch_size)]
+
+    def _save_scores(self, scored: dict):
+        scores_df = pd.DataFrame({'content_hash': list(scored.keys()),
+                                  'model': self.model_name,
+                                  'scores': [json.dumps(s) for s in scored.values()]})
+        self.generic_db.bulk_insert_into_table(table_name='document_scores', data=scores_df,
+                                               id_col=['content_hash', 'model'])
+
+    def _score_missing(self, texts: dict):
+        hashes = list(texts.keys())
+        text_list = list(texts.values())
+        text_classifier = self._load_text_classifier()
+        pending = {}
+        done = 0
+        for batch in self._length_sorted_batches(text_list):
+            results = text_classifier([text_list[i] for i in batch], batch_size=len(batch), truncation=True,
+                                      max_length=self.max_length, top_k=None)
+            for i, result in zip(batch, results):
+                result = [result] if isinstance(result, dict) else result
+                pending[hashes[i]] = {r['label']: r['score'] for r in result}
+            if len(pending) >= self.commit_every:
+                self._save_scores(pending)
+                done += len(pending)
+                print(f'Scored {done} of {len(hashes)} documents with {self.model_name}')
+                pending = {}
+        if pending:
+            self._save_scores(pending)
+            done += len(pending)
+            print(f'Scored {done} of {len(hashes)} documents with {self.model_name}')
+
+    def score(self, documents: list, near_duplicates: NearDuplicateIndex = None) -> pd.DataFrame:
+        """
+        Given some documents, this method scores the ones not scored yet by the model and returns the scores of all of them.
+        :param documents: The documents (duplicates are scored once).
+        :param near_duplicates: A NearDuplicateIndex, to only score the canonical document of each cluster of
+        near-duplicates and give its scores to all the documents of the cluster.
+        :return: A Pandas DF with one row per document (in the given order) and one column per label of the model.
+        """
+        if near_duplicates is not None:
+            deduplication = near_duplicates.deduplicate(documents)
+            print(f'{len(documents)} documents, {len(deduplication.documents)} after removing near-duplicates')
+            return deduplication.expand(self.score(deduplication.documents))
+
+        hashes = [content_hash(d) for d in documents]
+        unique_texts = dict(zip(hashes, documents))
+        scores = self._lookup_scores(list(unique_texts.keys()))
+        missing = {h: t for h, t in unique_texts.items() if h not in scores}
+        print(f'{len(documents)} documents, {len(unique_texts) - len(missing)} already scored by {self.model_name}')
+
+        if missing:
+            self._score_missing(missing)
+            scores.update(self._lookup_scores(list(missing.keys())))
+
+        scores_df = pd.DataFrame.from_records([scores[h] for h in hashes])
+        return scores_df.reindex(columns=self.labels) if documents else scores_df
@@ -0,0 +1,196 @@
+"""
+Exports the crawled tables from the database into the Parquet snapshots the analysis notebooks read (see SNAPSHOT_QUERIES),
+replacing the comments_all.csv, users_all.csv, subreddits_all.csv and submissions_all.csv exports.
+
+Usage: python snapshot_export.py --db-config config/db_config.yml --root-dir notebooks/snapshots
+"""
+import argparse
+import itertools
+import json
+import os
+import shutil
+import time
+
+import pandas as pd
+
+from generic_db import GenericDBOperations
+
+# The crawled tables, with the column names the notebooks use (and used in the CSV exports)
+SNAPSHOT_QUERIES = {
+    'comments': '''
+        SELECT comment_id, author, submission AS submission_id, subreddit AS subreddit_id, body, clean_body, score,
+               distinguished, is_submitter, parent_id, permalink, created_at, created_utc
+        FROM comments
+        ''',
+    'submissions': '''
+        SELECT submission_id, author, subreddit AS subreddit_id, keyword, has_exact_keyword, title, selftext, clean_text,
+               score, upvote_ratio, num_comments, url, permalink, author_flair_text, link_flair_text, distinguished,
+               is_self, locked, over_18, created_at, created_utc
+        FROM submissions
+        ''',
+    'subreddits': 'SELECT * FROM subreddits',
+    'redditors': 'SELECT * FROM redditors',
+}
+
+# Snapshots partitioned by subreddit, so reading the rows of a few subreddits only opens their files
+SNAPSHOT_PARTITIONS = {
+    'comments': ['subreddit_id'],
+    'submissions': ['subreddit_id'],
+}
+
+
+def topic_words_frame(topics: dict) -> pd.DataFrame:
+    """
+    Given the topic words of a topic model (BERTopic.get_topics()), this function turns them into a long DF instead of
+    the one column of (word, score) tuples per topic of top_words.csv.
+    :param topics: A dict of topic to the list of its (word, score) pairs, best first.
+    :return: A DF with one row per (topic, word), with topic, rank, word and score columns.
+    """
+    rows = [(topic, rank, word, score) for topic, words in topics.items() for rank, (word, score) in enumerate(words)]
+    topic_words = pd.DataFrame.from_records(rows, columns=['topic', 'rank', 'word', 'score'])
+    return topic_words.astype({'topic': 'int32', 'rank': 'int16', 'word': 'str', 'score': 'float64'})
+
+
+class SnapshotStore:
+    """
+    SnapshotStore keeps the tables passed between the crawler and the analysis notebooks as Parquet datasets, one
+    directory per snapshot under root_dir, instead of CSV files which lose the dtypes and are parsed again on every read.
+    A snapshot is either exported from the database (streamed chunk by chunk, so a table never has to fit in memory) or
+    written from a DF (doc_info, topic words, ...). It can be partitioned by some columns (one sub-directory per value,
+    in the hive layout), and reads only load the asked columns and skip the files and row groups the filters exclude.
+    A snapshot is written next to the previous one and swapped in when complete, so readers never see a partial one.
+    """
+
+    def __init__(self, root_dir='snapshots', generic_db: GenericDBOperations = None):
+        self.root_dir = root_dir
+        self.generic_db = generic_db
+        os.makedirs(root_dir, exist_ok=True)
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.root_dir, name)
+
+    def _write(self, name: str, batches, partition_cols: list = None, metadata: dict = None) -> int:
+        # batches is an iterable of pyarrow RecordBatches, written to a temporary directory which replaces the snapshot
+        import pyarrow as pa
+        import pyarrow.dataset as ds
+
+        batches = iter(batches)
+        first = next(batches)
+        schema = first.schema
+        rows = 0
+
+        def counted(all_batches):
+            nonlocal rows
+            for batch in all_batches:
+                rows += batch.num_rows
+                # The types of the columns missing from ARROW_TYPES are inferred per batch, the first batch sets them
+                yield batch if batch.schema.equals(schema) else batch.cast(schema)
+
+        partition_cols = partition_cols or []
+        partitioning = ds.partitioning(pa.schema([schema.field(c) for c in partition_cols]), flavor='hive') \
+            if partition_cols else None
+        tmp_path = f'{self._path(name)}.tmp'
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        ds.write_dataset(counted(itertools.chain([first], batches)), tmp_path, schema=schema, format='parquet',
+                         partitioning=partitioning, existing_data_behavior='overwrite_or_ignore',
+                         basename_template='part-{i}.parquet', max_rows_per_group=100000)
+        if rows == 0:
+            # Nothing was written, an empty file keeps the schema of the snapshot
+            import pyarrow.parquet as pq
+            os.makedirs(tmp_path, exist_ok=True)
+            file_schema = pa.schema([f for f in schema if f.name not in partition_cols])
+            pq.write_table(file_schema.empty_table(), os.path.join(tmp_path, 'part-0.parquet'))
+
+        manifest = {
+            'name': name,
+            'rows': rows,
+            'partition_cols': {c: str(schema.field(c).type) for c in partition_cols},
+            'written_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            **(metadata or {}),
+        }
+        with open(os.path.join(tmp_path, '_snapshot.json'), 'w') as manifest_stream:
+            json.dump(manifest, manifest_stream, indent=2)
+
+        old_path = f'{self._path(name)}.old'
+        shutil.rmtree(old_path, ignore_errors=True)
+        if os.path.exists(self._path(name)):
+            os.rename(self._path(name), old_path)
+        os.rename(tmp_path, self._path(name))
+        shutil.rmtree(old_path, ignore_errors=True)
+        print(f'Wrote snapshot {name}: {rows} rows')
+        return rows
+
+    def export_query(self, name: str, query: str, params=None, partition_cols: list = None, chunk_size=100000) -> int:
+        """
+        Streams the result of a query into a snapshot, typed by the Postgres types of its columns.
+        :param name: The name of the snapshot.
+        :param query: The raw SQL SELECT query.
+        :param params: Optional parameters of the query (psycopg2 style placeholders).
+        :param partition_cols: The columns to partition the snapshot by, if any.
+        :param chunk_size: The number of rows read from the database (and written) at a time.
+        :return: The number of exported rows.
+        """
+        batches = self.generic_db.stream_query(query, params=params, chunk_size=chunk_size, as_arrow=True)
+        return self._write(name, batches, partition_cols=partition_cols, metadata={'query': ' '.join(query.split())})
+
+    def export_all(self, chunk_size=100000) -> dict:
+        """
+        Exports the crawled tables of SNAPSHOT_QUERIES.
+        :param chunk_size: The number of rows read from the database at a time.
+        :return: A dict of the number of exported rows per snapshot.
+        """
+        return {name: self.export_query(name, q, partition_cols=SNAPSHOT_PARTITIONS.get(name), chunk_size=chunk_size)
+                for name, q in SNAPSHOT_QUERIES.items()}
+
+    def write_frame(self, name: str, df: pd.DataFrame, partition_cols: list = None) -> int:
+        """
+        Writes a DF as a snapshot (its index is not kept).
+        :param name: The name of the snapshot.
+        :param df: The DF.
+        :param partition_cols: The columns to partition the snapshot by, if any.
+        :return: The number of written rows.
+        """
+        import pyarrow as pa
+
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        batches = table.to_batches() or [pa.RecordBatch.from_pylist([], schema=table.schema)]
+        return self._write(name, batches, partition_cols=partition_cols)
+
+    def read(self, name: str, columns: list = None, filters=None, dtypes: dict = None) -> pd.DataFrame:
+        """
+        Reads a snapshot, or the part of it that is asked for.
+        :param name: The name of the snapshot.
+        :param columns: The columns to read, all of them by default.
+        :param filters: Optional row filters, in the pyarrow (and pandas.read_parquet) format, e.g.
+        [('subreddit_id', 'in', ['t5_2qh68']), ('score', '>', 10)]. Filters on the partition columns skip whole files.
+        :param dtypes: Optional dtype hints of the columns, e.g. ANALYSIS_DTYPES.
+        :return: A Pandas DF.
+        """
+        import pyarrow as pa
+        import pyarrow.dataset as ds
+        import pyarrow.parquet as pq
+
+        path = self._path(name)
+        with open(os.path.join(path, '_snapshot.json')) as manifest_stream:
+            manifest = json.load(manifest_stream)
+        partition_fields = [pa.field(c, pa.type_for_alias(t)) for c, t in manifest['partition_cols'].items()]
+        dataset = ds.dataset(path, format='parquet',
+                             partitioning=ds.partitioning(pa.schema(partition_fields), flavor='hive')
+                             if partition_fields else None)
+        table = dataset.to_table(columns=columns,
+                                 filter=pq.filters_to_expression(filters) if filters else None)
+        return GenericDBOperations._apply_dtypes(table.to_pandas(), dtypes or {})
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument('--db-config', default=None, help='Path of the db config (defaults to config/db_config.yml)')
+    arg_parser.add_argument('--root-dir', default='snapshots', help='Directory of the snapshots')
+    arg_parser.add_argument('--chunk-size', type=int, default=100000, help='Rows read from the database at a time')
+    args = arg_parser.parse_args()
+
+    SnapshotStore(args.root_dir, GenericDBOperations(path=args.db_config)).export_all(chunk_size=args.chunk_size)
+
+
+if __name__ == '__main__':
+    main()
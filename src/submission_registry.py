@@ -0,0 +1,74 @@
+import threading
+
+import pandas as pd
+
+from generic_db import GenericDBOperations
+
+
+class SubmissionRegistry:
+    """
+    SubmissionRegistry keeps track of the submissions seen by a crawl run. The keywords overlap heavily, so the same
+    submission is returned by the searches of many keywords: every (submission, keyword) match is recorded in the
+    submission_keywords table, but the comment tree of a submission is only claimed for expansion once per run.
+    """
+
+    def __init__(self, generic_db: GenericDBOperations):
+        self.generic_db = generic_db
+        self._claimed = set()
+        self._lock = threading.Lock()
+        self._ensure_table()
+
+    def _ensure_table(self):
+        rows = self.generic_db.execute_query("SELECT to_regclass('submission_keywords');", fetch_one=True)
+        already_exists = rows[0][0] is not None
+        q = '''
+        CREATE TABLE IF NOT EXISTS submission_keywords (
+            submission_id TEXT NOT NULL,
+            keyword TEXT NOT NULL,
+            has_exact_keyword BOOLEAN,
+            PRIMARY KEY (submission_id, keyword)
+        );
+        CREATE INDEX IF NOT EXISTS submission_keywords_keyword_idx ON submission_keywords (keyword);
+        '''
+        self.generic_db.execute_query(q)
+        if not already_exists:
+            # Backfill the matches recorded so far, i.e. the first keyword of every submission
+            q = '''
+            INSERT INTO submission_keywords (submission_id, keyword, has_exact_keyword)
+            SELECT submission_id, keyword, has_exact_keyword FROM submissions
+            ON CONFLICT DO NOTHING;
+            '''
+            self.generic_db.execute_query(q)
+
+    def reset(self):
+        """
+        Forgets the submissions claimed so far, called at the start of every crawl run.
+        """
+        with self._lock:
+            self._claimed = set()
+
+    def claim(self, submission_ids: list) -> list:
+        """
+        Given a list of submission ids, this method claims the ones not claimed yet in this run.
+        :param submission_ids: The submission ids.
+        :return: The newly claimed submission ids, whose comment trees the caller is responsible for expanding.
+        """
+        claimed = []
+        with self._lock:
+            for submission_id in submission_ids:
+                if submission_id not in self._claimed:
+                    self._claimed.add(submission_id)
+                    claimed.append(submission_id)
+        return claimed
+
+    def register_keywords(self, matches_df: pd.DataFrame, fetch_ids=False) -> tuple:
+        """
+        Records keyword matches of submissions.
+        :param matches_df: A DF with submission_id, keyword and has_exact_keyword columns, e.g. a DF of submissions.
+        :param fetch_ids: Whether or not to also return the (submission_id, keyword) pairs of the inserted matches.
+        :return: A two-tuple of the number of inserted and skipped matches, or a three-tuple (if asked for the ids) with the
+        list of the inserted pairs appended.
+        """
+        matches_df = matches_df[['submission_id', 'keyword', 'has_exact_keyword']]
+        return self.generic_db.bulk_insert_into_table(table_name='submission_keywords', data=matches_df,
+                                                      id_col=['submission_id', 'keyword'], fetch_ids=fetch_ids)
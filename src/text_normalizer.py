@@ -0,0 +1,158 @@
+import re
+from multiprocessing import Pool
+from typing import TYPE_CHECKING
+
+import pandas as pd
+import psycopg2.extras
+
+from metrics import METRICS
+
+if TYPE_CHECKING:
+    # generic_db itself uses the normalization of this module
+    from generic_db import GenericDBOperations
+
+# Bumped whenever clean_text changes, rows cleaned by an older version are cleaned again by TextNormalizer.backfill
+NORMALIZATION_VERSION = 1
+
+_NEWLINE = '\n'
+_MARKDOWN_LINK = re.compile(r'\[(.*?)\]\((.*?)\)')
+_URL = re.compile(r'http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\\(\\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+')
+# Same result as \s+ -> ' ', without replacing every single space between words
+_WHITESPACE = re.compile(r'\s{2,}|[^\S ]')
+_SPACES = re.compile(' {2,}')
+
+
+def clean_text(text: str) -> str:
+    """
+    Given a submission or comment text, this function removes newlines, markdown link targets, URLs and "[deleted]"
+    markers, and collapses whitespace (the cleaning the topic and sentiment notebooks always applied).
+    :param text: The text.
+    :return: The cleaned text.
+    """
+    text = text.replace(_NEWLINE, ' ')
+    # Most comments have no links, the substring checks skip the patterns which cannot match
+    if '](' in text:
+        text = _MARKDOWN_LINK.sub(r'\1', text)
+    if 'http' in text:
+        text = _URL.sub('', text)
+    text = _WHITESPACE.sub(' ', text)
+    return text.replace('[deleted]', ' ')
+
+
+def squeeze_spaces(text: str) -> str:
+    """
+    Given a text, this function collapses runs of spaces into a single space.
+    :param text: The text.
+    :return: The text with single spaces.
+    """
+    return _SPACES.sub(' ', text) if '  ' in text else text
+
+
+def _clean_chunk(texts: list) -> list:
+    return [None if text is None else clean_text(text) for text in texts]
+
+
+def clean_series(texts, processes=1, chunk_size=10000) -> pd.Series:
+    """
+    Given some texts, this function cleans them with clean_text, in chunks spread over a pool of processes if asked.
+    :param texts: A Pandas Series (or any list-like) of texts, nulls are kept as nulls.
+    :param processes: The number of processes, 1 cleans in the calling process.
+    :param chunk_size: The number of texts per chunk sent to a process.
+    :return: A Pandas Series of the cleaned texts, with the index of the given Series.
+    """
+    texts = texts if isinstance(texts, pd.Series) else pd.Series(texts, dtype=object)
+    values = [None if pd.isna(text) else str(text) for text in texts.tolist()]
+    chunks = [values[start: start + chunk_size] for start in range(0, len(values), chunk_size)]
+    if processes > 1 and len(chunks) > 1:
+        with Pool(processes) as pool:
+            cleaned_chunks = pool.map(_clean_chunk, chunks)
+    else:
+        cleaned_chunks = [_clean_chunk(chunk) for chunk in chunks]
+    return pd.Series([text for chunk in cleaned_chunks for text in chunk], index=texts.index, dtype=object)
+
+
+class TextNormalizer:
+    """
+    TextNormalizer stores the cleaned text of submissions and comments next to their raw text, so that the topic and
+    sentiment runs read it instead of cleaning the whole corpus every time:
+    - comments.clean_body: the cleaned body.
+    - submissions.clean_text: the cleaned title and selftext, joined by a space.
+    Both tables also get a normalization_version column, stamped with the NORMALIZATION_VERSION the text was cleaned with.
+    New rows are cleaned at ingest (normalize_frame), existing rows by backfill.
+    """
+
+    # table: (id column, source columns, cleaned column)
+    CLEAN_COLUMNS = {
+        'comments': ('comment_id', ['body'], 'clean_body'),
+        'submissions': ('submission_id', ['title', 'selftext'], 'clean_text'),
+    }
+
+    def __init__(self, generic_db: 'GenericDBOperations', processes=1):
+        self.generic_db = generic_db
+        self.processes = processes
+        self._ensure_columns()
+
+    def _ensure_columns(self):
+        q = '\n'.join(f'''
+        ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {clean_col} TEXT;
+        ALTER TABLE {table} ADD COLUMN IF NOT EXISTS normalization_version SMALLINT;
+        ''' for table, (_, _, clean_col) in self.CLEAN_COLUMNS.items())
+        self.generic_db.execute_query(q)
+
+    def normalize_frame(self, df: pd.DataFrame, table_name: str) -> pd.DataFrame:
+        """
+        Given a DF of submissions or comments, this method adds its cleaned text and normalization version columns.
+        :param df: A DF in the format of the submissions or comments table.
+        :param table_name: The table of the DF, submissions or comments.
+        :return: The DF with the cleaned text columns added.
+        """
+        _, source_cols, clean_col = self.CLEAN_COLUMNS[table_name]
+        df = df.copy()
+        with METRICS.timer('text_normalization_seconds', table=table_name):
+            cleaned = [clean_series(df[col], processes=self.processes) for col in source_cols]
+            if len(cleaned) == 1:
+                df[clean_col] = cleaned[0]
+            else:
+                # The notebooks joined the cleaned title and selftext with a space, a missing part counts as empty
+                df[clean_col] = pd.concat(cleaned, axis=1).fillna('').agg(' '.join, axis=1) if not df.empty else None
+        df['normalization_version'] = NORMALIZATION_VERSION
+        return df
+
+    def backfill(self, chunk_size=10000) -> dict:
+        """
+        Cleans the stored rows which were not cleaned yet, or were cleaned by an older NORMALIZATION_VERSION. The rows are
+        read in chunks ordered by id (each read starting after the last id of the previous chunk), and every chunk is
+        updated in a transaction of its own, so the backfill holds a single connection at a time and resumes where an
+        interrupted run stopped.
+        :param chunk_size: The number of rows read, cleaned and updated at a time.
+        :return: A dict of the number of updated rows per table.
+        """
+        updated = {}
+        for table, (id_col, source_cols, clean_col) in self.CLEAN_COLUMNS.items():
+            q = f'''
+            SELECT {id_col}, {', '.join(source_cols)}
+            FROM {table}
+            WHERE normalization_version IS DISTINCT FROM %s AND {id_col} > %s
+            ORDER BY {id_col}
+            LIMIT %s;
+            '''
+            update_q = f'''
+            UPDATE {table}
+            SET {clean_col} = v.clean, normalization_version = {NORMALIZATION_VERSION}
+            FROM (VALUES %s) AS v (id, clean)
+            WHERE {table}.{id_col} = v.id;
+            '''
+            updated[table] = 0
+            last_id = ''
+            while True:
+                chunk = self.generic_db.read_query(q, params=(NORMALIZATION_VERSION, last_id, chunk_size))
+                if chunk.empty:
+                    break
+                last_id = chunk[id_col].iloc[-1]
+                chunk = self.normalize_frame(chunk, table)
+                values = list(zip(chunk[id_col].tolist(), chunk[clean_col].tolist()))
+                with self.generic_db.transaction() as cur:
+                    psycopg2.extras.execute_values(cur, update_q, values, page_size=1000)
+                updated[table] += len(values)
+            print(f'Normalized {table}: {updated[table]} rows')
+        return updated
@@ -0,0 +1,299 @@
+import json
+import os
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+from embedding_store import EMBEDDING_MODEL
+from generic_db import GenericDBOperations
+from sentiment_scoring import content_hash
+
+
+def jensen_shannon_divergence(p: dict, q: dict) -> float:
+    """
+    Given two distributions over topics, this function computes their Jensen-Shannon divergence (base 2, in [0, 1]).
+    :param p: A dict of topic to count (or probability).
+    :param q: A dict of topic to count (or probability).
+    :return: The divergence, 0 for identical distributions.
+    """
+    topics = sorted(set(p) | set(q))
+    p = np.array([p.get(t, 0) for t in topics], dtype=float)
+    q = np.array([q.get(t, 0) for t in topics], dtype=float)
+    if not p.sum() or not q.sum():
+        return 0.0
+    p, q = p / p.sum(), q / q.sum()
+    m = (p + q) / 2
+
+    def kl(a, b):
+        mask = a > 0
+        return float(np.sum(a[mask] * np.log2(a[mask] / b[mask])))
+
+    return (kl(p, m) + kl(q, m)) / 2
+
+
+class TopicAssigner:
+    """
+    TopicAssigner persists fitted BERTopic models as versioned artifacts and assigns the documents to their topics:
+    - models_dir/v<N>/: the saved model of version N, models_dir/manifest.json: per version, its fit date, the number of
+    documents it was fitted on, its topic names and its topic distribution.
+    - topic_assignments: per (content_hash, model_version), the topic and probability of a document, and whether it was
+    assigned by the fit itself or incrementally.
+    A full refit creates a new version from all the documents. In between, the documents the current version has never
+    seen are assigned with transform, so a daily update costs in proportion to the new documents. A refit is due once the
+    current version is older than refit_every_days, or when the drift of the incremental assignments exceeds max_drift.
+    Models are saved with safetensors by default, which keeps the topic embeddings but not the UMAP and HDBSCAN models:
+    transform then assigns by similarity to the topic embeddings. serialization='pickle' keeps the whole model instead.
+    """
+
+    def __init__(self, generic_db: GenericDBOperations, models_dir='topic_models', refit_every_days=30, max_drift=0.1,
+                 embedding_model=EMBEDDING_MODEL, serialization='safetensors'):
+        self.generic_db = generic_db
+        self.models_dir = models_dir
+        self.refit_every_days = refit_every_days
+        self.max_drift = max_drift
+        self.embedding_model = embedding_model
+        self.serialization = serialization
+        self._loaded = {}
+        os.makedirs(self.models_dir, exist_ok=True)
+        self._ensure_table()
+
+    def _ensure_table(self):
+        q = '''
+        CREATE TABLE IF NOT EXISTS topic_assignments (
+            content_hash TEXT NOT NULL,
+            model_version INTEGER NOT NULL,
+            topic INTEGER NOT NULL,
+            probability DOUBLE PRECISION,
+            incremental BOOLEAN NOT NULL,
+            assigned_at TIMESTAMP NOT NULL DEFAULT now(),
+            PRIMARY KEY (content_hash, model_version)
+        );
+        '''
+        self.generic_db.execute_query(q)
+
+    def _manifest_path(self) -> str:
+        return os.path.join(self.models_dir, 'manifest.json')
+
+    def _read_manifest(self) -> dict:
+        if not os.path.exists(self._manifest_path()):
+            return {'versions': []}
+        with open(self._manifest_path()) as manifest_stream:
+            return json.load(manifest_stream)
+
+    def _write_manifest(self, manifest: dict):
+        # Written aside and renamed, so a crash never leaves a truncated manifest
+        tmp_path = self._manifest_path() + '.tmp'
+        with open(tmp_path, 'w') as manifest_stream:
+            json.dump(manifest, manifest_stream, indent=2)
+        os.replace(tmp_path, self._manifest_path())
+
+    def latest_version(self):
+        """
+        :return: The manifest entry of the latest version, or None if no model was fitted yet.
+        """
+        versions = self._read_manifest()['versions']
+        return versions[-1] if versions else None
+
+    def _get_version(self, version=None) -> dict:
+        entry = self.latest_version() if version is None else next(
+            (v for v in self._read_manifest()['versions'] if v['version'] == version), None)
+        if entry is None:
+            raise ValueError(f'No topic model version {version if version is not None else ""} in {self.models_dir}')
+        return entry
+
+    def load_model(self, version=None):
+        """
+        Given a version, this method loads its saved BERTopic model (once per instance).
+        :param version: The version to load, the latest one by default.
+        :return: The BERTopic model.
+        """
+        from bertopic import BERTopic
+        entry = self._get_version(version)
+        if entry['version'] not in self._loaded:
+            self._loaded[entry['version']] = BERTopic.load(os.path.join(self.models_dir, entry['path']),
+                                                           embedding_model=self.embedding_model)
+        return self._loaded[entry['version']]
+
+    @staticmethod
+    def _top_probabilities(probabilities, n: int) -> list:
+        if probabilities is None:
+            return [None] * n
+        probabilities = np.asarray(probabilities, dtype=float)
+        if probabilities.ndim == 2:
+            probabilities = probabilities.max(axis=1)
+        return probabilities.tolist()
+
+    def _assigned_hashes(self, version: int, hashes: list) -> set:
+        assigned = set()
+        q = 'SELECT content_hash FROM topic_assignments WHERE model_version = %s AND content_hash = ANY(%s);'
+        for start in range(0, len(hashes), 10000):
+            rows = self.generic_db.execute_query(q, fetch_all=True, params=(version, hashes[start: start + 10000]))
+            if not self.generic_db.check_db_result_sanity(rows):
+                assigned.update(r[0] for r in rows)
+        return assigned
+
+    def _record_assignments(self, version: int, hashes: list, topics: list, probabilities: list, incremental: bool):
+        assignments_df = pd.DataFrame({'content_hash': hashes,
+                                       'model_version': version,
+                                       'topic': [int(t) for t in topics],
+                                       'probability': probabilities,
+                                       'incremental': incremental})
+        inserted, _ = self.generic_db.bulk_insert_into_table(table_name='topic_assignments', data=assignments_df,
+                                                             id_col=['content_hash', 'model_version'])
+        return inserted
+
+    def fit(self, documents: list, embeddings: np.ndarray, topic_model):
+        """
+        Given the documents, their embeddings and an unfitted BERTopic model, this method fits the model, saves it as a new
+        version and records the topics of all the documents.
+        :param documents: The documents.
+        :param embeddings: The embeddings of the documents (e.g. from EmbeddingStore.get_or_compute).
+        :param topic_model: The unfitted BERTopic model.
+        :return: The fitted BERTopic model.
+        """
+        topics, probabilities = topic_model.fit_transform(documents, embeddings=embeddings)
+
+        manifest = self._read_manifest()
+        version = manifest['versions'][-1]['version'] + 1 if manifest['versions'] else 1
+        path = f'v{version}'
+        topic_model.save(os.path.join(self.models_dir, path), serialization=self.serialization, save_ctfidf=True,
+                         save_embedding_model=self.embedding_model)
+
+        topic_counts = pd.Series(topics).value_counts()
+        topic_info = topic_model.get_topic_info()
+        manifest['versions'].append({
+            'version': version,
+            'path': path,
+            'fitted_at': datetime.now().isoformat(),
+            'n_documents': len(documents),
+            'topic_names': {str(t): n for t, n in zip(topic_info['Topic'], topic_info['Name'])},
+            'topic_counts': {str(t): int(c) for t, c in topic_counts.items()},
+        })
+        self._write_manifest(manifest)
+        self._loaded[version] = topic_model
+
+        hashes = [content_hash(d) for d in documents]
+        unique = dict(zip(hashes, zip(topics, self._top_probabilities(probabilities, len(documents)))))
+        self._record_assignments(version, list(unique.keys()), [t for t, _ in unique.values()],
+                                 [p for _, p in unique.values()], incremental=False)
+        print(f'Fitted topic model version {version} on {len(documents)} documents: {len(topic_info)} topics')
+        return topic_model
+
+    def assign(self, documents: list, embeddings: np.ndarray, version=None) -> int:
+        """
+        Given the documents and their embeddings, this method assigns the documents never assigned by the given version.
+        :param documents: The documents.
+        :param embeddings: The embeddings of the documents.
+        :param version: The version to assign with, the latest one by default.
+        :return: The number of newly assigned documents.
+        """
+        entry = self._get_version(version)
+        hashes = [content_hash(d) for d in documents]
+        assigned = self._assigned_hashes(entry['version'], list(set(hashes)))
+        new_rows = {}
+        for i, h in enumerate(hashes):
+            if h not in assigned and h not in new_rows:
+                new_rows[h] = i
+        print(f'{len(documents)} documents, {len(new_rows)} to assign with topic model version {entry["version"]}')
+        if not new_rows:
+            return 0
+
+        rows = list(new_rows.values())
+        topics, probabilities = self.load_model(entry['version']).transform([documents[i] for i in rows],
+                                                                            embeddings=np.asarray(embeddings)[rows])
+        return self._record_assignments(entry['version'], list(new_rows.keys()), topics,
+                                        self._top_probabilities(probabilities, len(rows)), incremental=True)
+
+    def drift_report(self, version=None) -> tuple:
+        """
+        Given a version, this method compares the topics of the documents assigned incrementally with the topics of the
+        documents the version was fitted on.
+        :param version: The version, the latest one by default.
+        :return: A two-tuple of a summary dict (Jensen-Shannon divergence of the topic distributions, outlier rates,
+        number of documents) and a per topic DF of the fitted and incremental shares.
+        """
+        entry = self._get_version(version)
+        q = '''
+        SELECT topic, count(*)
+        FROM topic_assignments
+        WHERE model_version = %s AND incremental
+        GROUP BY topic;
+        '''
+        rows = self.generic_db.execute_query(q, fetch_all=True, params=(entry['version'],)) or []
+        fitted = {int(t): c for t, c in entry['topic_counts'].items()}
+        incremental = {int(t): c for t, c in rows}
+
+        topics_df = pd.DataFrame({'fitted_count': pd.Series(fitted, dtype=float),
+                                  'incremental_count': pd.Series(incremental, dtype=float)}).fillna(0)
+        topics_df.index.name = 'Topic'
+        topics_df['fitted_share'] = topics_df['fitted_count'] / max(topics_df['fitted_count'].sum(), 1)
+        topics_df['incremental_share'] = topics_df['incremental_count'] / max(topics_df['incremental_count'].sum(), 1)
+        topics_df['Name'] = [entry['topic_names'].get(str(t)) for t in topics_df.index]
+
+        n_fitted, n_incremental = sum(fitted.values()), sum(incremental.values())
+        summary = {
+            'version': entry['version'],
+            'fitted_at': entry['fitted_at'],
+            'fitted_documents': n_fitted,
+            'incremental_documents': n_incremental,
+            'js_divergence': jensen_shannon_divergence(fitted, incremental),
+            'fitted_outlier_rate': fitted.get(-1, 0) / n_fitted if n_fitted else None,
+            'incremental_outlier_rate': incremental.get(-1, 0) / n_incremental if n_incremental else None,
+        }
+        return summary, topics_df.reset_index()
+
+    def needs_refit(self, now: datetime = None) -> bool:
+        """
+        :param now: The current time (defaults to now).
+        :return: Whether or not a full refit is due: no version yet, the latest one is too old, or it drifted too much.
+        """
+        entry = self.latest_version()
+        if entry is None:
+            return True
+        now = now or datetime.now()
+        if now - datetime.fromisoformat(entry['fitted_at']) >= timedelta(days=self.refit_every_days):
+            return True
+        return self.drift_report(entry['version'])[0]['js_divergence'] > self.max_drift
+
+    def run(self, documents: list, embeddings: np.ndarray, topic_model_factory):
+        """
+        The scheduled entry point: refits a new version if one is due, otherwise assigns the new documents with the latest
+        version.
+        :param documents: All the documents.
+        :param embeddings: The embeddings of the documents.
+        :param topic_model_factory: A function returning an unfitted BERTopic model, called only for a refit.
+        :return: The BERTopic model of the latest version.
+        """
+        if self.needs_refit():
+            return self.fit(documents, embeddings, topic_model_factory())
+        self.assign(documents, embeddings)
+        return self.load_model()
+
+    def document_info(self, documents: list, version=None) -> pd.DataFrame:
+        """
+        Given some documents, this method reads their recorded topics, in the format of BERTopic.get_document_info.
+        :param documents: The documents (already assigned by the version).
+        :param version: The version, the latest one by default.
+        :return: A DF with the Document, Topic, Name and Probability of each document, in the given order.
+        """
+        entry = self._get_version(version)
+        hashes = [content_hash(d) for d in documents]
+        q = '''
+        SELECT content_hash, topic, probability
+        FROM topic_assignments
+        WHERE model_version = %s AND content_hash = ANY(%s);
+        '''
+        assignments = {}
+        unique_hashes = list(set(hashes))
+        for start in range(0, len(unique_hashes), 10000):
+            rows = self.generic_db.execute_query(q, fetch_all=True,
+                                                 params=(entry['version'], unique_hashes[start: start + 10000]))
+            if not self.generic_db.check_db_result_sanity(rows):
+                assignments.update((h, (t, p)) for h, t, p in rows)
+
+        topics = [assignments.get(h, (None, None))[0] for h in hashes]
+        return pd.DataFrame({'Document': documents,
+                             'Topic': pd.array(topics, dtype='Int64'),
+                             'Name': [entry['topic_names'].get(str(t)) for t in topics],
+                             'Probability': [assignments.get(h, (None, None))[1] for h in hashes]})
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# The modules of src import each other by their plain names, like when run from src
+SRC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+sys.path.insert(0, SRC_DIR)
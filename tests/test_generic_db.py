@@ -0,0 +1,221 @@
+import re
+import threading
+
+import pandas as pd
+import psycopg2
+import psycopg2.extras
+import pytest
+
+import generic_db
+from generic_db import GenericDBOperations
+
+
+class StubCursor:
+    def __init__(self, connection, name=None):
+        self.connection = connection
+        self.name = name
+        self.rowcount = -1
+        self.description = None
+        self._rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def execute(self, query, params=None):
+        query = ' '.join(query.split())
+        self.connection.statements.append(query)
+        if self.connection.readonly:
+            self.connection.read_only_statements.append(query)
+        self.rowcount, self._rows = 0, []
+        if query.startswith('INSERT'):
+            # The single row of insert_into_table, whose first value is the id
+            row_id = re.search(r"VALUES \('([^']*)'", query).group(1)
+            self._insert([row_id])
+        elif query.startswith('SELECT'):
+            self._rows = [(1,)]
+            self.rowcount = 1
+            self.description = [('one', 23)]
+
+    def _insert(self, row_ids: list) -> list:
+        if 'bad' in row_ids:
+            raise psycopg2.DataError('invalid input syntax')
+        inserted = [(row_id,) for row_id in row_ids if row_id not in self.connection.table]
+        self.connection.table.update(row_ids)
+        self._rows, self.rowcount = inserted, len(inserted)
+        return inserted
+
+    def fetchone(self):
+        return self._rows[0]
+
+    def fetchall(self):
+        return self._rows
+
+    def fetchmany(self, size):
+        rows, self._rows = self._rows[:size], self._rows[size:]
+        return rows
+
+    def close(self):
+        pass
+
+
+class StubConnection:
+    """
+    A psycopg2 connection stand-in recording the statements, commits and rollbacks, on a table of ids.
+    """
+
+    def __init__(self):
+        self.closed = 0
+        self.statements = []
+        self.table = set()
+        self.readonly = False
+        self.read_only_statements = []
+
+    def cursor(self, name=None):
+        return StubCursor(self, name=name)
+
+    def commit(self):
+        self.statements.append('COMMIT')
+
+    def rollback(self):
+        self.statements.append('ROLLBACK')
+
+    def set_session(self, readonly=None):
+        self.readonly = readonly
+
+
+class StubPool:
+    def __init__(self, min_size, max_size, **credentials):
+        self.closed = False
+        self.connection = StubConnection()
+        self.released = 0
+
+    def getconn(self):
+        return self.connection
+
+    def putconn(self, connection, close=False):
+        self.released += 1
+
+
+def stub_execute_values(cur, query, values, page_size=100, fetch=False):
+    cur.connection.statements.append('INSERT VALUES')
+    return cur._insert([row[0] for row in values])
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    monkeypatch.setattr(generic_db.pg.pool, 'ThreadedConnectionPool', StubPool)
+    monkeypatch.setattr(psycopg2.extras, 'execute_values', stub_execute_values)
+    config_path = tmp_path / 'db_config.yml'
+    config_path.write_text('credentials: {}\npool:\n  max_size: 1\n  acquire_timeout: 0.1\n')
+    db = GenericDBOperations(path=str(config_path))
+    db._connect_to_db()
+    return db
+
+
+def test_transaction_commits_and_releases_its_connection(db):
+    with db.transaction() as cur:
+        cur.execute('SELECT 1;')
+
+    assert db.connection_pool.connection.statements == ['SELECT 1;', 'COMMIT']
+    assert db.connection_pool.released == 1
+
+
+def test_transaction_rolls_back_when_it_raises(db):
+    with pytest.raises(ValueError):
+        with db.transaction() as cur:
+            cur.execute('SELECT 1;')
+            raise ValueError()
+
+    assert db.connection_pool.connection.statements == ['SELECT 1;', 'ROLLBACK']
+    assert db.connection_pool.released == 1
+
+
+def test_nested_transactions_are_savepoints(db):
+    with db.transaction() as cur:
+        with db.transaction() as inner_cur:
+            inner_cur.execute('SELECT 1;')
+        with pytest.raises(ValueError):
+            with db.transaction():
+                with db.transaction():
+                    raise ValueError()
+        cur.execute('SELECT 2;')
+
+    assert db.connection_pool.connection.statements == [
+        'SAVEPOINT sp_1;', 'SELECT 1;', 'RELEASE SAVEPOINT sp_1;',
+        'SAVEPOINT sp_1;', 'SAVEPOINT sp_2;', 'ROLLBACK TO SAVEPOINT sp_2;', 'ROLLBACK TO SAVEPOINT sp_1;',
+        'SELECT 2;', 'COMMIT']
+    assert db.connection_pool.released == 1
+
+
+def test_acquire_times_out_on_an_exhausted_pool(db):
+    acquired, done = threading.Event(), threading.Event()
+
+    def hold_connection():
+        with db.transaction():
+            acquired.set()
+            done.wait()
+
+    holder = threading.Thread(target=hold_connection)
+    holder.start()
+    acquired.wait()
+    try:
+        with pytest.raises(RuntimeError, match='No free database connection'):
+            with db.transaction():
+                pass
+    finally:
+        done.set()
+        holder.join()
+    # The slot of the holder is free again
+    with db.transaction():
+        pass
+
+
+def test_stream_query_reads_on_a_read_only_connection(db):
+    chunks = list(db.stream_query('SELECT 1;'))
+
+    assert [chunk.to_dict('records') for chunk in chunks] == [[{'one': 1}]]
+    connection = db.connection_pool.connection
+    assert connection.read_only_statements == ['SELECT 1;']
+    # The connection goes back to the pool read-write
+    assert connection.readonly is False
+    assert connection.statements == ['SELECT 1;', 'ROLLBACK']
+    assert db.connection_pool.released == 1
+
+
+def test_stream_query_inside_a_transaction_uses_its_connection(db):
+    with db.transaction():
+        chunks = list(db.stream_query('SELECT 1;'))
+
+    assert len(chunks) == 1
+    assert db.connection_pool.connection.read_only_statements == []
+    assert db.connection_pool.connection.statements == ['SELECT 1;', 'COMMIT']
+    assert db.connection_pool.released == 1
+
+
+def test_bulk_insert_skips_duplicates_and_conflicts(db):
+    db.connection_pool.connection.table.add('t3_c')
+    df = pd.DataFrame({'submission_id': ['t3_a', 't3_b', 't3_a', None, 't3_c'], 'title': list('abcde')})
+
+    assert db.bulk_insert_into_table('submissions', df, id_col='submission_id', page_size=2, fetch_ids=True) == \
+        (2, 3, [('t3_a',), ('t3_b',)])
+    assert db.connection_pool.connection.statements == ['INSERT VALUES', 'COMMIT', 'INSERT VALUES', 'COMMIT']
+
+
+def test_failed_batch_falls_back_to_row_by_row(db):
+    df = pd.DataFrame({'submission_id': ['t3_a', 'bad', 't3_b', 't3_c'], 'title': list('abcd')})
+    with db.transaction():
+        result = db.bulk_insert_into_table('submissions', df, id_col='submission_id', page_size=3, fetch_ids=True)
+
+    assert result == (3, 1, [('t3_a',), ('t3_b',), ('t3_c',)])
+    statements = db.connection_pool.connection.statements
+    # The failed batch is rolled back to its savepoint, then its rows are inserted one savepoint each
+    assert statements[:3] == ['SAVEPOINT sp_1;', 'INSERT VALUES', 'ROLLBACK TO SAVEPOINT sp_1;']
+    assert [s.split()[0] for s in statements[3:]] == [
+        'SAVEPOINT', 'INSERT', 'RELEASE',
+        'SAVEPOINT', 'INSERT', 'ROLLBACK',
+        'SAVEPOINT', 'INSERT', 'RELEASE',
+        'SAVEPOINT', 'INSERT', 'RELEASE',
+        'COMMIT']
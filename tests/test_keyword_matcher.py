@@ -0,0 +1,34 @@
+import os
+import random
+
+import yaml
+
+from conftest import SRC_DIR
+from keyword_matcher import KeywordMatcher
+from query_planner import keyword_parts
+
+with open(os.path.join(SRC_DIR, 'config', 'keywords.yml')) as config_stream:
+    KEYWORDS = yaml.full_load(config_stream)['keywords']
+
+
+def naive_match(keywords: list, text: str) -> list:
+    # The has_exact_keyword check: every part of the AND group occurs in the text, case insensitively
+    return [k for k in keywords if all(part in text.lower() for part in keyword_parts(k))]
+
+
+def test_matches_like_the_substring_check():
+    words = ['heat', 'Heatwave', 'wave', 'dome', 'BC', 'climate', 'change', 'crisis', 'hot', 'hottest', 'day', 'summer',
+             'year', 'urban', 'island', 'stress', 'warming', 'planet', 'the', 'in', 'extreme', 'weather', 'stroke']
+    rng = random.Random(0)
+    matcher = KeywordMatcher(KEYWORDS)
+    for _ in range(2000):
+        text = rng.choice([' ', '']).join(rng.choice(words) for _ in range(rng.randint(0, 8)))
+        assert matcher.match(text) == naive_match(KEYWORDS, text), text
+
+
+def test_overlapping_parts_are_all_found():
+    matcher = KeywordMatcher(KEYWORDS)
+
+    assert matcher.match('Another HEATWAVE: the BC heat wave, climate change') == \
+        ['climate change AND heat', 'BC heat wave', 'heat', 'heatwave', 'heat wave', 'climate AND heat']
+    assert matcher.match('') == []
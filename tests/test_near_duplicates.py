@@ -0,0 +1,33 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from near_duplicates import NearDuplicateIndex, shingle_hashes
+
+TEXT = 'record temperatures were measured across the province during the heat dome of late june'
+
+
+def test_shingles_ignore_case_and_punctuation():
+    hashes, counts = shingle_hashes([TEXT, TEXT.upper().replace(' ', ', '), 'too short', ''], shingle_size=5)
+
+    assert counts.tolist() == [10, 10, 1, 0]
+    assert np.array_equal(hashes[:10], hashes[10:20])
+
+
+def test_near_copies_are_clustered_on_their_first_document():
+    documents = ['an unrelated comment about the hockey game', TEXT, '', TEXT + ' (source: CBC)', '',
+                 TEXT.capitalize() + '!']
+    deduplication = NearDuplicateIndex(threshold=0.7).deduplicate(documents)
+
+    assert deduplication.documents == [documents[0], TEXT, '', '']
+    assert deduplication.mapping.tolist() == [0, 1, 2, 1, 3, 1]
+    assert deduplication.duplicate_rate == pytest.approx(2 / 6)
+    assert deduplication.expand(['a', 'b', 'c', 'd']) == ['a', 'b', 'c', 'b', 'd', 'b']
+
+
+def test_deduplicate_frame_maps_to_the_canonical_ids():
+    df = pd.DataFrame({'id': ['t3_a', 't3_b', 't3_c'], 'text': [TEXT, 'something else entirely', TEXT + '.']})
+    duplicates_df = NearDuplicateIndex().deduplicate_frame(df, id_col='id', text_col='text')
+
+    assert duplicates_df['canonical_id'].tolist() == ['t3_a', 't3_b', 't3_a']
+    assert duplicates_df['cluster_size'].tolist() == [2, 1, 2]
@@ -0,0 +1,49 @@
+from query_planner import SearchPlanner
+
+KEYWORDS = ['heat', 'heat dome', 'climate change AND heat', 'heatwave', 'hot day', 'hottest day']
+
+
+def test_plan_covers_every_keyword_with_the_broadest_terms():
+    searches = SearchPlanner(KEYWORDS, max_terms=2).plan()
+
+    assert [search.terms for search in searches] == [(('heat',), ('heatwave',)), (('hot', 'day'), ('hottest', 'day'))]
+    assert [search.query for search in searches] == ['title:heat OR title:heatwave',
+                                                     '(title:hot AND title:day) OR (title:hottest AND title:day)']
+    assert sorted(k for search in searches for k in search.keywords) == sorted(KEYWORDS)
+
+
+def test_split_halves_an_or_query():
+    planner = SearchPlanner(KEYWORDS)
+    halves = planner.split(planner.plan()[0])
+
+    assert [search.terms for search in halves] == [(('heat',), ('heatwave',)), (('hot', 'day'), ('hottest', 'day'))]
+    assert halves[1].keywords == ('hot day', 'hottest day')
+    assert {search.depth for search in halves} == {1}
+
+
+def test_split_term_sorts_and_plans_its_narrower_keywords_again():
+    planner = SearchPlanner(KEYWORDS, max_terms=1, split_sorts=['new', 'top'])
+    heat = planner.plan()[0]
+    searches = planner.split(heat)
+
+    assert [(search.query, search.sort) for search in searches] == [
+        ('title:heat', 'new'), ('title:heat', 'top'),
+        ('title:heat AND title:dome', 'relevance'), ('title:climate AND title:change AND title:heat', 'relevance')]
+    assert searches[2].keywords == ('heat dome',)
+    assert planner.split(searches[0]) == []
+
+
+def test_assign_matches_words_and_substrings():
+    planner = SearchPlanner(KEYWORDS)
+    search = planner.plan()[0]
+
+    assert planner.assign('Heat dome over BC', search) == ['heat', 'heat dome']
+    assert planner.assign('Heatwaves and climate change', search) == ['heat', 'climate change AND heat', 'heatwave']
+
+
+def test_assign_keeps_unmatched_results_under_the_searched_keywords():
+    planner = SearchPlanner(KEYWORDS, max_terms=1)
+    search = planner.split(planner.plan()[0])[-1]
+
+    assert planner.assign('Climate is changing, so is the heating bill', search) == ['climate change AND heat']
+    assert planner.assign(None, search) == ['climate change AND heat']
@@ -0,0 +1,103 @@
+import json
+from types import SimpleNamespace
+
+from generic_db import GenericDBOperations
+from near_duplicates import NearDuplicateIndex
+from sentiment_scoring import DocumentScorer
+
+LABELS = {0: 'NEGATIVE', 1: 'POSITIVE'}
+
+
+def expected_scores(text: str) -> dict:
+    positive = (sum(map(ord, text)) % 100) / 100
+    return {'NEGATIVE': 1 - positive, 'POSITIVE': positive}
+
+
+class StubTextClassifier:
+    """
+    A text-classification pipeline stand-in, whose scores only depend on the text and which records what it scored.
+    """
+
+    def __init__(self):
+        self.model = SimpleNamespace(config=SimpleNamespace(id2label=LABELS))
+        self.scored = []
+
+    @staticmethod
+    def tokenizer(texts, truncation=True, max_length=512):
+        return {'input_ids': [text.split()[:max_length] for text in texts]}
+
+    def __call__(self, texts, **kwargs):
+        self.scored += texts
+        return [[{'label': label, 'score': score} for label, score in expected_scores(text).items()] for text in texts]
+
+
+class InMemoryDB:
+    """
+    The part of GenericDBOperations DocumentScorer uses, on a dict of the document_scores rows.
+    """
+
+    check_db_result_sanity = staticmethod(GenericDBOperations.check_db_result_sanity)
+
+    def __init__(self):
+        self.document_scores = {}
+
+    def execute_query(self, query, fetch_one=False, fetch_all=False, row_count=False, params=None):
+        if query.lstrip().startswith('SELECT'):
+            model, hashes = params
+            return [(h, json.loads(self.document_scores[(h, model)])) for h in hashes
+                    if (h, model) in self.document_scores]
+
+    def bulk_insert_into_table(self, table_name, data, id_col, page_size=1000, fetch_ids=False):
+        inserted = 0
+        for row in data.itertuples(index=False):
+            if (row.content_hash, row.model) not in self.document_scores:
+                self.document_scores[(row.content_hash, row.model)] = row.scores
+                inserted += 1
+        return inserted, len(data) - inserted
+
+
+def make_scorer(db=None, **kwargs):
+    return DocumentScorer(db or InMemoryDB(), model_name='stub', text_classifier=StubTextClassifier(), **kwargs)
+
+
+DOCUMENTS = ['a much longer document about the heat dome over the whole province',
+             'short one',
+             'a document of medium length about heat',
+             'short one',
+             'hot']
+
+
+def test_scores_keep_the_order_of_the_documents():
+    scores_df = make_scorer(batch_size=2, commit_every=2).score(DOCUMENTS)
+
+    assert list(scores_df.columns) == ['NEGATIVE', 'POSITIVE']
+    assert scores_df.to_dict('records') == [expected_scores(d) for d in DOCUMENTS]
+
+
+def test_duplicates_are_scored_once():
+    scorer = make_scorer()
+    scorer.score(DOCUMENTS)
+
+    assert sorted(scorer.text_classifier.scored) == sorted(set(DOCUMENTS))
+
+
+def test_rerun_scores_nothing():
+    db = InMemoryDB()
+    first_df = make_scorer(db).score(DOCUMENTS)
+    scorer = make_scorer(db)
+    second_df = scorer.score(DOCUMENTS)
+
+    assert scorer.text_classifier.scored == []
+    assert second_df.equals(first_df)
+
+
+def test_near_duplicates_share_the_scores_of_their_cluster():
+    documents = ['the heat wave broke every record in the city this week',
+                 'unrelated text about the weather in the spring of this year',
+                 'The heat wave broke every record in the city this week!']
+    scorer = make_scorer()
+    scores_df = scorer.score(documents, near_duplicates=NearDuplicateIndex())
+
+    assert sorted(scorer.text_classifier.scored) == sorted(documents[:2])
+    assert scores_df.to_dict('records') == [expected_scores(documents[0]), expected_scores(documents[1]),
+                                            expected_scores(documents[0])]